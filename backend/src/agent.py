@@ -1,29 +1,70 @@
+import functools
+
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import StateGraph, START, END
+from checkpoints import checkpointer_from_env
 from configuration import Configuration
-from state import OverallState
+from state import OverallState, WebSearchState
+from tracing import traced_node
+
+from nodes import check_answer_cache, acheck_answer_cache, route_answer_cache
+from nodes import generate_query, agenerate_query
+from nodes import web_research, aweb_research
+from nodes import reflection, areflection, finalize_answer, afinalize_answer
+from nodes import continue_to_web_research, evaluate_search
+
+
+def _node(func, afunc):
+    # the graph runs the sync function under invoke/stream and the async twin
+    # under ainvoke/astream, so async callers never block a thread on I/O;
+    # with `trace_path` set, every execution records a span
+    run, arun = traced_node(func.__name__, func, afunc)
+    return RunnableLambda(run, afunc=arun, name=func.__name__)
+
 
-from nodes import generate_query
-from nodes import web_research
-from nodes import reflection, finalize_answer, continue_to_web_research, evaluate_search
+def build_graph() -> StateGraph:
+    """Builds the uncompiled research graph."""
+    builder = StateGraph(OverallState, config_schema=Configuration)
+    builder.add_node("check_answer_cache", _node(check_answer_cache, acheck_answer_cache))
+    builder.add_node("generate_query", _node(generate_query, agenerate_query))
+    builder.add_node("web_research", _node(web_research, aweb_research), input=WebSearchState)
+    builder.add_node("reflection", _node(reflection, areflection))
+    builder.add_node("finalize_answer", _node(finalize_answer, afinalize_answer))
 
-builder = StateGraph(OverallState, config_schema=Configuration)
-builder.add_node("generate_query", generate_query)
-builder.add_node("web_research", web_research)
-builder.add_node("reflection", reflection)
-builder.add_node("finalize_answer", finalize_answer)
+    builder.add_edge(START, "check_answer_cache")
+    # a repeat question is answered from the cache without any research
+    builder.add_conditional_edges("check_answer_cache", route_answer_cache, ["generate_query", END])
 
+    #add conditional edge to continue with the search queries in a parallel branch
+    builder.add_conditional_edges("generate_query", continue_to_web_research, ["web_research"])
+    builder.add_edge("web_research", "reflection")
+    #evaluate the search
+    builder.add_conditional_edges("reflection", evaluate_search, ["web_research", "finalize_answer"])
+    builder.add_edge("finalize_answer", END)
+    return builder
 
-builder.add_edge(START, "generate_query")
 
-#add conditional edge to continue with the search queries in a parallel branch
-builder.add_conditional_edges("generate_query", continue_to_web_research, ["web_research"])
-builder.add_edge("web_research", "reflection")
-#evaluate the search
-builder.add_conditional_edges("reflection", evaluate_search, ["web_research", "finalize_answer"])
-builder.add_edge("finalize_answer", END)
-graph = builder.compile(name="pro-search-agent")
+@functools.lru_cache(maxsize=None)
+def get_builder() -> StateGraph:
+    return build_graph()
 
 
+@functools.lru_cache(maxsize=None)
+def get_graph():
+    """
+    Returns the process-wide compiled graph, compiling it on first use.
 
+    With a durable checkpointer (opted into through `CHECKPOINTER`), every
+    finished branch is recorded, so a run resumed with the same thread_id
+    re-runs only the branches that had not completed.
+    """
+    return get_builder().compile(name="pro-search-agent", checkpointer=checkpointer_from_env())
 
 
+def __getattr__(name: str):
+    # `from agent import graph` keeps working, but importing the module compiles nothing
+    if name == "graph":
+        return get_graph()
+    if name == "builder":
+        return get_builder()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,175 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from dedup import MinHashIndex, same_distinguishing_tokens
+from utils import normalize_query
+
+
+class AnswerCache:
+    """
+    Final answers keyed on research topic, matched by approximate similarity.
+
+    A topic that normalizes to a cached one is an exact hit; otherwise the MinHash
+    LSH index over the topics' character n-grams finds the most similar cached
+    topic, which hits if its estimated Jaccard similarity is at least `threshold`
+    and it names the same years, numbers and entities (`same_distinguishing_tokens`);
+    "... revenue in fiscal year 2023?" never answers "... 2024?".
+    Entries expire after `ttl` seconds and the least recently used ones are
+    evicted beyond `max_entries`. When `path` is given they are also kept in a
+    SQLite file and reloaded on startup.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 3600, threshold: float = 0.85,
+                 max_entries: int = 10_000):
+        self.path = path
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._index = MinHashIndex()
+        # topics still in the index after their entry was dropped; the index has no removal
+        self._stale = 0
+        self._stats = {
+            "exact_hits": 0, "similar_hits": 0, "misses": 0,
+            "expired": 0, "evicted": 0, "writes": 0,
+        }
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " key TEXT PRIMARY KEY, topic TEXT NOT NULL, answer TEXT NOT NULL,"
+                " sources TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._load()
+
+    def _load(self):
+        rows = self._db.execute(
+            "SELECT key, topic, answer, sources, created FROM answers WHERE created >= ? "
+            "ORDER BY accessed DESC LIMIT ?",
+            (time.time() - self.ttl, self.max_entries),
+        ).fetchall()
+        for key, topic, answer, sources, created in reversed(rows):
+            self._entries[key] = {"topic": topic, "answer": answer, "sources_gathered": json.loads(sources),
+                                  "created": created}
+            self._index.add(topic)
+
+    def _drop(self, key: str, stat: str):
+        del self._entries[key]
+        self._stale += 1
+        self._stats[stat] += 1
+        if self._db is not None:
+            self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+
+    def _rebuild_index(self):
+        self._index = MinHashIndex()
+        for entry in self._entries.values():
+            self._index.add(entry["topic"])
+        self._stale = 0
+
+    def _fresh(self, key: str, now: float) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if now - entry["created"] > self.ttl:
+            self._drop(key, "expired")
+            return None
+        return entry
+
+    def get(self, topic: str) -> Optional[dict]:
+        """
+        Returns {"answer", "sources_gathered", "topic", "similarity"} of the cached
+        topic closest to `topic`, or None on a miss.
+        """
+        key = normalize_query(topic)
+        now = time.time()
+        with self._lock:
+            entry, similarity = self._fresh(key, now), 1.0
+            if entry is not None:
+                self._stats["exact_hits"] += 1
+            else:
+                for other, similarity in self._index.query(topic, self.threshold):
+                    if not same_distinguishing_tokens(topic, other):
+                        continue
+                    entry = self._fresh(normalize_query(other), now)
+                    if entry is not None:
+                        key = normalize_query(other)
+                        self._stats["similar_hits"] += 1
+                        break
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute("UPDATE answers SET accessed = ? WHERE key = ?", (now, key))
+        return {
+            "answer": entry["answer"],
+            "sources_gathered": entry["sources_gathered"],
+            "topic": entry["topic"],
+            "similarity": similarity,
+        }
+
+    def put(self, topic: str, answer: str, sources_gathered: list) -> None:
+        key = normalize_query(topic)
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+            else:
+                self._index.add(topic)
+            self._entries[key] = {"topic": topic, "answer": answer, "sources_gathered": sources_gathered,
+                                  "created": now}
+            self._stats["writes"] += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO answers (key, topic, answer, sources, created, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, topic, answer, json.dumps(sources_gathered), now, now),
+                )
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)), "evicted")
+            if self._stale > len(self._entries):
+                self._rebuild_index()
+
+    def stats(self) -> dict:
+        """Hit/miss counters, with the overall hit rate."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        hits = stats["exact_hits"] + stats["similar_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._rebuild_index()
+            if self._db is not None:
+                self._db.execute("DELETE FROM answers")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_answer_cache(path: Optional[str], ttl: float, threshold: float, max_entries: int) -> AnswerCache:
+    """Returns the process-wide cache for these settings, creating it on first use."""
+    key = (path or None, ttl, threshold, max_entries)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = AnswerCache(path or None, ttl, threshold, max_entries)
+        return cache
@@ -0,0 +1,337 @@
+"""
+HTTP service streaming research runs over Server-Sent Events.
+
+    python app.py
+    curl -N -X POST localhost:8000/runs/stream -H 'Content-Type: application/json' \\
+        -d '{"question": "How did margins change last year?"}'
+
+A run streams "queued" and "started" events, one "node" event per finished
+node, the answer as "token" events and a final "done" (or "error" or
+"cancelled") event. Runs are admitted through a bounded queue with a
+per-client concurrency limit, set by the MAX_CONCURRENT_RUNS,
+MAX_QUEUED_RUNS and MAX_RUNS_PER_CLIENT environment variables. Runs beyond
+them are refused with a 429. A client going away, or
+`DELETE /runs/{run_id}`, cancels the run and its in-flight searches. On
+shutdown the service stops admitting runs and gives the streams in flight
+DRAIN_TIMEOUT seconds to finish (run it with `python app.py`, or pass the
+same value to uvicorn's --timeout-graceful-shutdown) before cancelling them.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from contextlib import aclosing, asynccontextmanager
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from langchain_core.messages import HumanMessage
+from pydantic import BaseModel
+
+from agent import get_graph
+from cascade import cascade_stats
+from clients import get_client_registry
+from nodes import forgetting_runs
+from speculation import speculation_registry
+from state import RESET
+from utils import percentile
+
+# the update keys worth showing as progress, per node
+PROGRESS_KEYS = {
+    "check_answer_cache": ("metrics",),
+    "generate_query": ("query_list", "suppressed_queries"),
+    "web_research": ("search_query", "skipped_queries"),
+    "reflection": ("is_sufficient", "knowledge_gap", "follow_up_queries"),
+    "finalize_answer": (),
+}
+
+
+class Rejected(Exception):
+    def __init__(self, status: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionQueue:
+    """
+    Admits runs up to `max_running` at a time, queueing up to `max_queued` more.
+
+    A client may have at most `per_client` runs queued or running. Requests
+    beyond any limit are refused up front instead of waiting, so an overloaded
+    service sheds load quickly and clients can back off. A limit of 0 disables it.
+    """
+
+    def __init__(self, max_running: int, max_queued: int, per_client: int):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.per_client = per_client
+        self.draining = False
+        self._running = asyncio.Semaphore(max_running) if max_running else None
+        self._queued = 0
+        self._active = 0
+        self._clients = {}
+        self._waits = []
+        self._stats = {"admitted": 0, "rejected_queue_full": 0, "rejected_client_limit": 0,
+                       "rejected_draining": 0, "completed": 0}
+
+    def reserve(self, client: str):
+        """Takes a queue place for one of `client`'s runs, or raises `Rejected`."""
+        if self.draining:
+            self._stats["rejected_draining"] += 1
+            raise Rejected(503, "draining", 5.0)
+        if self.per_client and self._clients.get(client, 0) >= self.per_client:
+            self._stats["rejected_client_limit"] += 1
+            raise Rejected(429, "too many runs for this client", 1.0)
+        if self.max_running and self.max_queued and self._queued + self._active >= self.max_running + self.max_queued:
+            self._stats["rejected_queue_full"] += 1
+            raise Rejected(429, "queue full", self._retry_after())
+        self._clients[client] = self._clients.get(client, 0) + 1
+        self._queued += 1
+        self._stats["admitted"] += 1
+
+    def _retry_after(self) -> float:
+        # roughly how long until the queue ahead has drained, from recent waits
+        return max(1.0, percentile(self._waits[-100:], 50))
+
+    @asynccontextmanager
+    async def slot(self, client: str):
+        """Waits for a running slot for a reserved run; yields the seconds spent queued."""
+        started = time.perf_counter()
+        if self._running is not None:
+            await self._running.acquire()
+        waited = time.perf_counter() - started
+        self._waits = self._waits[-999:] + [waited]
+        self._queued -= 1
+        self._active += 1
+        try:
+            yield waited
+        finally:
+            self._active -= 1
+            self._stats["completed"] += 1
+            self._release_client(client)
+            if self._running is not None:
+                self._running.release()
+
+    def cancel(self, client: str):
+        """Gives back the reservation of a run that left the queue without running."""
+        self._queued -= 1
+        self._release_client(client)
+
+    def _release_client(self, client: str):
+        self._clients[client] -= 1
+        if not self._clients[client]:
+            del self._clients[client]
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "running": self._active,
+            "queued": self._queued,
+            "draining": self.draining,
+            "queue_wait_p50_s": percentile(self._waits, 50),
+            "queue_wait_p95_s": percentile(self._waits, 95),
+        }
+
+
+class RunRequest(BaseModel):
+    question: str
+    # continues the thread of an earlier run: resumes it if it was interrupted, else asks a follow-up
+    thread_id: Optional[str] = None
+    # overrides of the graph's Configuration fields
+    config: dict = {}
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def _shown(value):
+    # a run's first update resets its metrics, which is no progress to show
+    return {key: item for key, item in value.items() if key != RESET} if isinstance(value, dict) else value
+
+
+def _progress(node: str, update) -> dict:
+    update = update if isinstance(update, dict) else {}
+    return {"node": node, **{key: _shown(update[key]) for key in PROGRESS_KEYS.get(node, ()) if key in update}}
+
+
+class Run:
+    """One streamed run: the graph task and the bounded queue of its events."""
+
+    def __init__(self, body: RunRequest, client: str):
+        self.id = uuid.uuid4().hex
+        self.client = client
+        self.body = body
+        self.thread_id = body.thread_id or self.id
+        # bounded, so a client reading slowly slows its run down instead of buffering it
+        self.events = asyncio.Queue(maxsize=64)
+        self.task = None
+        self.cancel_requested = False
+
+    async def execute(self):
+        graph = get_graph()
+        config = {
+            # tokens are what the stream is for, unless the client turns them off
+            "configurable": {"stream_answer": True, **self.body.config, "thread_id": self.thread_id},
+            "recursion_limit": 100,
+        }
+        inputs = {"messages": [HumanMessage(content=self.body.question)]}
+        if self.body.thread_id and graph.checkpointer is not None:
+            # an interrupted run continues where it stopped instead of taking a new question
+            snapshot = await graph.aget_state(config)
+            if snapshot.next:
+                inputs = None
+        final = {}
+        try:
+            # the searches of a run that is cancelled or fails are cancelled with it
+            with forgetting_runs():
+                # closed explicitly, so that on cancellation the graph's own tasks are torn down at once
+                stream_mode = ["updates", "custom", "values"]
+                async with aclosing(graph.astream(inputs, config, stream_mode=stream_mode)) as chunks:
+                    async for mode, chunk in chunks:
+                        if mode == "values":
+                            final = chunk
+                        elif mode == "custom" and "answer_token" in chunk:
+                            await self.events.put(sse("token", {"text": chunk["answer_token"]}))
+                        elif mode == "custom":
+                            await self.events.put(sse("metric", chunk))
+                        elif mode == "updates":
+                            for node, update in chunk.items():
+                                await self.events.put(sse("node", _progress(node, update)))
+            await self.events.put(sse("done", {
+                "run_id": self.id,
+                "thread_id": self.thread_id,
+                "answer": final["messages"][-1].content,
+                "sources": [source["value"] for source in final.get("cited_sources") or []],
+            }))
+        except asyncio.CancelledError:
+            self._put_nowait(sse("cancelled", {"run_id": self.id}))
+            raise
+        except Exception as exc:
+            await self.events.put(sse("error", {"run_id": self.id, "error": f"{type(exc).__name__}: {exc}"}))
+        finally:
+            # None ends the stream; the reader also stops once the task is done and the queue empty
+            self._put_nowait(None)
+
+    def _put_nowait(self, event: Optional[str]):
+        if not self.events.full():
+            self.events.put_nowait(event)
+
+
+def create_app(
+        max_running: int = 32,
+        max_queued: int = 128,
+        per_client: int = 4,
+        drain_timeout: float = 30.0,
+) -> FastAPI:
+    admission = AdmissionQueue(max_running, max_queued, per_client)
+    runs = {}
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        # graceful drain: refuse new runs, let those in flight finish, then cancel the rest
+        admission.draining = True
+        tasks = [run.task for run in runs.values() if run.task is not None]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        registry = get_client_registry()
+        if hasattr(registry, "aclose"):
+            await registry.aclose()
+
+    app = FastAPI(title="pro-search-agent", lifespan=lifespan)
+    app.state.admission = admission
+    app.state.runs = runs
+
+    async def stream(run: Run):
+        started = False
+        try:
+            yield sse("queued", {"run_id": run.id, "queued": admission.stats()["queued"]})
+            async with admission.slot(run.client) as waited:
+                started = True
+                if run.cancel_requested:
+                    # cancelled while queued
+                    yield sse("cancelled", {"run_id": run.id})
+                    return
+                yield sse("started", {"run_id": run.id, "queue_wait_s": waited})
+                run.task = asyncio.create_task(run.execute())
+                while True:
+                    event = await run.events.get()
+                    if event is None:
+                        break
+                    yield event
+                    if run.task.done() and run.events.empty():
+                        break
+        finally:
+            if not started:
+                admission.cancel(run.client)
+            # the client went away, or the run ended: either way nothing may keep running. The
+            # stream may itself be being cancelled, so the run is forgotten once it has unwound
+            # rather than awaited here
+            if run.task is not None and not run.task.done():
+                run.task.cancel()
+                run.task.add_done_callback(lambda _: runs.pop(run.id, None))
+            else:
+                runs.pop(run.id, None)
+
+    @app.post("/runs/stream")
+    async def stream_run(body: RunRequest, request: Request):
+        client = request.headers.get("x-client-id") or (request.client.host if request.client else "unknown")
+        try:
+            admission.reserve(client)
+        except Rejected as exc:
+            return JSONResponse(
+                {"error": exc.reason}, status_code=exc.status,
+                headers={"Retry-After": f"{exc.retry_after:.0f}"},
+            )
+        run = Run(body, client)
+        runs[run.id] = run
+        return StreamingResponse(
+            stream(run), media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Run-Id": run.id},
+        )
+
+    @app.delete("/runs/{run_id}")
+    async def cancel_run(run_id: str):
+        run = runs.get(run_id)
+        if run is None:
+            return JSONResponse({"error": "unknown run"}, status_code=404)
+        run.cancel_requested = True
+        if run.task is not None:
+            run.task.cancel()
+        return {"run_id": run_id, "cancelled": True}
+
+    @app.get("/stats")
+    async def stats():
+        return {"admission": admission.stats(), "runs": len(runs), "cascade": cascade_stats(),
+                "speculation": speculation_registry.stats()}
+
+    @app.get("/healthz")
+    async def healthz():
+        if admission.draining:
+            return JSONResponse({"status": "draining"}, status_code=503)
+        return {"status": "ok"}
+
+    return app
+
+
+app = create_app(
+    max_running=int(os.environ.get("MAX_CONCURRENT_RUNS", 32)),
+    max_queued=int(os.environ.get("MAX_QUEUED_RUNS", 128)),
+    per_client=int(os.environ.get("MAX_RUNS_PER_CLIENT", 4)),
+    drain_timeout=float(os.environ.get("DRAIN_TIMEOUT", 30)),
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvicorn lets open streams finish for this long before closing them on shutdown
+    uvicorn.run(app, host=os.environ.get("HOST", "127.0.0.1"), port=int(os.environ.get("PORT", 8000)),
+                timeout_graceful_shutdown=int(os.environ.get("DRAIN_TIMEOUT", 30)))
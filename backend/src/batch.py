@@ -0,0 +1,234 @@
+"""
+Batch research over a JSONL file of questions, through the one compiled graph.
+
+Each input line is an object with the question under "question" (or "title"
+and "body", as in a request backlog) and an optional "id" (or "request_id";
+the line number otherwise). Up to `--concurrency` questions run at once, all
+sharing the process-wide client pools, caches and rate limiters, and each
+result is appended to the output JSONL as soon as its run finishes:
+
+    python batch.py questions.jsonl --output answers.jsonl --concurrency 16
+    python batch.py ../../requests.jsonl --output answers.jsonl --fake
+
+Re-running with the same output file resumes the batch: questions already
+answered there are skipped, and runs interrupted midway continue from their
+last checkpoint instead of restarting. The command line checkpoints to SQLite
+unless `CHECKPOINTER` says otherwise, and drops a run's checkpoints once its
+result is written.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from typing import AsyncIterator, Iterable, Iterator, Optional, TextIO
+
+from langchain_core.messages import HumanMessage
+
+import agent
+from nodes import forgetting_runs
+from utils import percentile
+
+
+def read_questions(lines: Iterable[str]) -> Iterator[dict]:
+    """Parses JSONL question lines into {"id", "question"} dicts, skipping blank lines."""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        question = item.get("question") or "\n\n".join(
+            part for part in (item.get("title"), item.get("body")) if part
+        )
+        if not question:
+            raise ValueError(f"line {number} has no question")
+        yield {"id": str(item.get("id") or item.get("request_id") or number), "question": question}
+
+
+def answered_ids(path: str) -> set:
+    """Ids of the questions with a successful result in an earlier output file."""
+    done = set()
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a batch killed mid-write
+                    continue
+                if result.get("status") == "ok":
+                    done.add(result["id"])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def thread_id(batch_id: str, item: dict, configurable: dict) -> str:
+    """
+    The checkpoint thread of a question: `<batch_id>:<id>:<digest>`, where the
+    digest covers the question and its configuration, so that another file
+    reusing the batch id and question ids never resumes this one's runs.
+    """
+    digest = hashlib.sha256(
+        json.dumps({"question": item["question"], "configurable": configurable}, sort_keys=True, default=str)
+        .encode("utf-8")
+    ).hexdigest()[:16]
+    return f"{batch_id}:{item['id']}:{digest}"
+
+
+def _asks(snapshot, item: dict) -> bool:
+    """Whether a checkpointed run is of the item's question."""
+    messages = (snapshot.values or {}).get("messages") or []
+    return bool(messages) and messages[0].content == item["question"]
+
+
+async def _invoke(item: dict, config: dict, fresh: bool) -> dict:
+    thread_id = config["configurable"]["thread_id"]
+    # compiled on the first question, so importing this module compiles nothing
+    graph = agent.get_graph()
+    if graph.checkpointer is not None:
+        snapshot = None if fresh else await graph.aget_state(config)
+        if snapshot is None or (snapshot.values and not _asks(snapshot, item)):
+            # a thread of another question is never resumed
+            await graph.checkpointer.adelete_thread(thread_id)
+            snapshot = await graph.aget_state(config)
+        if snapshot.values and not snapshot.next:
+            # finished before the batch was interrupted, but its result was never written
+            return snapshot.values
+        if snapshot.next:
+            # interrupted midway: invoking with no input re-runs only the unfinished nodes
+            return await graph.ainvoke(None, config)
+    return await graph.ainvoke({"messages": [HumanMessage(content=item["question"])]}, config)
+
+
+async def prune(item: dict, batch_id: str, configurable: dict):
+    """Drops the checkpoints of a question whose result is stored, so they do not pile up."""
+    checkpointer = agent.get_graph().checkpointer
+    if checkpointer is not None:
+        await checkpointer.adelete_thread(thread_id(batch_id, item, configurable))
+
+
+async def run_question(item: dict, batch_id: str, configurable: dict, fresh: bool) -> dict:
+    """Runs one question on its `thread_id`; a failure is returned as an "error" result."""
+    config = {
+        "configurable": {**configurable, "thread_id": thread_id(batch_id, item, configurable)},
+        "recursion_limit": 100,
+    }
+    started = time.perf_counter()
+    try:
+        # the searches of a run that is cancelled or fails are cancelled with it
+        with forgetting_runs():
+            state = await _invoke(item, config, fresh)
+    except Exception as exc:
+        return {**item, "status": "error", "error": f"{type(exc).__name__}: {exc}",
+                "latency_s": time.perf_counter() - started}
+    return {
+        **item,
+        "status": "ok",
+        "answer": state["messages"][-1].content,
+        "sources": [source["value"] for source in state.get("cited_sources") or []],
+        "latency_s": time.perf_counter() - started,
+    }
+
+
+async def run_batch(
+        questions: Iterable[dict],
+        output: TextIO,
+        concurrency: int = 8,
+        configurable: Optional[dict] = None,
+        batch_id: str = "batch",
+        skip: frozenset = frozenset(),
+        fresh: bool = False,
+) -> AsyncIterator[dict]:
+    """
+    Runs `questions` with at most `concurrency` in flight, writing each result to
+    `output` as one JSON line when its run finishes, and yields it too.
+
+    Questions are pulled from the iterable only as slots free up, so a large
+    input file is never held in memory. Ids in `skip` are not run, and with
+    `fresh` the checkpoints of earlier runs of the same ids are discarded.
+    """
+    pending = (item for item in questions if item["id"] not in skip)
+    finished = asyncio.Queue()
+
+    async def worker():
+        for item in pending:
+            result = await run_question(item, batch_id, configurable or {}, fresh)
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            if result["status"] == "ok":
+                await prune(item, batch_id, configurable or {})
+            await finished.put(result)
+        await finished.put(None)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        running = len(workers)
+        while running:
+            result = await finished.get()
+            if result is None:
+                running -= 1
+            else:
+                yield result
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    """Aggregate throughput and latency percentiles of a batch."""
+    latencies = [result["latency_s"] for result in results if result["status"] == "ok"]
+    return {
+        "questions": len(results),
+        "ok": len(latencies),
+        "errors": len(results) - len(latencies),
+        "elapsed_s": elapsed,
+        "throughput_per_min": 60 * len(results) / elapsed if elapsed else 0.0,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "max_s": max(latencies, default=0.0),
+    }
+
+
+async def main(args):
+    # resuming needs checkpoints, which the graph does not keep unless asked, and the research
+    # texts they refer to, kept on disk beside the output
+    os.environ.setdefault("CHECKPOINTER", "sqlite")
+    os.environ.setdefault("BLOB_STORE", "disk")
+    os.environ.setdefault("BLOB_STORE_PATH", f"{args.output}.blobs")
+    if args.fake:
+        from clients import set_client_registry
+        from fake_providers import FakeClientRegistry, LatencyModel
+
+        set_client_registry(FakeClientRegistry(
+            llm_latency=LatencyModel(median=0.05, seed=args.seed),
+            search_latency=LatencyModel(median=0.2, seed=args.seed + 1),
+            seed=args.seed,
+        ))
+    skip = frozenset(answered_ids(args.output)) if not args.restart else frozenset()
+    if skip:
+        print(f"resuming: {len(skip)} questions already answered", file=sys.stderr)
+    results = []
+    started = time.perf_counter()
+    with open(args.input) as lines, open(args.output, "w" if args.restart else "a") as output:
+        async for result in run_batch(
+                read_questions(lines), output, args.concurrency, {}, args.batch_id, skip, args.restart,
+        ):
+            results.append(result)
+            print(f"{result['id']:>12} {result['status']:<5} {result['latency_s']:8.2f}s", file=sys.stderr)
+    report = summarize(results, time.perf_counter() - started)
+    print(json.dumps(report, indent=2), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input", help="JSONL file of questions")
+    parser.add_argument("--output", required=True, help="JSONL file the results are appended to")
+    parser.add_argument("--concurrency", type=int, default=8, help="questions in flight at once")
+    parser.add_argument("--batch-id", default="batch", help="prefix of the runs' checkpoint thread ids")
+    parser.add_argument("--restart", action="store_true", help="overwrite the output instead of resuming")
+    parser.add_argument("--fake", action="store_true", help="run on the offline fake providers")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,82 @@
+"""
+Benchmark of the generate_query and reflection model cascade on the offline fake LLMs.
+
+Runs `--runs` questions concurrently with every node on the large model, then
+with generate_query and reflection trying the small model first. The small
+model answers in a third of the time but returns output that does not validate
+(`--invalid`) or is unsure of itself (`--unsure`) some of the time, which is
+escalated to the large model. Reports the run and per-loop latency of both,
+and the escalation rate and latency saved per node:
+
+    python bench_cascade.py --runs 40 --large 1.2 --small 0.4 --invalid 0.05 --unsure 0.15
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from langchain_core.messages import HumanMessage
+
+from agent import get_graph
+from cascade import cascade_stats
+from clients import set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+from utils import percentile
+
+
+async def _run(question: str, configurable: dict) -> tuple:
+    config = {"configurable": {"thread_id": uuid.uuid4().hex, **configurable}, "recursion_limit": 100}
+    start = time.perf_counter()
+    state = await get_graph().ainvoke({"messages": [HumanMessage(content=question)]}, config)
+    return time.perf_counter() - start, state
+
+
+async def _pass(runs: int, configurable: dict, tag: str) -> list:
+    return await asyncio.gather(*(
+        _run(f"How did segment margins change in {tag} {i}?", configurable) for i in range(runs)
+    ))
+
+
+def _line(name: str, results: list) -> str:
+    latencies = [latency for latency, _ in results]
+    # a loop is a fan-out of searches and the reflection on them
+    loops = sum(len(state["metrics"]["reflection"]["loops"]) for _, state in results)
+    return (f"{name:<10} run p50={percentile(latencies, 50):6.2f}s p95={percentile(latencies, 95):6.2f}s "
+            f"per loop={sum(latencies) / loops:6.2f}s")
+
+
+async def main(args):
+    set_client_registry(FakeClientRegistry(
+        LatencyModel(median=args.large, sigma=0.3, seed=args.seed),
+        LatencyModel(median=args.search, sigma=0.3, seed=args.seed + 1),
+        seed=args.seed,
+        model_options={"fake-small": {
+            "latency": LatencyModel(median=args.small, sigma=0.3, seed=args.seed + 2),
+            "invalid_probability": args.invalid,
+            "low_confidence_probability": args.unsure,
+        }},
+    ))
+    configurable = {"query_generator_model": "fake-large", "reasoning_model": "fake-large", "search_cache_ttl": 0,
+                    "max_research_loops": args.loops}
+    baseline = await _pass(args.runs, configurable, "baseline")
+    cascade = {**configurable, "cascade_models": {"generate_query": "fake-small", "reflection": "fake-small"},
+               "cascade_min_confidence": args.min_confidence}
+    cascaded = await _pass(args.runs, cascade, "cascade")
+    print(_line("large only", baseline))
+    print(_line("cascade", cascaded))
+    print(json.dumps(cascade_stats(), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=40)
+    parser.add_argument("--loops", type=int, default=2, help="max_research_loops of every run")
+    parser.add_argument("--large", type=float, default=1.2, help="median latency of the large model, in seconds")
+    parser.add_argument("--small", type=float, default=0.4, help="median latency of the small model, in seconds")
+    parser.add_argument("--search", type=float, default=0.8, help="median latency of a search, in seconds")
+    parser.add_argument("--invalid", type=float, default=0.05, help="share of small-model outputs that do not validate")
+    parser.add_argument("--unsure", type=float, default=0.15, help="share of small-model outputs with low confidence")
+    parser.add_argument("--min-confidence", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,137 @@
+"""
+Benchmark of durable checkpointing on the offline fakes.
+
+Measures the checkpoint write cost per node and per run, and the time a failed
+run saves by resuming from its checkpoints instead of starting over. The
+failure is injected into the last search of the last research loop:
+
+    python bench_checkpoints.py --runs 20 --loops 3 --search-latency 0.5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+from langchain_core.messages import HumanMessage
+
+from agent import builder
+from checkpoints import SqliteCheckpointer
+from clients import set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+
+
+class TimedCheckpointer(SqliteCheckpointer):
+    """Attributes the time spent storing task writes to the node that made them."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.by_node = defaultdict(list)
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        start = time.perf_counter()
+        super().put_writes(config, writes, task_id, task_path)
+        # pull tasks end their path with the node name; the only Send target is web_research
+        node = task_path.rsplit(", ", 1)[-1] if "__pregel_pull" in task_path else "web_research"
+        self.by_node[node].append(time.perf_counter() - start)
+
+
+def _registry(args, fail_on_calls=()):
+    return FakeClientRegistry(
+        llm_latency=LatencyModel(median=args.llm_latency, seed=args.seed),
+        search_latency=LatencyModel(median=args.search_latency, seed=args.seed + 1),
+        seed=args.seed,
+        sufficient_probability=0.0,
+        fail_on_calls=fail_on_calls,
+    )
+
+
+def _inputs(i: int) -> dict:
+    return {"messages": [HumanMessage(content=f"How did segment {i} margins change last year?")]}
+
+
+def _config(args, thread_id: str) -> dict:
+    return {
+        "configurable": {
+            "thread_id": thread_id,
+            "max_research_loops": args.loops,
+            "number_of_initial_queries": args.fan_out,
+            "search_cache_ttl": 0,
+        },
+        "recursion_limit": 100,
+    }
+
+
+async def write_cost(args, path: str):
+    set_client_registry(_registry(args))
+    plain = builder.compile()
+    checkpointer = TimedCheckpointer(path)
+    durable = builder.compile(checkpointer=checkpointer)
+    timings = {"none": [], "sqlite": []}
+    for i in range(args.runs):
+        for name, graph in (("none", plain), ("sqlite", durable)):
+            start = time.perf_counter()
+            await graph.ainvoke(_inputs(i), _config(args, uuid.uuid4().hex))
+            timings[name].append(time.perf_counter() - start)
+
+    stats = checkpointer.stats()
+    print("# checkpoint write cost")
+    for node, samples in sorted(checkpointer.by_node.items()):
+        print(f"{node:>16}: writes={len(samples):>5} mean={statistics.fmean(samples) * 1e6:7.1f}us "
+              f"max={max(samples) * 1e6:7.1f}us")
+    print(f"{'checkpoints':>16}: puts={stats['puts']:>5} mean={stats['put_seconds'] / stats['puts'] * 1e6:7.1f}us")
+    per_run = (stats["put_seconds"] + stats["write_seconds"]) / args.runs
+    print(f"per run: {per_run * 1e3:.2f}ms storing {stats['bytes'] / args.runs / 1024:.1f}KiB; "
+          f"mean run latency none={statistics.fmean(timings['none']) * 1e3:.1f}ms "
+          f"sqlite={statistics.fmean(timings['sqlite']) * 1e3:.1f}ms")
+
+
+async def resume_savings(args, path: str):
+    # count the searches of a clean run, then fail the last one
+    registry = _registry(args)
+    set_client_registry(registry)
+    await builder.compile().ainvoke(_inputs(0), _config(args, "count"))
+    searches = registry.genai_client().calls
+
+    results = {}
+    for mode in ("restart", "resume"):
+        registry = _registry(args, fail_on_calls=[searches])
+        set_client_registry(registry)
+        graph = builder.compile(checkpointer=SqliteCheckpointer(path))
+        config = _config(args, uuid.uuid4().hex)
+        try:
+            await graph.ainvoke(_inputs(0), config)
+        except RuntimeError:
+            pass
+        before = registry.genai_client().calls
+        start = time.perf_counter()
+        if mode == "resume":
+            await graph.ainvoke(None, config)
+        else:
+            await graph.ainvoke(_inputs(0), _config(args, uuid.uuid4().hex))
+        results[mode] = (time.perf_counter() - start, registry.genai_client().calls - before)
+
+    print("# recovery after a failed last search")
+    for mode, (elapsed, repeated) in results.items():
+        print(f"{mode:>8}: {elapsed * 1e3:8.1f}ms, {repeated} searches run again (of {searches})")
+    print(f"time saved by resuming: {(results['restart'][0] - results['resume'][0]) * 1e3:.1f}ms")
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        await write_cost(args, os.path.join(directory, "cost.sqlite"))
+        await resume_savings(args, os.path.join(directory, "resume.sqlite"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--loops", type=int, default=3)
+    parser.add_argument("--fan-out", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
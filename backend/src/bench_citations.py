@@ -0,0 +1,126 @@
+"""
+Micro-benchmark of citation extraction and insertion on large grounded responses.
+
+Builds synthetic ~100 KB Gemini responses with thousands of grounding supports
+and times `get_citations` + `insert_citation_markers` against the previous
+per-citation string rebuilding:
+
+    python bench_citations.py --size 100000 --supports 1000 5000
+"""
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from utils import get_citations, insert_citation_markers, resolve_urls
+
+
+def synthetic_response(size: int, supports: int, chunks: int = 50, non_ascii: bool = False, seed: int = 0):
+    """A Gemini-shaped response whose segments are UTF-8 byte offsets, as the API reports them."""
+    rng = random.Random(seed)
+    words = ["growth", "revenue", "stock", "iphone", "fiscal", "report", "quarter"]
+    if non_ascii:
+        words += ["prévision", "größe", "año"]
+    parts, length = [], 0
+    while length < size:
+        word = rng.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    text = " ".join(parts)[:size]
+
+    byte_length = len(text.encode("utf-8"))
+    grounding_chunks = [
+        SimpleNamespace(web=SimpleNamespace(uri=f"https://vertexaisearch.cloud.google.com/grounding-api-redirect/{i}",
+                                            title=f"site{i}.com"))
+        for i in range(chunks)
+    ]
+    grounding_supports = []
+    for _ in range(supports):
+        end = rng.randint(1, byte_length)
+        grounding_supports.append(SimpleNamespace(
+            segment=SimpleNamespace(start_index=rng.randint(0, end - 1), end_index=end),
+            grounding_chunk_indices=rng.sample(range(chunks), rng.randint(1, 3)),
+        ))
+    metadata = SimpleNamespace(grounding_chunks=grounding_chunks, grounding_supports=grounding_supports)
+    return SimpleNamespace(text=text, candidates=[SimpleNamespace(grounding_metadata=metadata)])
+
+
+def legacy_insert_citation_markers(text, citations_list):
+    """The previous implementation: one full string rebuild per citation."""
+    sorted_citations = sorted(
+        citations_list, key=lambda c: (c["end_index"], c["start_index"]), reverse=True
+    )
+    modified_text = text
+    for citation_info in sorted_citations:
+        end_idx = citation_info["end_index"]
+        marker_to_insert = ""
+        for segment in citation_info["segments"]:
+            marker_to_insert += f" [{segment['label']}]({segment['short_url']})"
+        modified_text = modified_text[:end_idx] + marker_to_insert + modified_text[end_idx:]
+    return modified_text
+
+
+def legacy_get_citations(response, resolved_urls_map):
+    """The previous implementation: chunk lookups and title parsing per support."""
+    citations = []
+    candidate = response.candidates[0]
+    for support in candidate.grounding_metadata.grounding_supports:
+        if support.segment is None or support.segment.end_index is None:
+            continue
+        citation = {
+            "start_index": support.segment.start_index or 0,
+            "end_index": support.segment.end_index,
+            "segments": [],
+        }
+        for ind in support.grounding_chunk_indices or []:
+            try:
+                chunk = candidate.grounding_metadata.grounding_chunks[ind]
+                citation["segments"].append({
+                    "label": chunk.web.title.split(".")[:-1][0],
+                    "short_url": resolved_urls_map.get(chunk.web.uri, None),
+                    "value": chunk.web.uri,
+                })
+            except (IndexError, AttributeError, NameError):
+                pass
+        citations.append(citation)
+    return citations
+
+
+def _best_of(repeat: int, func) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(size: int, supports: int, repeat: int, non_ascii: bool):
+    response = synthetic_response(size, supports, non_ascii=non_ascii)
+    resolved = resolve_urls(response.candidates[0].grounding_metadata.grounding_chunks, 0)
+
+    def legacy():
+        legacy_insert_citation_markers(response.text, legacy_get_citations(response, resolved))
+
+    def single_pass():
+        insert_citation_markers(response.text, get_citations(response, resolved))
+
+    legacy_time = _best_of(repeat, legacy)
+    new_time = _best_of(repeat, single_pass)
+    label = "non-ascii" if non_ascii else "ascii"
+    print(
+        f"{label:<9} text={len(response.text):>7} supports={supports:>6} "
+        f"legacy={legacy_time * 1e3:9.2f}ms single_pass={new_time * 1e3:8.2f}ms "
+        f"speedup={legacy_time / new_time:6.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--supports", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for non_ascii in (False, True):
+        for supports in args.supports:
+            run(args.size, supports, args.repeat, non_ascii)
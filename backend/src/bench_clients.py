@@ -0,0 +1,86 @@
+"""
+Benchmark of per-call client construction against the shared client registry.
+
+Runs against a local stub server, so it needs no network or API keys:
+
+    python bench_clients.py --calls 200
+"""
+import argparse
+import statistics
+import time
+
+from google.genai import Client
+from langchain_openai import ChatOpenAI
+
+from clients import ClientRegistry
+from stub_server import run_stub_server
+
+
+def _summary(name: str, timings: list, server, stats: dict = None) -> str:
+    line = (
+        f"{name:<28} mean={statistics.mean(timings) * 1e3:7.3f}ms "
+        f"p50={statistics.median(timings) * 1e3:7.3f}ms "
+        f"server_connections={len(server.connections)}"
+    )
+    if stats:
+        line += f" opened={stats['connections_opened']} reused={stats['connections_reused']}"
+    return line
+
+
+def _time_calls(calls: int, call) -> list:
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_openai(calls: int):
+    with run_stub_server() as (url, server):
+        def per_call():
+            # what the nodes did before the registry: a new client for every call
+            llm = ChatOpenAI(model="stub", temperature=1.0, max_retries=2,
+                             api_key="API_KEY", base_url=f"{url}/v1")
+            llm.invoke("hello")
+
+        print(_summary("openai per-call client", _time_calls(calls, per_call), server))
+
+    with run_stub_server() as (url, server):
+        registry = ClientRegistry()
+
+        def pooled():
+            registry.chat_model("stub", api_key="API_KEY", base_url=f"{url}/v1").invoke("hello")
+
+        timings = _time_calls(calls, pooled)
+        print(_summary("openai registry client", timings, server, registry.stats()["openai"]))
+        registry.close()
+
+
+def bench_gemini(calls: int):
+    request = {"model": "stub", "contents": "hello", "config": {"temperature": 0}}
+
+    with run_stub_server() as (url, server):
+        def per_call():
+            client = Client(api_key="API_KEY", http_options={"base_url": url})
+            client.models.generate_content(**request)
+
+        print(_summary("gemini per-call client", _time_calls(calls, per_call), server))
+
+    with run_stub_server() as (url, server):
+        registry = ClientRegistry()
+
+        def pooled():
+            registry.genai_client(api_key="API_KEY", base_url=url).models.generate_content(**request)
+
+        timings = _time_calls(calls, pooled)
+        print(_summary("gemini registry client", timings, server, registry.stats()["gemini"]))
+        registry.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+    bench_openai(args.calls)
+    bench_gemini(args.calls)
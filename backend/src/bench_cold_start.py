@@ -0,0 +1,92 @@
+"""
+Import-time and cold-start benchmark of the research agent.
+
+Each measurement runs in a fresh interpreter. The import of `agent` is broken
+down per module the way `python -X importtime` reports it, and the cold start
+is split into importing, compiling the graph and the first and second runs on
+the offline fakes:
+
+    python bench_cold_start.py --top 15
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# the imports a cold start should not pay for until a provider is first called
+PROVIDER_MODULES = ("google.genai", "langchain_openai", "openai", "httpx")
+
+_COLD_START = """
+import json, sys, time, uuid
+started = time.perf_counter()
+import agent
+imported = time.perf_counter()
+graph = agent.get_graph()
+compiled = time.perf_counter()
+from langchain_core.messages import HumanMessage
+from clients import set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+set_client_registry(FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0)))
+runs = []
+for _ in range(2):
+    start = time.perf_counter()
+    graph.invoke({"messages": [HumanMessage(content="How did margins change?")]},
+                 {"configurable": {"thread_id": uuid.uuid4().hex, "search_cache_ttl": 0}})
+    runs.append(time.perf_counter() - start)
+json.dump({"import_s": imported - started, "compile_s": compiled - imported,
+           "first_run_s": runs[0], "second_run_s": runs[1]}, sys.stdout)
+"""
+
+
+def _python(code: str, *flags: str) -> subprocess.CompletedProcess:
+    env = {**os.environ, "CHECKPOINTER": "none", "BLOB_STORE": "memory"}
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code], cwd=here, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def import_breakdown(module: str = "agent") -> dict:
+    """
+    Imports `module` in a fresh interpreter under `-X importtime`. Returns the total
+    seconds, the (module, self seconds, cumulative seconds) of every import, and
+    the provider SDKs that got loaded.
+    """
+    stderr = _python(f"import {module}", "-X", "importtime").stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+    names = {name for name, _, _ in modules}
+    return {
+        "total_s": next((cumulative for name, _, cumulative in modules if name == module), 0.0),
+        "modules": modules,
+        "providers_loaded": [provider for provider in PROVIDER_MODULES if provider in names],
+    }
+
+
+def cold_start() -> dict:
+    """Seconds to import `agent`, compile the graph, and run it twice on the fakes, in a fresh interpreter."""
+    return json.loads(_python(_COLD_START).stdout)
+
+
+def main(args):
+    breakdown = import_breakdown(args.module)
+    print(f"import {args.module}: {breakdown['total_s'] * 1e3:.1f}ms, "
+          f"provider SDKs loaded: {', '.join(breakdown['providers_loaded']) or 'none'}")
+    print(f"{'module':<48} {'self ms':>9} {'cumulative ms':>14}")
+    for name, own, cumulative in sorted(breakdown["modules"], key=lambda m: -m[2])[:args.top]:
+        print(f"{name:<48} {own * 1e3:>9.1f} {cumulative * 1e3:>14.1f}")
+    print("# cold start")
+    for phase, seconds in cold_start().items():
+        print(f"{phase:<14} {seconds * 1e3:9.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default="agent")
+    parser.add_argument("--top", type=int, default=15, help="the slowest imports to list")
+    main(parser.parse_args())
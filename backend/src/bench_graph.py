@@ -0,0 +1,151 @@
+"""
+Offline end-to-end benchmark of the compiled research graph.
+
+Installs the deterministic fakes of `fake_providers` in place of the OpenAI and
+Gemini clients, then runs `agent.graph` at several concurrency levels and fan-out
+widths, reporting throughput, p50/p95/p99 run latency and the memory peak. No
+network access or API keys are needed:
+
+    python bench_graph.py --concurrency 1 8 32 128 --fan-out 1 3 5 10
+    python bench_graph.py --llm-latency 0.2 --search-latency 0.8 --tail 0.02 --json results.json
+    python bench_graph.py --tail 0.05 --quorum 0.8 --deadline 1.0
+    python bench_graph.py --tail 0.05 --hedge 95 --hedge-budget 0.1
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import tracemalloc
+import uuid
+
+from langchain_core.messages import HumanMessage
+
+from agent import graph
+from clients import set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+from hedging import hedge_stats
+from utils import percentile
+
+
+def _question(i: int) -> str:
+    return f"How did segment {i} revenue and margins change over the last fiscal year?"
+
+
+async def _run_once(i: int, fan_out: int, configurable: dict) -> tuple:
+    start = time.perf_counter()
+    state = await graph.ainvoke(
+        {
+            "messages": [HumanMessage(content=_question(i))],
+            "initial_search_query_count": fan_out,
+        },
+        {"configurable": {**configurable, "thread_id": uuid.uuid4().hex}, "recursion_limit": 100},
+    )
+    return time.perf_counter() - start, len(state.get("web_research_result") or [])
+
+
+async def run_level(runs: int, concurrency: int, fan_out: int, configurable: dict, trace_memory: bool = True) -> dict:
+    """
+    Runs `runs` questions with at most `concurrency` in flight.
+
+    tracemalloc slows Python code down noticeably, so pass `trace_memory=False`
+    when comparing timings against a run that did not trace memory.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(i):
+        async with semaphore:
+            return await _run_once(i, fan_out, configurable)
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(bounded(i) for i in range(runs)))
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies = [latency for latency, _ in results]
+    return {
+        "concurrency": concurrency,
+        "fan_out": fan_out,
+        "runs": runs,
+        "searches": sum(searches for _, searches in results),
+        "throughput_runs_per_s": runs / elapsed,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "mean_s": statistics.fmean(latencies),
+        "peak_memory_mb": peak / 2 ** 20,
+    }
+
+
+def _print(result: dict):
+    print(
+        f"concurrency={result['concurrency']:>4} fan_out={result['fan_out']:>3} runs={result['runs']:>4} "
+        f"searches={result['searches']:>5} throughput={result['throughput_runs_per_s']:7.2f} runs/s "
+        f"p50={result['p50_s'] * 1e3:7.1f}ms p95={result['p95_s'] * 1e3:7.1f}ms "
+        f"p99={result['p99_s'] * 1e3:7.1f}ms peak_mem={result['peak_memory_mb']:7.1f}MB"
+    )
+
+
+async def main(args):
+    set_client_registry(FakeClientRegistry(
+        llm_latency=LatencyModel(median=args.llm_latency, tail_probability=args.tail, seed=args.seed),
+        search_latency=LatencyModel(median=args.search_latency, tail_probability=args.tail, seed=args.seed + 1),
+        seed=args.seed,
+        sufficient_probability=args.sufficient,
+    ))
+    configurable = {
+        "max_research_loops": args.loops,
+        # every run must reach the fakes, not the cache
+        "search_cache_ttl": 0,
+        "fan_in_quorum": args.quorum,
+        "fan_in_deadline": args.deadline,
+        "late_searches": args.late,
+        "hedge_percentile": args.hedge,
+        "hedge_budget": args.hedge_budget,
+    }
+    results = []
+    print("# concurrency scaling")
+    for concurrency in args.concurrency:
+        result = await run_level(
+            max(args.runs, concurrency), concurrency, args.fan_out[0], configurable, not args.no_memory
+        )
+        results.append(result)
+        _print(result)
+    print("# fan-out scaling")
+    for fan_out in args.fan_out:
+        result = await run_level(args.runs, args.concurrency[0], fan_out, configurable, not args.no_memory)
+        results.append(result)
+        _print(result)
+    if args.hedge:
+        print("# hedging")
+        for node, stats in hedge_stats().items():
+            print(f"{node:>16}: " + " ".join(f"{key}={value}" for key, value in stats.items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--fan-out", type=int, nargs="+", default=[3, 1, 5, 10])
+    parser.add_argument("--runs", type=int, default=32, help="runs per level")
+    parser.add_argument("--loops", type=int, default=2, help="max research loops")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="median LLM latency in seconds")
+    parser.add_argument("--search-latency", type=float, default=0.2, help="median search latency in seconds")
+    parser.add_argument("--tail", type=float, default=0.0, help="probability of a 10x slow response")
+    parser.add_argument("--sufficient", type=float, default=0.3, help="probability reflection is satisfied")
+    parser.add_argument("--quorum", type=float, default=1.0, help="fan-in quorum of each research loop")
+    parser.add_argument("--deadline", type=float, default=0.0, help="fan-in deadline of each research loop")
+    parser.add_argument("--late", default="fold", choices=["fold", "cancel"], help="what to do with late searches")
+    parser.add_argument("--hedge", type=float, default=0.0, help="hedge calls slower than this percentile")
+    parser.add_argument("--hedge-budget", type=float, default=0.05, help="fraction of calls that may be hedged")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc for undisturbed timings")
+    parser.add_argument("--json", help="also write the results to this file")
+    asyncio.run(main(parser.parse_args()))
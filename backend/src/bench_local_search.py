@@ -0,0 +1,108 @@
+"""
+Benchmark of the local BM25 search backend on a synthetic corpus.
+
+Indexes `--documents` generated documents in `--batches` incremental adds,
+reports the indexing rate and the index size, then the query latency with one
+segment per add and after merging them. Finally runs the graph once on the
+offline fake LLMs with `search_backend="local"` to show the sources it cites:
+
+    python bench_local_search.py --documents 100000 --batches 10 --queries 500
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from langchain_core.messages import HumanMessage
+
+from agent import get_graph
+from clients import set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+from local_index import LocalIndex
+from utils import percentile
+
+TOPICS = ("revenue", "margins", "segment", "pricing", "churn", "inventory", "guidance", "capex",
+          "headcount", "supply", "demand", "forecast", "retention", "latency", "outage", "roadmap")
+
+
+def _vocabulary(size: int, rng: random.Random) -> list:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = ["".join(rng.choices(letters, k=rng.randint(4, 9))) for _ in range(size)]
+    # topic words at ranks 100, 200, ... so each occurs in a few percent of the documents
+    for i, topic in enumerate(TOPICS):
+        words.insert(100 * (i + 1), topic)
+    return words
+
+
+def corpus(documents: int, seed: int):
+    """Documents of Zipf-distributed words, a few sentences each."""
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(20_000, rng)
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    for i in range(documents):
+        words = rng.choices(vocabulary, weights, k=rng.randint(60, 240))
+        sentences = [" ".join(words[j:j + 15]).capitalize() + "." for j in range(0, len(words), 15)]
+        yield {"url": f"https://wiki.internal/doc/{i}", "title": f"Report {i}", "text": " ".join(sentences)}
+
+
+def _size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def _query_latencies(index: LocalIndex, queries: list) -> list:
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, 5)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _line(name: str, values: list) -> str:
+    return (f"{name:<22} p50={percentile(values, 50) * 1e3:7.3f}ms p95={percentile(values, 95) * 1e3:7.3f}ms "
+            f"max={max(values) * 1e3:7.3f}ms")
+
+
+def main(args):
+    path = args.index or tempfile.mkdtemp(prefix="local_index_")
+    index = LocalIndex(path, max_segments=args.batches + 1)
+    documents = list(corpus(args.documents, args.seed))
+    per_batch = -(-len(documents) // args.batches)
+    start = time.perf_counter()
+    for i in range(0, len(documents), per_batch):
+        index.add(documents[i:i + per_batch])
+    elapsed = time.perf_counter() - start
+    print(f"indexed {len(index)} documents in {elapsed:.2f}s ({len(index) / elapsed:,.0f} docs/s), "
+          f"{_size(path) / 1e6:.1f}MB, {index.stats()['segments']} segments, {index.stats()['terms']:,} postings lists")
+
+    rng = random.Random(args.seed + 1)
+    vocabulary = _vocabulary(20_000, random.Random(args.seed))
+    queries = [
+        " ".join(rng.sample(TOPICS, rng.randint(1, 2)) + rng.sample(vocabulary[50:5000], rng.randint(1, 2)))
+        for _ in range(args.queries)
+    ]
+    print(_line("query, per-add segments", _query_latencies(index, queries)))
+    start = time.perf_counter()
+    index.merge()
+    print(f"merged in {time.perf_counter() - start:.2f}s")
+    print(_line("query, merged", _query_latencies(index, queries)))
+
+    set_client_registry(FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0)))
+    configurable = {"thread_id": uuid.uuid4().hex, "search_backend": "local", "search_index_path": path}
+    start = time.perf_counter()
+    state = get_graph().invoke({"messages": [HumanMessage(content="How did segment margins and pricing change?")]},
+                               {"configurable": configurable, "recursion_limit": 100})
+    print(f"graph run on the local backend: {(time.perf_counter() - start) * 1e3:.1f}ms, "
+          f"{len(state['sources_gathered'])} sources, e.g. {state['sources_gathered'][:1]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=20_000)
+    parser.add_argument("--batches", type=int, default=10, help="incremental adds, one segment each")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--index", default="", help="index directory (default: a new temporary one)")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+"""
+Benchmark of fetching the pages behind search results, against the local stub web server.
+
+Fetches `--pages` pages through their redirect links one at a time and then
+all at once through the pooled fetcher, reports the latency of a cached and of
+a revalidated fetch, and how a page larger than the size cap is cut short.
+Finally runs the graph with and without `fetch_pages` on the offline fake LLMs:
+
+    python bench_page_fetch.py --pages 20 --latency 0.1 --per-host 4
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from langchain_core.messages import HumanMessage
+
+from agent import get_graph
+from clients import set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+from page_fetch import PageFetcher
+from stub_server import PageHandler, run_stub_server
+
+QUERY = "segment margins and pricing guidance"
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def _run_graph(configurable: dict) -> tuple:
+    config = {"configurable": {"thread_id": uuid.uuid4().hex, **configurable}, "recursion_limit": 100}
+    inputs = {"messages": [HumanMessage(content="How did segment margins and pricing change?")]}
+    return _timed(lambda: asyncio.run(get_graph().ainvoke(inputs, config)))
+
+
+def main(args):
+    with run_stub_server(PageHandler, latency=args.latency) as (url, server):
+        urls = [f"{url}/redirect/page-{i}" for i in range(args.pages)]
+        serial = PageFetcher(per_host=1, timeout=args.timeout, allow_private=True)
+        _, elapsed = _timed(lambda: [serial.fetch([page], QUERY) for page in urls])
+        print(f"{args.pages} pages one at a time:        {elapsed * 1e3:8.1f}ms")
+        serial.close()
+
+        fetcher = PageFetcher(per_host=args.per_host, timeout=args.timeout, max_bytes=args.max_bytes,
+                              allow_private=True)
+        server.max_active_pages = 0
+        result, elapsed = _timed(lambda: fetcher.fetch(urls, QUERY))
+        chunks = sum(page["chunks"] for page in result["pages"])
+        print(f"{args.pages} pages, {args.per_host} per host:          {elapsed * 1e3:8.1f}ms "
+              f"({server.max_active_pages} concurrent at most, {chunks} chunks)")
+        best = result["excerpts"][0]
+        print(f"  best excerpt ({best['score']:.2f}): {best['text'][:100]}...")
+        _, elapsed = _timed(lambda: fetcher.fetch(urls, QUERY))
+        print(f"{args.pages} pages from the cache:         {elapsed * 1e3:8.1f}ms")
+        fetcher.ttl = 0
+        not_modified = server.not_modified
+        _, elapsed = _timed(lambda: fetcher.fetch(urls, QUERY))
+        print(f"{args.pages} pages revalidated:            {elapsed * 1e3:8.1f}ms "
+              f"({server.not_modified - not_modified} answered 304)")
+        server.page_bytes = 20 * args.max_bytes
+        result, elapsed = _timed(lambda: fetcher.fetch([f"{url}/large/big"], QUERY))
+        print(f"a {server.page_bytes / 1e6:.0f}MB page, capped at {args.max_bytes / 1e6:.1f}MB: "
+              f"{elapsed * 1e3:8.1f}ms, {result['pages'][0]['status']}")
+        print(fetcher.stats())
+        fetcher.close()
+
+        set_client_registry(FakeClientRegistry(
+            LatencyModel("constant", 0.0), LatencyModel("constant", args.latency), page_base_url=url,
+        ))
+        common = {"search_cache_ttl": 0, "fetch_timeout": args.timeout, "fetch_per_host": args.per_host,
+                  "fetch_private_hosts": True}
+        _, without = _run_graph(common)
+        state, with_pages = _run_graph({**common, "fetch_pages": True})
+        fetched = [page for page in state["fetched_pages"] if page["status"] in ("fetched", "truncated")]
+        print(f"graph run: {without * 1e3:.1f}ms without fetch_pages, {with_pages * 1e3:.1f}ms with "
+              f"({len(fetched)}/{len(state['fetched_pages'])} pages fetched)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds the stub takes per response")
+    parser.add_argument("--per-host", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--max-bytes", type=int, default=500_000)
+    main(parser.parse_args())
@@ -0,0 +1,96 @@
+"""
+Benchmark of the shared rate limiter against a rate-limited stub provider.
+
+Simulated sessions each fan out web_research searches and then stream a
+final answer, all through real clients against a local stub server that
+answers 429s past its limit. Runs the sessions once with only per-call
+retries and once through the shared limiter, and compares 429s, failed calls,
+session times and the limiter's queue waits:
+
+    python bench_rate_limit.py --sessions 20 --fan-out 5 --server-rpm 120
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import rate_limit
+from clients import ClientRegistry
+from stub_server import RateLimitedHandler, run_stub_server
+
+MODEL = "stub-model"
+
+
+async def session(registry: ClientRegistry, url: str, limiter, args) -> tuple:
+    genai = registry.genai_client(api_key="stub", base_url=url)
+    llm = registry.chat_model(MODEL, api_key="stub", base_url=url, max_retries=0)
+    started = time.perf_counter()
+    failed = 0
+
+    async def search(idx: int):
+        return await rate_limit.acall(
+            limiter, lambda: genai.aio.models.generate_content(model=MODEL, contents=f"query {idx}"),
+            "web_research", 100, args.retries,
+        )
+
+    for outcome in await asyncio.gather(*(search(i) for i in range(args.fan_out)), return_exceptions=True):
+        failed += isinstance(outcome, Exception)
+    try:
+        await rate_limit.acall(limiter, lambda: llm.ainvoke("answer"), "finalize_answer", 100, args.retries)
+    except Exception:
+        failed += 1
+    return time.perf_counter() - started, failed
+
+
+async def run(args, url: str, limiter) -> tuple:
+    registry = ClientRegistry()
+
+    async def staggered(idx: int):
+        # sessions arrive over time, so later searches compete with earlier answers
+        await asyncio.sleep(idx * args.arrival)
+        return await session(registry, url, limiter, args)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(staggered(i) for i in range(args.sessions)))
+    elapsed = time.perf_counter() - started
+    await registry.aclose()
+    return results, elapsed
+
+
+def _report(name: str, results: list, elapsed: float, server, limiter=None):
+    times = sorted(t for t, _ in results)
+    print(
+        f"{name:<10} total={elapsed:6.2f}s 429s={server.rate_limited:4d} "
+        f"failed_calls={sum(f for _, f in results):3d} "
+        f"session p50={statistics.median(times):6.2f}s p95={times[int(0.95 * (len(times) - 1))]:6.2f}s "
+        f"max={times[-1]:6.2f}s"
+    )
+    if limiter is not None:
+        for node, wait in limiter.stats()["queue_wait"].items():
+            print(f"{'':<10} queue wait {node:<16} mean={wait['mean'] * 1e3:8.1f}ms "
+                  f"p95={wait['p95'] * 1e3:8.1f}ms max={wait['max'] * 1e3:8.1f}ms")
+
+
+async def main(args):
+    window = args.window
+    server_limit = max(1, int(args.server_rpm * window / 60))
+    for name, use_limiter in (("retries", False), ("limiter", True)):
+        with run_stub_server(RateLimitedHandler, args.latency, server_limit, window) as (url, server):
+            limiter = None
+            if use_limiter:
+                # a little under the provider's limit, leaving headroom for clock skew
+                limiter = rate_limit.RateLimiter(name, requests_per_minute=args.server_rpm * 0.9)
+            results, elapsed = await run(args, url, limiter)
+            _report(name, results, elapsed, server, limiter)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--fan-out", type=int, default=5)
+    parser.add_argument("--arrival", type=float, default=0.05, help="seconds between session starts")
+    parser.add_argument("--server-rpm", type=float, default=120, help="requests per minute the stub allows")
+    parser.add_argument("--window", type=float, default=5.0, help="the stub's rate-limit window in seconds")
+    parser.add_argument("--latency", type=float, default=0.02, help="stub response latency in seconds")
+    parser.add_argument("--retries", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,145 @@
+"""
+Load test of the SSE service on the offline fake providers.
+
+Serves `app.create_app` with uvicorn on a free localhost port, then opens
+`--clients` concurrent streams spread over `--client-ids` client ids. A
+fraction of the clients hang up after the first node event, to exercise
+cancellation. Reports admissions and refusals, time to start, time to first
+token and run latency, and checks that no run outlives its stream:
+
+    python bench_server.py --clients 200 --max-running 32 --max-queued 64 --per-client 8
+    python bench_server.py --clients 40 --cancel 0.25 --drain
+"""
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import httpx
+import uvicorn
+
+from app import create_app
+from clients import set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+from utils import percentile
+
+
+async def _client(http: httpx.AsyncClient, url: str, i: int, args, hang_up: bool) -> dict:
+    result = {"status": None, "events": {}, "started_s": None, "first_token_s": None, "total_s": None}
+    started = time.perf_counter()
+    body = {"question": f"How did segment {i} margins change last year?", "config": {"search_cache_ttl": 0}}
+    headers = {"X-Client-Id": f"client-{i % args.client_ids}"}
+    async with http.stream("POST", f"{url}/runs/stream", json=body, headers=headers) as response:
+        result["status"] = response.status_code
+        if response.status_code != 200:
+            return result
+        try:
+            await _read_events(response, result, started, hang_up)
+        except httpx.RemoteProtocolError:
+            # the server closed the stream, e.g. at the end of its shutdown grace period
+            result["events"]["cut_off"] = 1
+    return result
+
+
+async def _read_events(response, result: dict, started: float, hang_up: bool):
+    async for line in response.aiter_lines():
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+            result["events"][event] = result["events"].get(event, 0) + 1
+            elapsed = time.perf_counter() - started
+            if event == "started":
+                result["started_s"] = elapsed
+            elif event == "token" and result["first_token_s"] is None:
+                result["first_token_s"] = elapsed
+            elif event == "node" and hang_up:
+                return
+            elif event in ("done", "error", "cancelled"):
+                result["total_s"] = elapsed
+
+
+def _serve(app, drain_timeout: float) -> tuple:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", timeout_graceful_shutdown=drain_timeout))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{sock.getsockname()[1]}", server, thread
+
+
+def _line(name: str, values: list) -> str:
+    if not values:
+        return f"{name:<14} -"
+    return (f"{name:<14} p50={percentile(values, 50) * 1e3:8.1f}ms p95={percentile(values, 95) * 1e3:8.1f}ms "
+            f"max={max(values) * 1e3:8.1f}ms")
+
+
+async def main(args):
+    set_client_registry(FakeClientRegistry(
+        llm_latency=LatencyModel(median=args.llm_latency, seed=args.seed),
+        search_latency=LatencyModel(median=args.search_latency, seed=args.seed + 1),
+        seed=args.seed,
+    ))
+    app = create_app(args.max_running, args.max_queued, args.per_client, drain_timeout=args.drain_timeout)
+    url, server, thread = _serve(app, args.drain_timeout)
+    limits = httpx.Limits(max_connections=args.clients + 10)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as http:
+        started = time.perf_counter()
+        calls = [
+            _client(http, url, i, args, hang_up=i < args.cancel * args.clients)
+            for i in range(args.clients)
+        ]
+        if args.drain:
+            # shut the server down while the runs are still going
+            async def stop():
+                await asyncio.sleep(args.search_latency)
+                server.should_exit = True
+            calls.append(stop())
+        results = [result for result in await asyncio.gather(*calls) if result]
+        elapsed = time.perf_counter() - started
+        stats = None
+        if not args.drain:
+            # cancellation is asynchronous; give hung-up streams a moment to unwind
+            await asyncio.sleep(0.2)
+            stats = (await http.get(f"{url}/stats")).json()
+    server.should_exit = True
+    thread.join()
+
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+    events = {}
+    for result in results:
+        for event, count in result["events"].items():
+            events[event] = events.get(event, 0) + count
+    completed = [result for result in results if result["events"].get("done")]
+    print(f"clients={len(results)} elapsed={elapsed:.2f}s completed={len(completed)} "
+          f"throughput={len(completed) / elapsed:.1f} runs/s")
+    print("status codes:", json.dumps(statuses))
+    print("final events:", json.dumps({key: events.get(key, 0) for key in ("done", "cancelled", "error", "cut_off")}))
+    print(_line("time to start", [r["started_s"] for r in completed]))
+    print(_line("first token", [r["first_token_s"] for r in completed if r["first_token_s"]]))
+    print(_line("run latency", [r["total_s"] for r in completed]))
+    if stats is not None:
+        print("server:", json.dumps(stats))
+        if stats["runs"] or stats["admission"]["running"] or stats["admission"]["queued"]:
+            print("WARNING: runs still in flight after every stream closed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--client-ids", type=int, default=10, help="distinct X-Client-Id values")
+    parser.add_argument("--max-running", type=int, default=32)
+    parser.add_argument("--max-queued", type=int, default=64)
+    parser.add_argument("--per-client", type=int, default=8)
+    parser.add_argument("--cancel", type=float, default=0.1, help="fraction of clients hanging up early")
+    parser.add_argument("--drain", action="store_true", help="shut the server down mid-load")
+    parser.add_argument("--drain-timeout", type=float, default=30.0)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,72 @@
+"""
+Benchmark of short-url expansion in finalize_answer.
+
+Compares the previous per-source `in` + `str.replace` loop against the single
+scan of `expand_short_urls` for answers citing a share of many gathered sources:
+
+    python bench_short_urls.py --sources 1000 5000 20000
+"""
+import argparse
+import random
+import time
+
+from utils import SHORT_URL_PREFIX, expand_short_urls
+
+
+def synthetic_answer(sources: int, cited: int, words: int = 20_000, seed: int = 0):
+    rng = random.Random(seed)
+    # sources_gathered repeats a chunk once per support citing it
+    gathered = []
+    for i in range(sources):
+        source = {
+            "label": f"site{i}",
+            "short_url": f"{SHORT_URL_PREFIX}{i // 10}-{i % 10}",
+            "value": f"https://vertexaisearch.cloud.google.com/grounding-api-redirect/{i:08d}",
+        }
+        gathered.extend([source] * rng.randint(1, 3))
+    cited_urls = [source["short_url"] for source in rng.sample(gathered, cited)]
+    parts = []
+    for _ in range(words):
+        parts.append(rng.choice(["growth", "revenue", "stock", "iphone", "fiscal"]))
+        if rng.random() < 0.02:
+            parts.append(f"[site]({rng.choice(cited_urls)})")
+    return " ".join(parts), gathered
+
+
+def legacy_expand(content, sources_gathered):
+    """The previous implementation: one `in` check and `replace` per source."""
+    unique_sources = []
+    for source in sources_gathered:
+        if source["short_url"] in content:
+            content = content.replace(source["short_url"], source["value"])
+            unique_sources.append(source)
+    return content, unique_sources
+
+
+def _best_of(repeat: int, func) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(sources: int, repeat: int):
+    answer, gathered = synthetic_answer(sources, cited=min(200, sources))
+    legacy_time = _best_of(repeat, lambda: legacy_expand(answer, gathered))
+    new_time = _best_of(repeat, lambda: expand_short_urls(answer, gathered))
+    print(
+        f"sources={sources:>6} gathered={len(gathered):>6} answer={len(answer):>7} "
+        f"legacy={legacy_time * 1e3:8.2f}ms single_scan={new_time * 1e3:7.2f}ms "
+        f"speedup={legacy_time / new_time:6.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sources", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for sources in args.sources:
+        run(sources, args.repeat)
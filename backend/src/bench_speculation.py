@@ -0,0 +1,83 @@
+"""
+Benchmark of speculative follow-up searches on the offline fake providers.
+
+Runs `--runs` questions concurrently without speculation, then with
+`speculate_follow_ups`, where each finished branch has a small model guess the
+follow-ups reflection will ask from its result alone and starts their searches.
+`--predictable` of reflection's follow-ups are gaps a single result points to,
+which the guesses can match. Reports the run and per-loop latency of both, the
+searches each made, and the hit rate and latency saved:
+
+    python bench_speculation.py --runs 20 --llm 1.2 --small 0.3 --search 0.8 --predictable 0.6
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from langchain_core.messages import HumanMessage
+
+from agent import get_graph
+from clients import get_client_registry, set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+from speculation import speculation_registry
+from utils import percentile
+
+
+async def _run(question: str, configurable: dict) -> tuple:
+    config = {"configurable": {"thread_id": uuid.uuid4().hex, **configurable}, "recursion_limit": 100}
+    start = time.perf_counter()
+    state = await get_graph().ainvoke({"messages": [HumanMessage(content=question)]}, config)
+    return time.perf_counter() - start, state
+
+
+async def _pass(runs: int, configurable: dict) -> tuple:
+    searches = get_client_registry().genai_client().calls
+    # the same questions in both passes, so the fake providers research them the same way
+    results = await asyncio.gather(*(
+        _run(f"How did segment margins change in {1990 + i}?", configurable) for i in range(runs)
+    ))
+    return results, get_client_registry().genai_client().calls - searches
+
+
+def _line(name: str, results: list, searches: int) -> str:
+    latencies = [latency for latency, _ in results]
+    loops = sum(len(state["metrics"]["reflection"]["loops"]) for _, state in results)
+    return (f"{name:<12} run p50={percentile(latencies, 50):6.2f}s p95={percentile(latencies, 95):6.2f}s "
+            f"per loop={sum(latencies) / loops:6.2f}s searches={searches}")
+
+
+async def main(args):
+    set_client_registry(FakeClientRegistry(
+        LatencyModel(median=args.llm, sigma=0.3, seed=args.seed),
+        LatencyModel(median=args.search, sigma=0.3, seed=args.seed + 1),
+        seed=args.seed,
+        model_options={"fake-small": {"latency": LatencyModel(median=args.small, sigma=0.3, seed=args.seed + 2)}},
+        predictable_follow_ups=args.predictable,
+    ))
+    configurable = {"query_generator_model": "fake-large", "reasoning_model": "fake-large", "search_cache_ttl": 0,
+                    "max_research_loops": args.loops}
+    baseline = await _pass(args.runs, configurable)
+    speculative = await _pass(args.runs, {
+        **configurable, "speculate_follow_ups": True, "speculation_model": "fake-small",
+        "speculative_queries": args.guesses, "max_speculative_searches": args.max_searches,
+    })
+    print(_line("baseline", *baseline))
+    print(_line("speculative", *speculative))
+    print(json.dumps(speculation_registry.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--loops", type=int, default=3, help="max_research_loops of every run")
+    parser.add_argument("--llm", type=float, default=1.2, help="median latency of the large model, in seconds")
+    parser.add_argument("--small", type=float, default=0.3, help="median latency of the guessing model, in seconds")
+    parser.add_argument("--search", type=float, default=0.8, help="median latency of a search, in seconds")
+    parser.add_argument("--predictable", type=float, default=0.6,
+                        help="share of reflection's follow-ups that a single result points to")
+    parser.add_argument("--guesses", type=int, default=2, help="speculative_queries guessed per branch")
+    parser.add_argument("--max-searches", type=int, default=6, help="max_speculative_searches of every run")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,75 @@
+"""
+Per-step state size and serialization time, with and without the blob store.
+
+Runs the graph on the offline fakes, serializes the state after every
+superstep the way a checkpointer does, and compares keeping the research texts
+inline against offloading them to a blob store:
+
+    python bench_state.py --loops 3 --fan-out 5 --sentences 60
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+
+from langchain_core.messages import HumanMessage
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+from agent import builder
+from clients import set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+
+
+def _serialize(serde, state: dict, repeat: int) -> tuple:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _, data = serde.dumps_typed(state)
+        timings.append(time.perf_counter() - start)
+    return len(data), min(timings)
+
+
+async def run(args, blob_store: str, path: str) -> list:
+    graph = builder.compile()
+    serde = JsonPlusSerializer()
+    config = {"configurable": {
+        "max_research_loops": args.loops,
+        "number_of_initial_queries": args.fan_out,
+        "search_cache_ttl": 0,
+        "blob_store": blob_store,
+        "blob_store_path": path,
+    }}
+    inputs = {"messages": [HumanMessage(content="How did the segment margins change last year?")]}
+    steps = []
+    async for state in graph.astream(inputs, config, stream_mode="values"):
+        steps.append(_serialize(serde, state, args.repeat))
+    return steps
+
+
+async def main(args):
+    set_client_registry(FakeClientRegistry(
+        llm_latency=LatencyModel("constant", 0.0),
+        search_latency=LatencyModel("constant", 0.0),
+        seed=args.seed,
+        sufficient_probability=0.0,
+        sentences=args.sentences,
+    ))
+    with tempfile.TemporaryDirectory() as path:
+        inline = await run(args, "none", path)
+        offloaded = await run(args, args.blob_store, path)
+    print(f"{'step':>4} {'inline bytes':>13} {'inline ms':>10} {args.blob_store + ' bytes':>13} "
+          f"{args.blob_store + ' ms':>10}")
+    for step, ((inline_size, inline_time), (size, elapsed)) in enumerate(zip(inline, offloaded)):
+        print(f"{step:>4} {inline_size:>13} {inline_time * 1e3:>10.3f} {size:>13} {elapsed * 1e3:>10.3f}")
+    print(f"total serialized: inline={sum(s for s, _ in inline)} {args.blob_store}={sum(s for s, _ in offloaded)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--loops", type=int, default=3)
+    parser.add_argument("--fan-out", type=int, default=5)
+    parser.add_argument("--sentences", type=int, default=60, help="sentences per search result")
+    parser.add_argument("--blob-store", default="disk", choices=["memory", "disk", "mmap"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
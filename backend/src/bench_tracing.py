@@ -0,0 +1,92 @@
+"""
+Overhead of tracing, and the trace analysis, on the offline fake providers.
+
+Runs the graph `--runs` times with tracing off and on, on providers answering
+at once so that the graph's own work is all there is to measure, and reports
+the time tracing adds per run and per span. Then runs it again with the given
+provider latencies and prints `tracing.py`'s analysis of the trace:
+
+    python bench_tracing.py --runs 200 --fan-out 5 --llm-latency 0.05 --search-latency 0.3 --tail 0.05
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from langchain_core.messages import HumanMessage
+
+from agent import get_graph
+from clients import set_client_registry
+from fake_providers import FakeClientRegistry, LatencyModel
+from tracing import get_tracer
+from utils import percentile
+
+
+async def _runs(runs: int, fan_out: int, configurable: dict, concurrency: int) -> list:
+    graph = get_graph()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await graph.ainvoke(
+                {"messages": [HumanMessage(content=f"How did segment {i} margins change?")],
+                 "initial_search_query_count": fan_out},
+                {"configurable": {**configurable, "thread_id": uuid.uuid4().hex}, "recursion_limit": 100},
+            )
+            return time.perf_counter() - start
+
+    return await asyncio.gather(*(one(i) for i in range(runs)))
+
+
+def main(args):
+    os.environ.setdefault("CHECKPOINTER", "none")
+    trace_path = os.path.join(tempfile.mkdtemp(prefix="traces_"), "trace.json")
+    base = {"search_cache_ttl": 0, "max_research_loops": 2}
+
+    set_client_registry(FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0),
+                                           seed=args.seed))
+    # warm up imports, the compiled graph and the configuration cache
+    asyncio.run(_runs(5, args.fan_out, base, 1))
+    asyncio.run(_runs(5, args.fan_out, {**base, "trace_path": trace_path}, 1))
+    off, on = [], []
+    # alternated, so that drift over the measurement affects both alike
+    for _ in range(args.runs // 10):
+        off += asyncio.run(_runs(10, args.fan_out, base, 1))
+        on += asyncio.run(_runs(10, args.fan_out, {**base, "trace_path": trace_path}, 1))
+    tracer = get_tracer(trace_path)
+    tracer.flush()
+    spans_per_run = tracer.stats()["spans"] / (len(on) + 5)
+    added = percentile(on, 50) - percentile(off, 50)
+    print(f"run p50 without tracing {percentile(off, 50) * 1e3:.2f}ms, with {percentile(on, 50) * 1e3:.2f}ms: "
+          f"{added * 1e6:+.0f}us per run, {spans_per_run:.0f} spans per run, "
+          f"{added / spans_per_run * 1e6:+.1f}us per span")
+
+    os.remove(trace_path)
+    set_client_registry(FakeClientRegistry(
+        llm_latency=LatencyModel(median=args.llm_latency, tail_probability=args.tail, seed=args.seed),
+        search_latency=LatencyModel(median=args.search_latency, tail_probability=args.tail, seed=args.seed + 1),
+        seed=args.seed,
+    ))
+    asyncio.run(_runs(args.analyzed_runs, args.fan_out, {**base, "trace_path": trace_path}, args.concurrency))
+    tracer.flush()
+    print(f"# analysis of {args.analyzed_runs} runs ({trace_path})")
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tracing.py"),
+                    trace_path], check=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=200, help="runs timed with tracing off and on")
+    parser.add_argument("--analyzed-runs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8, help="runs in flight during the analyzed runs")
+    parser.add_argument("--fan-out", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.3)
+    parser.add_argument("--tail", type=float, default=0.05, help="probability of a slow provider call")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,93 @@
+"""
+Benchmark of the worker pool on the offline fake providers.
+
+Runs `--jobs` questions through `workers.py start --until-empty` with each of
+`--workers` process counts and reports the throughput, then repeats the largest
+pool with one worker killed midway, to show its jobs being claimed again, and
+with a shared request limit, to show the workers holding to it together:
+
+    python bench_workers.py --jobs 60 --workers 1 2 4 --concurrency 4 --rpm 300
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from rate_limit import SharedBuckets
+from workers import JobQueue
+
+
+def _run_pool(directory: str, name: str, jobs: int, workers: int, args, configurable: dict = None,
+              kill_after: float = 0.0) -> dict:
+    """Runs `jobs` questions on a new queue; with `kill_after`, kills a worker once that fraction is done."""
+    path = os.path.join(directory, f"{name}.sqlite")
+    queue = JobQueue(path)
+    queue.enqueue(
+        ({"id": f"q{i}", "question": f"How did segment margins change in {1990 + i}?"} for i in range(jobs)),
+        {"max_research_loops": args.loops, "query_generator_model": "fake-flash", "reflection_model": "fake-flash",
+         "reasoning_model": "fake-pro", **(configurable or {})},
+    )
+    # checkpoints and blobs on disk, where a job claimed again after a crash finds them
+    env = {**os.environ, "CHECKPOINT_PATH": os.path.join(directory, f"{name}-checkpoints.sqlite"),
+           "BLOB_STORE_PATH": os.path.join(directory, f"{name}-blobs")}
+    command = [sys.executable, "workers.py", "start", path, "--workers", str(workers), "--concurrency",
+               str(args.concurrency), "--visibility-timeout", str(args.visibility_timeout), "--until-empty",
+               "--fake", "--poll", "0.2"]
+    start = time.perf_counter()
+    supervisor = subprocess.Popen(command, env=env, stderr=subprocess.DEVNULL)
+    killed = None
+    if kill_after:
+        # once a quarter of the jobs are done, so the worker is sure to hold some
+        while queue.stats()["done"] < kill_after * jobs:
+            time.sleep(0.05)
+        killed = queue.stats()["worker_pids"][0]
+        os.kill(killed, signal.SIGKILL)
+    supervisor.wait()
+    elapsed = time.perf_counter() - start
+    results = list(queue.results())
+    return {
+        "elapsed_s": elapsed,
+        "done": sum(result["status"] == "ok" for result in results),
+        "redelivered": sum(result["attempts"] > 1 for result in results),
+        "killed": killed,
+        "rate_limits": SharedBuckets(path).stats(),
+    }
+
+
+def main(args):
+    directory = tempfile.mkdtemp(prefix="workers_")
+    print(f"{args.jobs} jobs, {args.concurrency} in flight per worker, {os.cpu_count()} cpus")
+    for workers in args.workers:
+        report = _run_pool(directory, f"scale-{workers}", args.jobs, workers, args)
+        print(f"{workers} workers: {report['elapsed_s']:6.2f}s, {60 * report['done'] / report['elapsed_s']:7.1f} "
+              f"jobs/min, {report['done']}/{args.jobs} done")
+
+    workers = max(args.workers)
+    report = _run_pool(directory, "crash", args.jobs, workers, args, kill_after=0.25)
+    print(f"{workers} workers, worker {report['killed']} killed a quarter of the way: "
+          f"{report['elapsed_s']:6.2f}s, {report['done']}/{args.jobs} done, {report['redelivered']} jobs claimed "
+          f"again after the {args.visibility_timeout}s visibility timeout")
+
+    # generate_query and web_research call fake-flash, each through a limiter of its own
+    report = _run_pool(directory, "limited", args.jobs, workers, args, {"rate_limits": {"fake-flash": [args.rpm, 0]}})
+    for name, limiter in report["rate_limits"].items():
+        if not name.endswith("fake-flash"):
+            continue
+        print(f"{workers} workers sharing {args.rpm} rpm: {name} granted {limiter['granted']} calls in "
+              f"{report['elapsed_s']:.2f}s = {60 * limiter['granted'] / report['elapsed_s']:.0f} rpm")
+    print(json.dumps(JobQueue(os.path.join(directory, "limited.sqlite")).stats(window=3600)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=60)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=4, help="questions in flight per worker")
+    parser.add_argument("--loops", type=int, default=1, help="max_research_loops of every run")
+    parser.add_argument("--visibility-timeout", type=float, default=5.0)
+    parser.add_argument("--rpm", type=float, default=300, help="requests per minute shared by the workers")
+    main(parser.parse_args())
@@ -0,0 +1,285 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from collections.abc import Sequence
+from typing import Any, List, Optional, Union
+
+from context import count_tokens
+
+
+def blob_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class _Pins:
+    """The blobs stored by runs still in flight, which eviction leaves alone until they are released."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_run = {}
+        self._counts = Counter()
+
+    def pin(self, run_id: Optional[str], key: str):
+        if run_id is None:
+            return
+        with self._lock:
+            keys = self._by_run.setdefault(run_id, set())
+            if key not in keys:
+                keys.add(key)
+                self._counts[key] += 1
+
+    def release(self, run_id: Optional[str]):
+        with self._lock:
+            for key in self._by_run.pop(run_id, ()):
+                self._counts[key] -= 1
+                if not self._counts[key]:
+                    del self._counts[key]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._counts
+
+
+class MemoryBlobStore:
+    """
+    Content-addressed text blobs kept in this process.
+
+    Blobs not stored or read for `ttl` seconds are evicted, and so are the
+    least recently used ones while the texts take more than `max_bytes`
+    (0 disables either limit). Blobs pinned by a run in flight are not.
+    """
+
+    def __init__(self, ttl: float = 0.0, max_bytes: int = 0):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (text, size, last used), least recently used first
+        self._blobs = OrderedDict()
+        self._bytes = 0
+        self.pins = _Pins()
+
+    def _evict(self, now: float):
+        # the blob just stored is the most recent and always kept
+        for key in list(self._blobs)[:-1]:
+            _, size, used = self._blobs[key]
+            if not (self.ttl and now - used >= self.ttl) and not (self.max_bytes and self._bytes > self.max_bytes):
+                return
+            if key not in self.pins:
+                del self._blobs[key]
+                self._bytes -= size
+
+    def put(self, text: str, run_id: Optional[str] = None) -> str:
+        """Stores a text, pinned until `run_id`, if given, is released; returns its key."""
+        key = blob_key(text)
+        now = time.monotonic()
+        self.pins.pin(run_id, key)
+        with self._lock:
+            blob = self._blobs.pop(key, None)
+            if blob is None:
+                blob = (text, len(text.encode("utf-8")), now)
+                self._bytes += blob[1]
+            self._blobs[key] = (blob[0], blob[1], now)
+            self._evict(now)
+        return key
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            text, size, _ = self._blobs.pop(key)
+            self._blobs[key] = (text, size, time.monotonic())
+            return text
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+
+class DiskBlobStore:
+    """
+    Content-addressed text blobs stored as files under `path`, one per sha256.
+
+    Identical texts share a file, and a blob is never rewritten once it exists,
+    so concurrent writers need no coordination: each writes a temporary file and
+    renames it into place. With `use_mmap`, reads decode straight from a memory
+    map of the file instead of copying it into a bytes object first.
+
+    With a `ttl`, storing or reading a blob touches its file, and files not
+    touched for `ttl` seconds are deleted by a sweep, which a put starts in the
+    background at most every quarter of the ttl (and at least hourly). The
+    sweep spares the blobs pinned by runs in flight in this process.
+    """
+
+    def __init__(self, path: str, use_mmap: bool = False, ttl: float = 0.0):
+        self.path = path
+        self.use_mmap = use_mmap
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._swept = 0.0
+        self.pins = _Pins()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def _touch(self, target: str) -> bool:
+        if not self.ttl:
+            return os.path.exists(target)
+        try:
+            os.utime(target)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self, text: str, run_id: Optional[str] = None) -> str:
+        """Stores a text, pinned until `run_id`, if given, is released; returns its key."""
+        key = blob_key(text)
+        self.pins.pin(run_id, key)
+        target = self._file(key)
+        if not self._touch(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+            with os.fdopen(fd, "wb") as f:
+                f.write(text.encode("utf-8"))
+            os.replace(tmp, target)
+        self._maybe_sweep()
+        return key
+
+    def _maybe_sweep(self):
+        if not self.ttl:
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._swept < min(self.ttl / 4, 3600):
+                return
+            self._swept = now
+        threading.Thread(target=self.sweep, name="blob-sweep", daemon=True).start()
+
+    def sweep(self) -> int:
+        """Deletes the blobs not stored or read for `ttl` seconds; returns how many."""
+        expired = time.time() - self.ttl
+        removed = 0
+        for directory, _, files in os.walk(self.path):
+            for name in files:
+                file = os.path.join(directory, name)
+                if os.path.basename(directory) + name in self.pins:
+                    continue
+                try:
+                    if os.stat(file).st_mtime < expired:
+                        os.remove(file)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def get(self, key: str) -> str:
+        if self.ttl:
+            self._touch(self._file(key))
+        with open(self._file(key), "rb") as f:
+            if self.use_mmap and os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    with memoryview(mapped) as view:
+                        return str(view, "utf-8")
+            return f.read().decode("utf-8")
+
+    def __len__(self) -> int:
+        return sum(len(files) for _, _, files in os.walk(self.path))
+
+
+BlobStore = Union[MemoryBlobStore, DiskBlobStore]
+
+
+def offload(store: Optional[BlobStore], text: str, run_id: Optional[str] = None) -> Union[str, dict]:
+    """
+    Stores `text` and returns the compact reference kept in the graph state.
+
+    The reference carries the token count of the text, so prompt budgets can be
+    planned without loading it. The blob is pinned until `run_id` is released.
+    Without a store the text itself is returned.
+    """
+    if store is None:
+        return text
+    return {"blob": store.put(text, run_id), "tokens": count_tokens(text)}
+
+
+def ref_tokens(item: Union[str, dict]) -> int:
+    return item["tokens"] if isinstance(item, dict) else count_tokens(item)
+
+
+class ResolvedResults(Sequence):
+    """
+    A read-only list of texts over state entries that are texts or blob references.
+
+    References are loaded from the store on first access only, so a prompt
+    that falls back to digests for older loops never reads their full texts.
+    A blob the store no longer has, e.g. one a checkpoint resumed after its
+    ttl refers to, reads as its entry of `fallbacks` (the digests) instead.
+    """
+
+    def __init__(self, items: List[Any], store: Optional[BlobStore], fallbacks: Optional[List[str]] = None):
+        self._items = items
+        self._store = store
+        self._fallbacks = fallbacks or []
+        self._loaded = {}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        item = self._items[index]
+        if not isinstance(item, dict):
+            return item
+        text = self._loaded.get(item["blob"])
+        if text is None:
+            try:
+                if self._store is None:
+                    raise KeyError(f"blob {item['blob']} referenced without a blob store")
+                text = self._store.get(item["blob"])
+            except (KeyError, FileNotFoundError):
+                if index >= len(self._fallbacks):
+                    raise
+                text = self._fallbacks[index]
+            self._loaded[item["blob"]] = text
+        return text
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_blob_store(kind: str, path: str, ttl: float = 0.0, max_bytes: int = 0) -> Optional[BlobStore]:
+    """
+    Returns the process-wide store of this kind: "memory", "disk", "mmap" (disk
+    read through memory maps) or "none", which keeps results inline in the state.
+    `ttl` and, for the memory store, `max_bytes` bound what it keeps. The disk
+    stores need a `path`, so that they never write into whatever directory the
+    process happened to start in.
+    """
+    if kind in ("", "none"):
+        return None
+    if kind not in ("memory", "disk", "mmap"):
+        raise ValueError(f"unknown blob store {kind!r}")
+    if kind != "memory" and not path:
+        raise ValueError(f"the {kind} blob store needs blob_store_path")
+    key = (kind, None if kind == "memory" else os.path.abspath(path))
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = MemoryBlobStore() if kind == "memory" else DiskBlobStore(path, use_mmap=kind == "mmap")
+            _stores[key] = store
+        # the latest configuration's limits apply
+        store.ttl = ttl
+        if kind == "memory":
+            store.max_bytes = max_bytes
+        return store
+
+
+
+def release_run(run_id: Optional[str]):
+    """Unpins the blobs a run stored in every store, once it has ended."""
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        store.pins.release(run_id)
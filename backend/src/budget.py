@@ -0,0 +1,171 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+_USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens", "cost", "calls")
+
+
+def add_usage(left: Optional[dict], right: Optional[dict]) -> dict:
+    """State reducer summing token/cost usage, overall and per node."""
+    if not left:
+        return right or {}
+    if not right:
+        return left
+    merged = {field: left.get(field, 0) + right.get(field, 0) for field in _USAGE_FIELDS}
+    by_node = {node: dict(usage) for node, usage in left.get("by_node", {}).items()}
+    for node, usage in right.get("by_node", {}).items():
+        totals = by_node.setdefault(node, {field: 0 for field in _USAGE_FIELDS})
+        for field in _USAGE_FIELDS:
+            totals[field] = totals.get(field, 0) + usage.get(field, 0)
+    merged["by_node"] = by_node
+    return merged
+
+
+class UsageCollector:
+    """Accumulates the token usage and cost of the provider calls made by one node."""
+
+    def __init__(self, node: str, prices: Optional[dict] = None):
+        self.node = node
+        self.prices = prices or {}
+        self._lock = threading.Lock()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.calls = 0
+
+    def add(self, model: Optional[str], prompt_tokens: int, completion_tokens: int):
+        # prices are (input, output) in dollars per million tokens
+        input_price, output_price = self.prices.get(model or "", (0.0, 0.0))
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost += (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+            self.calls += 1
+
+    def add_gemini(self, model: str, response):
+        """Records the `usage_metadata` of a google-genai response."""
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return
+        self.add(
+            model,
+            getattr(usage, "prompt_token_count", None) or 0,
+            getattr(usage, "candidates_token_count", None) or 0,
+        )
+
+    def as_update(self) -> dict:
+        usage = {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "cost": self.cost,
+            "calls": self.calls,
+        }
+        return {**usage, "by_node": {self.node: dict(usage)}}
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """Forwards the token usage reported at the end of every LLM call to a collector."""
+
+    def __init__(self, collector: UsageCollector):
+        self.collector = collector
+
+    def on_llm_end(self, response, **kwargs):
+        llm_output = response.llm_output or {}
+        token_usage = llm_output.get("token_usage") or {}
+        prompt_tokens = token_usage.get("prompt_tokens")
+        completion_tokens = token_usage.get("completion_tokens")
+        model = llm_output.get("model_name")
+        if prompt_tokens is None:
+            # streamed calls report usage on the aggregated message instead
+            for generations in response.generations:
+                for generation in generations:
+                    message = getattr(generation, "message", None)
+                    usage = getattr(message, "usage_metadata", None)
+                    if usage:
+                        prompt_tokens = (prompt_tokens or 0) + usage.get("input_tokens", 0)
+                        completion_tokens = (completion_tokens or 0) + usage.get("output_tokens", 0)
+                        model = model or message.response_metadata.get("model_name")
+        self.collector.add(model, prompt_tokens or 0, completion_tokens or 0)
+
+
+_usage_handler: ContextVar[Optional[UsageCallbackHandler]] = ContextVar("usage_handler", default=None)
+# every callback manager configured while the variable is set gets the handler,
+# so LLM calls are counted without threading callbacks through each call site
+register_configure_hook(_usage_handler, inheritable=True)
+
+
+@contextmanager
+def track_usage(node: str, prices: Optional[dict] = None):
+    """Collects the usage of every LangChain LLM call made inside the block."""
+    collector = UsageCollector(node, prices)
+    token = _usage_handler.set(UsageCallbackHandler(collector))
+    try:
+        yield collector
+    finally:
+        _usage_handler.reset(token)
+
+
+def _average(usage: dict, node: str, field: str = "total_tokens") -> float:
+    node_usage = usage.get("by_node", {}).get(node)
+    if not node_usage or not node_usage.get("calls"):
+        return 0.0
+    return node_usage[field] / max(node_usage["calls"], 1)
+
+
+def plan_next_loop(state: dict, configurable, follow_up_queries: list) -> tuple:
+    """
+    Trims the next fan-out so the run stays within its token, cost and time budgets.
+
+    The next loop is projected from the usage so far: each follow-up search costs
+    what an average `web_research` call cost, and another reflection plus the
+    final answer are held in reserve. Searches are dropped from the end of the
+    list until the projection fits.
+
+    Returns:
+        The follow-up queries that fit, and whether the budget is exhausted.
+    """
+    usage = state.get("usage") or {}
+    loops = max(state.get("research_loop_count") or 1, 1)
+    elapsed = time.time() - (state.get("run_started_at") or time.time())
+    if configurable.max_run_seconds and elapsed + elapsed / loops > configurable.max_run_seconds:
+        return [], True
+
+    allowed = len(follow_up_queries)
+    for limit, field in (
+            (configurable.max_run_tokens, "total_tokens"),
+            (configurable.max_run_cost, "cost"),
+    ):
+        if not limit:
+            continue
+        reserve = 2 * _average(usage, "reflection", field)
+        per_search = _average(usage, "web_research", field)
+        remaining = limit - usage.get(field, 0) - reserve
+        if remaining <= 0:
+            return [], True
+        if per_search:
+            allowed = min(allowed, math.floor(remaining / per_search))
+    if allowed <= 0 and follow_up_queries:
+        return [], True
+    return follow_up_queries[:allowed], False
+
+
+def budget_report(state: dict, configurable) -> dict:
+    """Budget consumption of the run, for the final state."""
+    usage = state.get("usage") or {}
+    return {
+        "total_tokens": usage.get("total_tokens", 0),
+        "max_run_tokens": configurable.max_run_tokens,
+        "cost": usage.get("cost", 0.0),
+        "max_run_cost": configurable.max_run_cost,
+        "elapsed_seconds": time.time() - (state.get("run_started_at") or time.time()),
+        "max_run_seconds": configurable.max_run_seconds,
+        "budget_exhausted": bool(state.get("budget_exhausted")),
+        "trimmed_queries": state.get("budget_trimmed_queries") or [],
+    }
@@ -0,0 +1,109 @@
+import threading
+from collections import deque
+from typing import Any, Callable, Optional
+
+from utils import percentile
+
+
+def escalation_reason(result: dict, min_confidence: float,
+                      check: Optional[Callable[[Any], bool]] = None) -> Optional[str]:
+    """
+    Why a small model's structured output is not good enough, or None if it is.
+
+    `result` is what `with_structured_output(schema, include_raw=True)` returns.
+    The output escalates if it failed to parse or validate ("invalid"), if
+    `check` rejects it ("unusable"), or if the confidence it reports is below
+    `min_confidence` ("low_confidence").
+    """
+    parsed = result.get("parsed")
+    if result.get("parsing_error") is not None or parsed is None:
+        return "invalid"
+    if check is not None and not check(parsed):
+        return "unusable"
+    confidence = getattr(parsed, "confidence", None)
+    if confidence is not None and confidence < min_confidence:
+        return "low_confidence"
+    return None
+
+
+class CascadeStats:
+    """
+    How one node's cascade fares: how often the small model's output is
+    escalated, and why, and the latency the cascade saves.
+
+    A call the small model answers saves what the large model would have
+    taken, estimated by the node's recent escalated calls to it; an escalated
+    call costs the small model's attempt on top of the large call. Savings are
+    priced when asked for, so calls answered before the first escalation count
+    once there is one to compare with.
+    """
+
+    def __init__(self, node: str, window: int = 1024):
+        self.node = node
+        self._lock = threading.Lock()
+        self._small = deque(maxlen=window)
+        self._large = deque(maxlen=window)
+        self._reasons = {}
+        self._answered = 0
+        self._answered_seconds = 0.0
+        self._wasted_seconds = 0.0
+
+    def _expected_large(self) -> Optional[float]:
+        return sum(self._large) / len(self._large) if self._large else None
+
+    def record(self, reason: Optional[str], small_seconds: float, large_seconds: Optional[float] = None):
+        """
+        Records a call, escalated for `reason` or answered by the small model.
+        Returns the seconds it saved, negative when it cost time, or None if
+        that is not known yet.
+        """
+        with self._lock:
+            self._small.append(small_seconds)
+            if reason is not None:
+                self._reasons[reason] = self._reasons.get(reason, 0) + 1
+                self._large.append(large_seconds)
+                self._wasted_seconds += small_seconds
+                return -small_seconds
+            self._answered += 1
+            self._answered_seconds += small_seconds
+            expected = self._expected_large()
+            return expected - small_seconds if expected is not None else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            escalated = sum(self._reasons.values())
+            calls = self._answered + escalated
+            expected = self._expected_large()
+            saved = (
+                self._answered * expected - self._answered_seconds - self._wasted_seconds
+                if expected is not None else None
+            )
+            return {
+                "calls": calls,
+                "escalated": escalated,
+                "escalation_rate": escalated / calls if calls else 0.0,
+                "reasons": dict(self._reasons),
+                "small_p50_s": percentile(self._small, 50),
+                "large_p50_s": percentile(self._large, 50),
+                "latency_saved_s": saved,
+                "latency_saved_per_call_s": saved / calls if saved is not None else None,
+            }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_cascade_stats(node: str) -> CascadeStats:
+    """Returns the process-wide cascade statistics of `node`."""
+    with _stats_lock:
+        stats = _stats.get(node)
+        if stats is None:
+            stats = _stats[node] = CascadeStats(node)
+        return stats
+
+
+def cascade_stats() -> dict:
+    with _stats_lock:
+        nodes = list(_stats.values())
+    return {stats.node: stats.stats() for stats in nodes}
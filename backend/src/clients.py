@@ -0,0 +1,229 @@
+import asyncio
+import atexit
+import threading
+import weakref
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from google.genai import Client
+    from langchain_openai import ChatOpenAI
+
+# the provider SDKs (and httpx) are imported on first use, as they take most of a cold start
+
+DEFAULT_POOL_SIZE = 100
+KEEPALIVE_EXPIRY = 30.0
+
+
+class ConnectionStats:
+    """Thread-safe counters of HTTP requests and the connections that served them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.opened = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_open(self):
+        with self._lock:
+            self.opened += 1
+
+    @property
+    def reused(self) -> int:
+        return self.requests - self.opened
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections_opened": self.opened,
+                "connections_reused": self.requests - self.opened,
+            }
+
+
+class _Pool:
+    """The keep-alive transport shared by every client of one provider and credential."""
+
+    def __init__(self, stats: ConnectionStats, pool_size: int, is_async: bool):
+        import httpx
+
+        self.stats = stats
+        self.is_async = is_async
+        limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        if is_async:
+            self.transport = httpx.AsyncHTTPTransport(limits=limits)
+        else:
+            self.transport = httpx.HTTPTransport(limits=limits)
+
+    def client_args(self) -> dict:
+        """Keyword arguments for an ``httpx.Client``/``httpx.AsyncClient`` on this pool."""
+        stats = self.stats
+
+        # httpcore reports every new TCP connection through the "trace" extension,
+        # which lets us tell opened connections apart from reused ones.
+        if self.is_async:
+            async def trace(event_name, info):
+                if event_name == "connection.connect_tcp.complete":
+                    stats.record_open()
+
+            async def on_request(request):
+                stats.record_request()
+                request.extensions["trace"] = trace
+        else:
+            def trace(event_name, info):
+                if event_name == "connection.connect_tcp.complete":
+                    stats.record_open()
+
+            def on_request(request):
+                stats.record_request()
+                request.extensions["trace"] = trace
+
+        return {"transport": self.transport, "event_hooks": {"request": [on_request]}}
+
+
+class ClientRegistry:
+    """
+    Process-wide registry of LLM and search clients.
+
+    Clients are built once per (provider, model, credentials) and reused by every
+    node invocation, so repeated calls share one keep-alive connection pool per
+    provider instead of paying for client setup and TLS handshakes on each call.
+
+    Sync callers share one set of pools. Async callers get pools bound to their
+    running event loop, since async connections cannot move between loops.
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._pools = {}
+        self._clients = {}
+        self._loop_pools = weakref.WeakKeyDictionary()
+        self._loop_clients = weakref.WeakKeyDictionary()
+
+    def _scope(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return None, self._pools, self._clients
+        return (
+            loop,
+            self._loop_pools.setdefault(loop, {}),
+            self._loop_clients.setdefault(loop, {}),
+        )
+
+    def _pool(self, pools: dict, key: tuple, is_async: bool, pool_size: Optional[int]) -> _Pool:
+        pool = pools.get(key)
+        if pool is None:
+            stats = self._stats.setdefault(key[0], ConnectionStats())
+            pool = _Pool(stats, pool_size or self.pool_size, is_async)
+            pools[key] = pool
+        return pool
+
+    def chat_model(
+            self,
+            model: str,
+            api_key: Optional[str] = None,
+            temperature: float = 1.0,
+            max_retries: int = 2,
+            base_url: Optional[str] = None,
+            pool_size: Optional[int] = None,
+    ) -> "ChatOpenAI":
+        """Returns the shared ``ChatOpenAI`` for this model and credential."""
+        import httpx
+        from langchain_openai import ChatOpenAI
+
+        with self._lock:
+            loop, pools, clients = self._scope()
+            key = ("openai", model, api_key, base_url, temperature, max_retries)
+            llm = clients.get(key)
+            if llm is None:
+                pool = self._pool(pools, ("openai", api_key, base_url), loop is not None, pool_size)
+                http_client = {
+                    "http_async_client" if pool.is_async else "http_client":
+                        (httpx.AsyncClient if pool.is_async else httpx.Client)(**pool.client_args())
+                }
+                llm = ChatOpenAI(
+                    model=model,
+                    temperature=temperature,
+                    max_retries=max_retries,
+                    api_key=api_key,
+                    base_url=base_url,
+                    # report token usage on streamed calls too
+                    stream_usage=True,
+                    **http_client,
+                )
+                clients[key] = llm
+            return llm
+
+    def genai_client(
+            self,
+            api_key: Optional[str] = None,
+            base_url: Optional[str] = None,
+            pool_size: Optional[int] = None,
+    ) -> "Client":
+        """Returns the shared google-genai ``Client`` for this credential."""
+        from google.genai import Client
+
+        with self._lock:
+            loop, pools, clients = self._scope()
+            key = ("gemini", api_key, base_url)
+            client = clients.get(key)
+            if client is None:
+                pool = self._pool(pools, key, loop is not None, pool_size)
+                http_options = {"async_client_args" if pool.is_async else "client_args": pool.client_args()}
+                if base_url:
+                    http_options["base_url"] = base_url
+                client = Client(api_key=api_key, http_options=http_options)
+                clients[key] = client
+            return client
+
+    def stats(self) -> dict:
+        """Per-provider request and connection counters."""
+        with self._lock:
+            return {provider: stats.snapshot() for provider, stats in self._stats.items()}
+
+    def close(self):
+        """Closes the sync connection pools and forgets every sync client."""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+            self._clients.clear()
+        for pool in pools:
+            pool.transport.close()
+
+    async def aclose(self):
+        """Closes the connection pools bound to the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            pools = list(self._loop_pools.pop(loop, {}).values())
+            self._loop_clients.pop(loop, None)
+        for pool in pools:
+            await pool.transport.aclose()
+
+
+# shared by every node in the process
+client_registry = ClientRegistry()
+atexit.register(client_registry.close)
+
+
+def get_client_registry():
+    """Returns the registry the nodes take their clients from."""
+    return client_registry
+
+
+def set_client_registry(registry):
+    """
+    Replaces the registry the nodes take their clients from, e.g. with the fakes of
+    `fake_providers`, and returns the previous one.
+    """
+    global client_registry
+    previous, client_registry = client_registry, registry
+    return previous
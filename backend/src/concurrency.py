@@ -0,0 +1,274 @@
+import asyncio
+import math
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, AsyncExitStack, ExitStack
+from typing import Any, Optional
+
+
+class _Slots:
+    """
+    A counting semaphore that threads and the coroutines of any event loop
+    wait on together, so one limit holds across sync and async branches.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.held = 0
+        self._cond = threading.Condition()
+        # futures of waiting coroutines, in arrival order
+        self._waiters = deque()
+
+    def acquire(self):
+        with self._cond:
+            while self.held >= self.limit:
+                self._cond.wait()
+            self.held += 1
+
+    async def aacquire(self):
+        with self._cond:
+            if self.held < self.limit and not self._waiters:
+                self.held += 1
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._cond:
+                queued = future in self._waiters
+                if queued:
+                    self._waiters.remove(future)
+            # a slot handed over before the cancellation is given back; one still
+            # on its way to a cancelled future is given back by `_grant`
+            if not queued and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._cond:
+            self.held -= 1
+            while self._waiters and self.held < self.limit:
+                future = self._waiters.popleft()
+                self.held += 1
+                future.get_loop().call_soon_threadsafe(self._grant, future)
+            self._cond.notify()
+
+    def _grant(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class FanOutLimiter:
+    """
+    Caps the number of web_research branches that run at the same time.
+
+    Two limits are applied to every branch: a per-run limit, keyed on the
+    ``run_id`` carried in the Send payload, and a per-process limit shared by
+    all the runs executing in this process. A limit of 0 (or None) disables
+    that cap.
+
+    The process has one set of slots, which sync branches and the async
+    branches of every event loop share; runs configured with different
+    ``per_process`` limits get the smallest of them, so no run's cap is
+    exceeded. Async branches wait on a future, so waiting for a slot parks a
+    coroutine rather than a thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._process_slots = None
+        self._run_slots = weakref.WeakValueDictionary()
+
+    def _slots(self, run_id: Optional[str], per_run: int, per_process: int) -> list:
+        with self._lock:
+            slots = []
+            if per_run and run_id is not None:
+                run_slots = self._run_slots.get(run_id)
+                if run_slots is None or run_slots.limit != per_run:
+                    run_slots = self._run_slots[run_id] = _Slots(per_run)
+                slots.append(run_slots)
+            if per_process:
+                if self._process_slots is None:
+                    self._process_slots = _Slots(per_process)
+                elif per_process < self._process_slots.limit:
+                    # holders above the new limit finish first
+                    self._process_slots.limit = per_process
+                slots.append(self._process_slots)
+            return slots
+
+    @contextmanager
+    def slot(self, run_id: Optional[str], per_run: int = 0, per_process: int = 0):
+        """Blocks the calling thread until a branch slot is free."""
+        with ExitStack() as stack:
+            for slots in self._slots(run_id, per_run, per_process):
+                slots.acquire()
+                stack.callback(slots.release)
+            yield
+
+    @asynccontextmanager
+    async def aslot(self, run_id: Optional[str], per_run: int = 0, per_process: int = 0):
+        """Waits, without blocking the event loop, until a branch slot is free."""
+        async with AsyncExitStack() as stack:
+            for slots in self._slots(run_id, per_run, per_process):
+                await slots.aacquire()
+                stack.callback(slots.release)
+            yield
+
+
+# shared by every graph run in the process
+fan_out_limiter = FanOutLimiter()
+
+
+class FanIn:
+    """
+    Decides when the web_research branches of one loop stop waiting for stragglers.
+
+    The loop is released once `quorum` of its branches have finished, or
+    `deadline` seconds after its first search started, whichever comes first.
+    Branches still searching at that point return without a result. A quorum
+    of 1 with no deadline waits for every branch, as a plain fan-in does.
+
+    The deadline runs from `start`, called once a search holds its slot, so
+    that time spent queued behind other runs' searches does not count.
+    """
+
+    def __init__(self, branches: int, quorum: float, deadline: float):
+        self.branches = branches
+        self.needed = branches if quorum >= 1 else max(1, math.ceil(quorum * branches))
+        self.seconds = deadline
+        self.deadline = None
+        self.finished = 0
+        self.settled = 0
+        self._cond = threading.Condition()
+        self._waiters = set()
+
+    @property
+    def released(self) -> bool:
+        return self.finished >= self.needed or (
+            self.deadline is not None and time.monotonic() >= self.deadline
+        )
+
+    def _timeout(self) -> Optional[float]:
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _wake_waiters(self, waiters: list):
+        for waiter in waiters:
+            waiter.get_loop().call_soon_threadsafe(_resolve, waiter)
+
+    def start(self):
+        """Starts the deadline clock, if a search of the loop has not already."""
+        with self._cond:
+            if not self.seconds or self.deadline is not None:
+                return
+            self.deadline = time.monotonic() + self.seconds
+            # waiters re-arm their timeouts on the deadline
+            self._cond.notify_all()
+            waiters = list(self._waiters)
+        self._wake_waiters(waiters)
+
+    def wait(self, future) -> bool:
+        """
+        Blocks until the branch's `concurrent.futures.Future` is done or the loop is
+        released, and returns whether the branch's search completed.
+        """
+        future.add_done_callback(lambda _: self._wake())
+        with self._cond:
+            while not (future.done() or self.released):
+                self._cond.wait(self._timeout())
+        return future.done()
+
+    async def await_(self, task: asyncio.Future) -> bool:
+        """Async twin of `wait`, for an asyncio task."""
+        while True:
+            release = asyncio.get_running_loop().create_future()
+            with self._cond:
+                # checked under the lock, so a start or settle after it resolves `release`
+                if task.done() or self.released:
+                    return task.done()
+                self._waiters.add(release)
+                timeout = self._timeout()
+            try:
+                await asyncio.wait([task, release], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                with self._cond:
+                    self._waiters.discard(release)
+
+    def settle(self, completed: bool):
+        """Records that a branch returned, with or without its search result."""
+        with self._cond:
+            self.settled += 1
+            self.finished += completed
+            self._cond.notify_all()
+            waiters = list(self._waiters) if self.finished >= self.needed else []
+        self._wake_waiters(waiters)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class FanInRegistry:
+    """
+    Shares one `FanIn` between the branches of each (run, loop), and keeps the
+    searches of released branches that were left running so the next loop can
+    pick them up instead of searching again.
+    """
+
+    def __init__(self, max_late_searches: int = 1024):
+        self._lock = threading.Lock()
+        self._fan_ins = {}
+        self._late = OrderedDict()
+        self.max_late_searches = max_late_searches
+
+    def get(self, run_id: Optional[str], loop: int, branches: int, quorum: float, deadline: float) -> FanIn:
+        with self._lock:
+            fan_in = self._fan_ins.get((run_id, loop))
+            if fan_in is None:
+                fan_in = self._fan_ins[(run_id, loop)] = FanIn(branches, quorum, deadline)
+            return fan_in
+
+    def settle(self, run_id: Optional[str], loop: int, completed: bool):
+        with self._lock:
+            fan_in = self._fan_ins.get((run_id, loop))
+            if fan_in is None:
+                return
+            if fan_in.settled + 1 >= fan_in.branches:
+                del self._fan_ins[(run_id, loop)]
+        fan_in.settle(completed)
+
+    def keep_late(self, run_id: Optional[str], query: str, future: Any):
+        with self._lock:
+            self._late[(run_id, query)] = future
+            while len(self._late) > self.max_late_searches:
+                self._late.popitem(last=False)
+
+    def take_late(self, run_id: Optional[str], query: str) -> Optional[Any]:
+        """Returns, and forgets, a search left running for this query by an earlier loop."""
+        with self._lock:
+            return self._late.pop((run_id, query), None)
+
+    def forget_run(self, run_id: Optional[str]):
+        """
+        Cancels the searches a finished run left running (running threads cannot
+        be stopped), and drops the fan-ins of loops it never finished.
+        """
+        with self._lock:
+            late = [self._late.pop(key) for key in [key for key in self._late if key[0] == run_id]]
+            for key in [key for key in self._fan_ins if key[0] == run_id]:
+                del self._fan_ins[key]
+        for future in late:
+            future.cancel()
+
+
+# shared by every graph run in the process
+fan_in_registry = FanInRegistry()
@@ -1,24 +1,444 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from typing import Any, Optional
 from langchain_core.runnables import RunnableConfig
 
+import functools
+import json
 import os
 
 
 class Configuration(BaseModel):
+    # instances are shared between node calls by `from_runnable_config`
+    model_config = ConfigDict(frozen=True)
 
     query_generator_model: str = Field(
         default="",
         metadata={
-            "description": "The name of the language model to use for the agent's description"
+            "description": "The name of the language model generate_query and web_research call"
         }
     )
     reflection_model: str = Field(
         default="",
         metadata={
-            "description": "The name of the model to use for the agent's answer"
+            "description": "The name of the model reflection calls (empty: the query_generator_model)"
         }
     )
+    reasoning_model: str = Field(
+        default="",
+        metadata={
+            "description": "The name of the model to use for the final answer"
+        }
+    )
+    cascade_models: dict[str, str] = Field(
+        default_factory=dict,
+        metadata={
+            "description": "A small model generate_query or reflection tries first, by node, e.g. "
+                           "{\"reflection\": \"gpt-4.1-mini\"}; the node's own model is called only "
+                           "when the small model's output does not validate or is not confident enough"
+        }
+    )
+    cascade_min_confidence: float = Field(
+        default=0.7,
+        metadata={
+            "description": "The confidence, from 0 to 1, below which a cascade's small-model output "
+                           "is escalated to the node's own model"
+        }
+    )
+    number_of_initial_queries: int = Field(
+        default=3,
+        metadata={
+            "description": "The number of initial search queries to generate"
+        }
+    )
+    max_research_loops: int = Field(
+        default=2,
+        metadata={
+            "description": "The maximum number of research loops to perform"
+        }
+    )
+    max_concurrent_searches_per_run: int = Field(
+        default=0,
+        metadata={
+            "description": "The maximum number of web_research branches a single run may "
+                           "execute at once (0 means no limit)"
+        }
+    )
+    max_concurrent_searches: int = Field(
+        default=0,
+        metadata={
+            "description": "The maximum number of web_research branches executing at once "
+                           "across all runs in this process (0 means no limit); the smallest value "
+                           "any run has asked for applies"
+        }
+    )
+    fan_in_quorum: float = Field(
+        default=1.0,
+        metadata={
+            "description": "The fraction of a loop's web_research branches that must finish before "
+                           "reflection runs; the rest are skipped (1 waits for every branch)"
+        }
+    )
+    fan_in_deadline: float = Field(
+        default=0.0,
+        metadata={
+            "description": "Seconds after a loop's first search starts at which its unfinished "
+                           "branches are skipped (0 means no deadline)"
+        }
+    )
+    late_searches: str = Field(
+        default="fold",
+        metadata={
+            "description": "What happens to the searches of skipped branches: \"fold\" keeps them "
+                           "running and re-queues their queries into the next loop, which picks up "
+                           "the result; \"cancel\" drops them"
+        }
+    )
+    speculate_follow_ups: bool = Field(
+        default=False,
+        metadata={
+            "description": "Whether each finished web_research branch guesses the follow-up queries "
+                           "reflection will ask from its own result, and starts their searches while "
+                           "the loop and reflection are still running"
+        }
+    )
+    speculation_model: str = Field(
+        default="",
+        metadata={
+            "description": "The model guessing follow-up queries (empty: the reflection cascade's small "
+                           "model, or else reflection's model)"
+        }
+    )
+    speculative_queries: int = Field(
+        default=2,
+        metadata={
+            "description": "The number of follow-up queries guessed from each branch's result"
+        }
+    )
+    max_speculative_searches: int = Field(
+        default=6,
+        metadata={
+            "description": "The maximum number of speculative searches a run executes at once, apart "
+                           "from its web_research branches"
+        }
+    )
+    speculation_match_threshold: float = Field(
+        default=0.8,
+        metadata={
+            "description": "The similarity at or above which a speculative search answers a follow-up "
+                           "query (0 matches exact repeats only)"
+        }
+    )
+    hedge_percentile: float = Field(
+        default=0.0,
+        metadata={
+            "description": "The percentile of a node's recent call latencies after which a slow search "
+                           "or structured LLM call is duplicated, the first answer winning "
+                           "(0 disables hedging)"
+        }
+    )
+    hedge_budget: float = Field(
+        default=0.05,
+        metadata={
+            "description": "The fraction of calls that may be hedged"
+        }
+    )
+    hedge_min_samples: int = Field(
+        default=20,
+        metadata={
+            "description": "The number of calls a node must have made before its calls are hedged"
+        }
+    )
+    rate_limits: dict[str, tuple[float, float]] = Field(
+        default_factory=dict,
+        metadata={
+            "description": "The (requests, tokens) per minute allowed for each model, shared by every "
+                           "run in this process; calls queue for them, finalize_answer first "
+                           "(a 0 or a missing model means no limit)"
+        }
+    )
+    rate_limit_store: str = Field(
+        default="",
+        metadata={
+            "description": "The SQLite file rate_limits are kept in, shared by every process using it, "
+                           "e.g. the workers of a job queue (empty keeps the limits per process)"
+        }
+    )
+    max_retries: int = Field(
+        default=2,
+        metadata={
+            "description": "The number of times a provider call failing with a 429, a 5xx or a "
+                           "connection error is retried, with jittered backoff"
+        }
+    )
+    http_pool_size: int = Field(
+        default=100,
+        metadata={
+            "description": "The size of the keep-alive connection pool shared by the clients "
+                           "of each provider"
+        }
+    )
+    search_backend: str = Field(
+        default="gemini",
+        metadata={
+            "description": "Where web_research searches: \"gemini\" (its google_search tool), "
+                           "\"local\" (the BM25 index at search_index_path) or "
+                           "\"package.module:factory\" for a custom backend"
+        }
+    )
+    search_index_path: str = Field(
+        default="search_index",
+        metadata={
+            "description": "The directory of the local search backend's index"
+        }
+    )
+    search_results: int = Field(
+        default=5,
+        metadata={
+            "description": "The number of documents a local or custom search backend returns per query"
+        }
+    )
+    search_cache_ttl: int = Field(
+        default=24 * 3600,
+        metadata={
+            "description": "How long, in seconds, a cached web_research response stays valid "
+                           "(0 disables the cache)"
+        }
+    )
+    search_cache_size: int = Field(
+        default=1024,
+        metadata={
+            "description": "The number of web_research responses kept in the in-memory cache tier"
+        }
+    )
+    search_cache_path: str = Field(
+        default="",
+        metadata={
+            "description": "The SQLite file backing the on-disk cache tier (empty keeps the "
+                           "cache in memory only)"
+        }
+    )
+    search_cache_disk_size: int = Field(
+        default=100_000,
+        metadata={
+            "description": "The number of web_research responses kept in the on-disk cache tier"
+        }
+    )
+    fetch_pages: bool = Field(
+        default=False,
+        metadata={
+            "description": "Whether web_research fetches the pages behind its grounding chunks and "
+                           "adds their passages that best match the query to its result"
+        }
+    )
+    fetch_max_pages: int = Field(
+        default=5,
+        metadata={
+            "description": "The number of distinct pages fetched per search"
+        }
+    )
+    fetch_per_host: int = Field(
+        default=4,
+        metadata={
+            "description": "The number of concurrent page requests to any one host, per process"
+        }
+    )
+    fetch_timeout: float = Field(
+        default=10.0,
+        metadata={
+            "description": "The time, in seconds, one page request may take before the page is given up"
+        }
+    )
+    fetch_max_bytes: int = Field(
+        default=2_000_000,
+        metadata={
+            "description": "The number of bytes of a page body that are read; the rest is dropped"
+        }
+    )
+    fetch_chunk_tokens: int = Field(
+        default=200,
+        metadata={
+            "description": "The size, in tokens, of the chunks a fetched page's text is split into"
+        }
+    )
+    fetch_top_chunks: int = Field(
+        default=3,
+        metadata={
+            "description": "The number of best-matching chunks of a search's fetched pages added "
+                           "to its result"
+        }
+    )
+    fetch_private_hosts: bool = Field(
+        default=False,
+        metadata={
+            "description": "Whether pages, and the redirects on the way to them, may be fetched from "
+                           "loopback, private and link-local addresses (only for local test servers)"
+        }
+    )
+    fetch_cache_path: str = Field(
+        default="",
+        metadata={
+            "description": "The SQLite file fetched pages are cached in by URL and chunk size (empty "
+                           "keeps the cache in memory)"
+        }
+    )
+    fetch_cache_size: int = Field(
+        default=10000,
+        metadata={
+            "description": "The number of fetched pages cached before the least recently fetched are "
+                           "evicted (0 means no limit)"
+        }
+    )
+    fetch_cache_ttl: int = Field(
+        default=24 * 3600,
+        metadata={
+            "description": "How long, in seconds, a fetched page is used without revalidating it "
+                           "with its ETag or Last-Modified"
+        }
+    )
+    answer_cache_ttl: int = Field(
+        default=0,
+        metadata={
+            "description": "How long, in seconds, a final answer stays cached for repeat questions, "
+                           "which then skip the research entirely (0 disables the cache)"
+        }
+    )
+    answer_cache_threshold: float = Field(
+        default=0.85,
+        metadata={
+            "description": "The similarity between research topics at or above which a question is "
+                           "answered from the answer cache"
+        }
+    )
+    answer_cache_size: int = Field(
+        default=10_000,
+        metadata={
+            "description": "The number of answers kept in the answer cache"
+        }
+    )
+    answer_cache_path: str = Field(
+        default="",
+        metadata={
+            "description": "The SQLite file the answer cache persists to (empty keeps it in memory only)"
+        }
+    )
+    query_dedup_threshold: float = Field(
+        default=0.0,
+        metadata={
+            "description": "The similarity at or above which a proposed search query is "
+                           "suppressed as a near-duplicate, e.g. 0.8; queries naming different years, "
+                           "numbers or entities are always kept (0 disables suppression)"
+        }
+    )
+    stream_answer: bool = Field(
+        default=False,
+        metadata={
+            "description": "Whether finalize_answer streams the answer tokens, with short urls "
+                           "rewritten, through the \"custom\" stream mode"
+        }
+    )
+    reflection_context_tokens: int = Field(
+        default=8000,
+        metadata={
+            "description": "The token budget for the research summaries in the reflection prompt "
+                           "(0 means no limit)"
+        }
+    )
+    answer_context_tokens: int = Field(
+        default=0,
+        metadata={
+            "description": "The token budget for the research summaries in the final answer prompt "
+                           "(0 means no limit)"
+        }
+    )
+    digest_tokens: int = Field(
+        default=200,
+        metadata={
+            "description": "The size, in tokens, of the digest kept for each web research result"
+        }
+    )
+    blob_store: str = Field(
+        default="memory",
+        metadata={
+            "description": "Where web research texts are stored, the state keeping only references: "
+                           "\"memory\", \"disk\", \"mmap\" (disk read through memory maps, both "
+                           "under blob_store_path) or \"none\" to keep them inline"
+        }
+    )
+    blob_store_path: str = Field(
+        default="",
+        metadata={
+            "description": "The directory of the disk and mmap blob stores, which they require"
+        }
+    )
+    blob_ttl: float = Field(
+        default=86400.0,
+        metadata={
+            "description": "Seconds a research text is kept in the blob store after it was last stored "
+                           "or read (0 keeps texts forever)"
+        }
+    )
+    blob_memory_bytes: int = Field(
+        default=256 * 1024 * 1024,
+        metadata={
+            "description": "The bytes of text the memory blob store keeps before evicting the least "
+                           "recently used texts (0 means no limit)"
+        }
+    )
+    trace_path: str = Field(
+        default="",
+        metadata={
+            "description": "The file spans of every node, provider call and local step are appended "
+                           "to as Chrome trace events (empty disables tracing)"
+        }
+    )
+    trace_sample_rate: float = Field(
+        default=1.0,
+        metadata={
+            "description": "The fraction of runs traced, chosen by run_id"
+        }
+    )
+    max_run_tokens: int = Field(
+        default=0,
+        metadata={
+            "description": "The maximum number of LLM and search tokens a single run may use "
+                           "(0 means no limit)"
+        }
+    )
+    max_run_cost: float = Field(
+        default=0.0,
+        metadata={
+            "description": "The maximum cost, in dollars, of a single run (0 means no limit)"
+        }
+    )
+    max_run_seconds: float = Field(
+        default=0.0,
+        metadata={
+            "description": "The maximum wall-clock time of a single run (0 means no limit)"
+        }
+    )
+    model_prices: dict[str, tuple[float, float]] = Field(
+        default_factory=dict,
+        metadata={
+            "description": "The (input, output) price in dollars per million tokens of each model, "
+                           "used to compute run costs"
+        }
+    )
+
+    @field_validator("model_prices", "rate_limits", "cascade_models", mode="before")
+    @classmethod
+    def _parse_model_prices(cls, value: Any) -> Any:
+        # values read from the environment arrive as JSON strings
+        return json.loads(value) if isinstance(value, str) else value
+
+    def model_for(self, node: str) -> str:
+        """The model `node` calls: reflection falls back to the query generator's model."""
+        if node == "reflection":
+            return self.reflection_model or self.query_generator_model
+        if node == "speculate":
+            return self.speculation_model or self.cascade_models.get("reflection") or self.model_for("reflection")
+        if node == "finalize_answer":
+            return self.reasoning_model
+        return self.query_generator_model
 
     @classmethod
     def from_runnable_config(
@@ -27,10 +447,28 @@ class Configuration(BaseModel):
         configurable = (
             config["configurable"] if config and "configurable" in config else {}
         )
-        # get raw values from environment of config
+        # get raw values from environment of config; scanning the environment once is
+        # several times cheaper than a lookup per field, which raises on every miss
+        env_names = _env_names(cls)
+        env = {env_names[key]: os.environ[key] for key in os.environ if key in env_names}
         raw_values: dict[str, Any] = {
-            name: os.environ.get(name.upper(), configurable.get(name))
-            for name in cls.model_field.keys()
+            name: env.get(name, configurable.get(name))
+            for name in cls.model_fields.keys()
         }
-        values = {k: v for k, v in raw_values.items() if v is not None}
-        return cls(**values)
\ No newline at end of file
+        # every node call builds one, and validation dominates its cost, so identical
+        # values share one instance; dicts are keyed as the JSON their validators accept
+        values = tuple(
+            (k, json.dumps(v, sort_keys=True) if isinstance(v, (dict, list)) else v)
+            for k, v in raw_values.items() if v is not None
+        )
+        return _from_values(cls, values)
+
+
+@functools.lru_cache(maxsize=None)
+def _env_names(cls) -> dict:
+    return {name.upper(): name for name in cls.model_fields}
+
+
+@functools.lru_cache(maxsize=256)
+def _from_values(cls, values: tuple) -> Configuration:
+    return cls(**dict(values))
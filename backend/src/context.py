@@ -0,0 +1,107 @@
+import re
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_CITATION_MARKER = re.compile(r"\[[^\]]*\]\([^)]*\)")
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:  # tiktoken missing or its encoding cannot be loaded offline
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Counts tokens with tiktoken when available, else estimates four characters per token."""
+    encoding = _encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def condense(text: str, max_tokens: int = 200) -> str:
+    """
+    Condenses a web research result into an extractive digest of about `max_tokens`.
+
+    Sentences carrying citation markers are kept first, so the digest still
+    cites its sources; the kept sentences stay in their original order.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    sentences = [sentence for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (not _CITATION_MARKER.search(sentences[i]), i),
+    )
+    kept, used = set(), 0
+    for i in ranked:
+        tokens = count_tokens(sentences[i])
+        if used + tokens > max_tokens:
+            continue
+        kept.add(i)
+        used += tokens
+    if not kept:
+        # a single sentence longer than the budget: keep its head
+        return sentences[0][:max_tokens * 4]
+    return " ".join(sentences[i] for i in sorted(kept))
+
+
+def build_summaries(
+        results: Sequence[str],
+        digests: List[str],
+        fresh_from: int,
+        max_tokens: int,
+        separator: str,
+        result_tokens: Optional[List[int]] = None,
+) -> Tuple[str, dict]:
+    """
+    Joins research results into a prompt section that fits a token budget.
+
+    Results from `fresh_from` onwards (the newest loop) are used raw, newest
+    first, while they fit; everything else falls back to its digest. Digests of
+    the oldest results are dropped if even they do not fit. A `max_tokens` of 0
+    keeps every raw result.
+
+    `results` may load its texts lazily: given their `result_tokens`, a raw
+    result is only read when it goes into the prompt.
+
+    Returns:
+        The joined summaries, and token counts for the bounded and unbounded prompt sections.
+    """
+    separator_tokens = count_tokens(separator)
+    if result_tokens is None:
+        unbounded_tokens = count_tokens(separator.join(results))
+    else:
+        unbounded_tokens = sum(result_tokens) + separator_tokens * max(len(results) - 1, 0)
+    if not max_tokens or unbounded_tokens <= max_tokens:
+        return separator.join(results), {
+            "summary_tokens": unbounded_tokens,
+            "unbounded_summary_tokens": unbounded_tokens,
+        }
+
+    chosen = [None] * len(results)
+    used = 0
+    for i in range(len(results) - 1, -1, -1):
+        # results gathered before digests were kept get condensed here instead
+        digest = digests[i] if i < len(digests) else condense(results[i])
+        if i >= fresh_from:
+            raw_tokens = result_tokens[i] if result_tokens is not None else count_tokens(results[i])
+            if used + raw_tokens + separator_tokens <= max_tokens:
+                chosen[i] = results[i]
+                used += raw_tokens + separator_tokens
+                continue
+        tokens = count_tokens(digest) + separator_tokens
+        if used + tokens <= max_tokens:
+            chosen[i] = digest
+            used += tokens
+
+    summaries = separator.join(text for text in chosen if text is not None)
+    return summaries, {
+        "summary_tokens": count_tokens(summaries),
+        "unbounded_summary_tokens": unbounded_tokens,
+    }
@@ -0,0 +1,223 @@
+import math
+import random
+import re
+import zlib
+from functools import lru_cache
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from utils import normalize_query
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_WORD = re.compile(r"[\w'-]+")
+_SENTENCE_END = re.compile(r"[.!?:]")
+# articles, auxiliaries and prepositions that rephrasing swaps freely; question
+# words and words of direction ("before", "from") change the meaning and stay
+_FILLER = frozenset(
+    "a an the of in on at by for during with is are was were be been do does did has have had".split()
+)
+
+
+def shingles(query: str, size: int = 3) -> set:
+    """
+    Character n-grams of every word in the normalized query but filler words.
+
+    Shingling words independently makes the set insensitive to word order, so
+    "apple revenue 2024" and "2024 apple revenue" share every shingle, and
+    leaving out filler makes "revenue in 2024" and "revenue during 2024" equal.
+    """
+    grams = set()
+    for word in normalize_query(query).split():
+        if word in _FILLER:
+            continue
+        padded = f" {word} "
+        if len(padded) <= size:
+            grams.add(padded)
+        for i in range(len(padded) - size + 1):
+            grams.add(padded[i:i + size])
+    return grams
+
+
+def _token(word: str) -> str:
+    # "Apple's" names Apple
+    word = word.lower()
+    return word[:-2] if word.endswith("'s") else word
+
+
+def distinguishing_tokens(query: str) -> frozenset:
+    """
+    The tokens of a query that name what it is about: those with a digit
+    (years, amounts, versions) and capitalized words (entities), lower-cased.
+    A word starting a sentence is capitalized anyway, so only its digits count.
+
+    Shingle similarity barely sees them, so "Apple revenue fiscal year 2023"
+    and "Apple revenue fiscal year 2024" look near-identical; queries that do
+    not have `same_distinguishing_tokens` are never treated as duplicates.
+    """
+    tokens, end = set(), None
+    for match in _WORD.finditer(query):
+        word = match.group()
+        initial = end is None or _SENTENCE_END.search(query, end, match.start()) is not None
+        if any(ch.isdigit() for ch in word) or (word[0].isupper() and not initial):
+            tokens.add(_token(word))
+        end = match.end()
+    return frozenset(tokens)
+
+
+def same_distinguishing_tokens(query: str, other: str) -> bool:
+    """
+    Whether neither query names a year, number or entity the other does not
+    mention. A token only has to appear among the other's words, in any case,
+    so "how did apple revenue change?" still matches "How did Apple revenue
+    change?" while "2023" never matches "2024".
+    """
+    words = frozenset(_token(word) for word in _WORD.findall(query))
+    other_words = frozenset(_token(word) for word in _WORD.findall(other))
+    return distinguishing_tokens(query) <= other_words and distinguishing_tokens(other) <= words
+
+
+@lru_cache(maxsize=4096)
+def _minhash(query: str, shingle_size: int, perms: Tuple[Tuple[int, int], ...]) -> Tuple[int, ...]:
+    # cached because every loop re-indexes the queries that already ran
+    hashes = [zlib.crc32(gram.encode()) for gram in shingles(query, shingle_size)]
+    if not hashes:
+        return tuple([_MERSENNE_PRIME] * len(perms))
+    return tuple(
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+        for a, b in perms
+    )
+
+
+class MinHashIndex:
+    """
+    MinHash signatures over query shingles with LSH banding for candidate lookup.
+
+    `query` returns the indexed queries whose estimated Jaccard similarity with
+    the probe is at least `threshold`, most similar first.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, shingle_size: int = 3, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self._perms = tuple(
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        )
+        self._buckets = {}
+        self._entries = []
+
+    def signature(self, query: str) -> Tuple[int, ...]:
+        return _minhash(query, self.shingle_size, self._perms)
+
+    def _bands(self, signature: Tuple[int, ...]):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows]
+
+    def add(self, query: str) -> None:
+        signature = self.signature(query)
+        position = len(self._entries)
+        self._entries.append((query, signature))
+        for band in self._bands(signature):
+            self._buckets.setdefault(band, []).append(position)
+
+    def query(self, query: str, threshold: float) -> List[Tuple[str, float]]:
+        signature = self.signature(query)
+        candidates = set()
+        for band in self._bands(signature):
+            candidates.update(self._buckets.get(band, ()))
+        matches = []
+        for position in candidates:
+            other, other_signature = self._entries[position]
+            similarity = sum(x == y for x, y in zip(signature, other_signature)) / self.num_perm
+            if similarity >= threshold:
+                matches.append((other, similarity))
+        return sorted(matches, key=lambda match: -match[1])
+
+
+class EmbeddingIndex:
+    """
+    Brute-force cosine similarity over embeddings from a pluggable `embed` function.
+
+    `embed` maps a list of strings to a list of vectors, e.g. the `embed_documents`
+    method of a LangChain embeddings model.
+    """
+
+    def __init__(self, embed: Callable[[List[str]], List[Sequence[float]]]):
+        self.embed = embed
+        self._entries = []
+
+    @staticmethod
+    def _unit(vector: Sequence[float]) -> List[float]:
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def add(self, query: str) -> None:
+        self._entries.append((query, self._unit(self.embed([query])[0])))
+
+    def query(self, query: str, threshold: float) -> List[Tuple[str, float]]:
+        probe = self._unit(self.embed([query])[0])
+        matches = []
+        for other, vector in self._entries:
+            similarity = sum(x * y for x, y in zip(probe, vector))
+            if similarity >= threshold:
+                matches.append((other, similarity))
+        return sorted(matches, key=lambda match: -match[1])
+
+
+# builds the similarity index used by `dedupe_queries`; replace it with e.g.
+# `lambda: EmbeddingIndex(embeddings.embed_documents)` to compare embeddings instead
+index_factory: Callable[[], object] = MinHashIndex
+
+
+def dedupe_queries(
+        queries: List[str],
+        past_queries: Optional[List[str]] = None,
+        threshold: float = 0.8,
+) -> Tuple[List[str], List[dict]]:
+    """
+    Drops queries that repeat or paraphrase one another or an already-run query.
+
+    A near match only counts when the queries have `same_distinguishing_tokens`,
+    so queries on different years or entities are kept.
+
+    Args:
+        queries: The candidate queries, in the order proposed by the LLM.
+        past_queries: Queries already searched in this run.
+        threshold: The similarity at or above which a query counts as a duplicate.
+            0 disables suppression.
+
+    Returns:
+        The queries to run, and one record per suppressed query with the query
+        it duplicates and their similarity.
+    """
+    if not threshold:
+        return list(queries), []
+
+    index = index_factory()
+    seen = {}
+    for past in past_queries or []:
+        normalized = normalize_query(past)
+        if normalized not in seen:
+            seen[normalized] = past
+            index.add(past)
+
+    kept, suppressed = [], []
+    for query in queries:
+        normalized = normalize_query(query)
+        if normalized in seen:
+            duplicate_of, similarity = seen[normalized], 1.0
+        else:
+            matches = [(other, similarity) for other, similarity in index.query(query, threshold)
+                       if same_distinguishing_tokens(query, other)]
+            duplicate_of, similarity = matches[0] if matches else (None, 0.0)
+        if duplicate_of is not None:
+            suppressed.append({"query": query, "duplicate_of": duplicate_of, "similarity": similarity})
+            continue
+        seen[normalized] = query
+        index.add(query)
+        kept.append(query)
+    return kept, suppressed
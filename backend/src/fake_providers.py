@@ -0,0 +1,416 @@
+"""
+Deterministic stand-ins for the OpenAI and Gemini clients used by the nodes.
+
+`FakeClientRegistry` has the interface of `clients.ClientRegistry`, so installing
+it with `clients.set_client_registry` runs the whole graph offline. Latency,
+token counts and grounding metadata are configurable and reproducible per seed.
+"""
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, Iterator, AsyncIterator, List, Optional, Sequence
+
+from google.genai import types
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+from pydantic import ValidationError
+
+from tools_and_schemas import FollowUpGuess, Reflection, SearchQueryList
+from utils import SHORT_URL_PREFIX
+
+_WORDS = (
+    "revenue growth market share quarter fiscal forecast analyst report supply chain demand "
+    "pricing margin segment outlook regulation competitor adoption benchmark latency model "
+    "hardware software services region guidance earnings investment research policy"
+).split()
+_SHORT_URL = re.compile(re.escape(SHORT_URL_PREFIX) + r"\d+-\d+")
+_NUMBER_QUERIES = re.compile(r"Don't produce more than (\d+) queries")
+# the id of the web_research branch a cited short url comes from
+_BRANCH_ID = re.compile(re.escape(SHORT_URL_PREFIX) + r"(\d+)-\d+")
+
+
+@dataclass
+class LatencyModel:
+    """
+    A provider latency distribution, in seconds.
+
+    "constant" always returns `median`; "uniform" draws from [0, 2 * median];
+    "lognormal" draws around `median` with shape `sigma`. With probability
+    `tail_probability` the draw is multiplied by `tail_multiplier`, modelling the
+    occasional slow response.
+    """
+    distribution: str = "lognormal"
+    median: float = 0.05
+    sigma: float = 0.5
+    tail_probability: float = 0.0
+    tail_multiplier: float = 10.0
+    seed: int = 0
+
+    def __post_init__(self):
+        self._rng = random.Random(self.seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        with self._lock:
+            if self.distribution == "constant":
+                value = self.median
+            elif self.distribution == "uniform":
+                value = self._rng.uniform(0, 2 * self.median)
+            elif self.distribution == "lognormal":
+                value = self.median * self._rng.lognormvariate(0, self.sigma)
+            else:
+                raise ValueError(f"unknown latency distribution {self.distribution!r}")
+            if self.tail_probability and self._rng.random() < self.tail_probability:
+                value *= self.tail_multiplier
+        return value
+
+
+def _rng_for(seed: int, text: str) -> random.Random:
+    return random.Random(seed ^ zlib.crc32(text.encode()))
+
+
+def _phrase(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _gap_query(seed: int, branch: str, gap: int) -> str:
+    # the same for reflection and the gap detector, so a guess can be right
+    return f"{_phrase(_rng_for(seed, f'gap {branch} {gap}'), 5)} follow up"
+
+
+def count_fake_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    A `ChatOpenAI`-compatible chat model that answers from the prompt without a network.
+
+    Structured output for `SearchQueryList` and `Reflection` is generated as JSON
+    and parsed by the schema, so the callback, streaming and usage paths are the
+    same as for a real model. With `invalid_probability` the JSON misses a
+    required key, and with `low_confidence_probability` it reports a confidence
+    of 0.3, as an unsure small model would. With `predictable_follow_ups`, that
+    share of reflection's follow-ups is one of the two gaps of a single cited
+    search result, which `FollowUpGuess` guesses from that result alone. Plain
+    answers cite the short urls found in the prompt, like the real answer does.
+    """
+    model_name: str = "fake-chat"
+    latency: Any = None
+    token_interval: float = 0.0
+    answer_words: int = 200
+    sufficient_probability: float = 0.3
+    follow_ups: int = 2
+    invalid_probability: float = 0.0
+    low_confidence_probability: float = 0.0
+    predictable_follow_ups: float = 0.0
+    seed: int = 0
+    structured_schema: Optional[type] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _content(self, prompt: str) -> str:
+        rng = _rng_for(self.seed, prompt)
+        if self.structured_schema in (SearchQueryList, Reflection):
+            # drawn per model, so a small and a large model differ on the same prompt
+            quality = _rng_for(self.seed, self.model_name + prompt).random()
+            confidence = 0.3 if quality < self.low_confidence_probability else 0.9
+            invalid = 1 - quality < self.invalid_probability
+        if self.structured_schema is SearchQueryList:
+            match = _NUMBER_QUERIES.search(prompt)
+            count = int(match.group(1)) if match else 3
+            output = {
+                "query": [f"{_phrase(rng, 4)} {i}" for i in range(count)],
+                "rational": _phrase(rng, 12),
+                "confidence": confidence,
+            }
+            if invalid:
+                del output["query"]
+            return json.dumps(output)
+        if self.structured_schema is Reflection:
+            sufficient = rng.random() < self.sufficient_probability
+            output = {
+                "is_sufficient": sufficient,
+                "knowledge_gap": "" if sufficient else _phrase(rng, 10),
+                "follow_up_queries": [] if sufficient else [
+                    self._follow_up(rng, prompt, i) for i in range(self.follow_ups)
+                ],
+                "confidence": confidence,
+            }
+            if invalid:
+                del output["is_sufficient"]
+            return json.dumps(output)
+        if self.structured_schema is FollowUpGuess:
+            match = _NUMBER_QUERIES.search(prompt)
+            branches = _BRANCH_ID.findall(prompt)
+            return json.dumps({"follow_up_queries": [
+                _gap_query(self.seed, branches[0], gap) if branches else f"{_phrase(rng, 5)} follow up {gap}"
+                for gap in range(int(match.group(1)) if match else 2)
+            ]})
+        citations = _SHORT_URL.findall(prompt)
+        words = []
+        for i in range(self.answer_words):
+            words.append(rng.choice(_WORDS))
+            if citations and i % 25 == 24:
+                words.append(f"[source]({rng.choice(citations)})")
+        return " ".join(words) + "."
+
+    def _follow_up(self, rng: random.Random, prompt: str, i: int) -> str:
+        branches = list(dict.fromkeys(_BRANCH_ID.findall(prompt)))
+        if branches and self.predictable_follow_ups and rng.random() < self.predictable_follow_ups:
+            return _gap_query(self.seed, rng.choice(branches), rng.randrange(2))
+        return f"{_phrase(rng, 5)} follow up {i}"
+
+    def _usage(self, prompt: str, content: str) -> dict:
+        prompt_tokens = count_fake_tokens(prompt)
+        completion_tokens = count_fake_tokens(content)
+        return {
+            "input_tokens": prompt_tokens,
+            "output_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def _result(self, prompt: str) -> ChatResult:
+        content = self._content(prompt)
+        usage = self._usage(prompt, content)
+        message = AIMessage(
+            content=content,
+            usage_metadata=usage,
+            response_metadata={"model_name": self.model_name},
+        )
+        return ChatResult(
+            generations=[ChatGeneration(message=message)],
+            llm_output={
+                "model_name": self.model_name,
+                "token_usage": {
+                    "prompt_tokens": usage["input_tokens"],
+                    "completion_tokens": usage["output_tokens"],
+                    "total_tokens": usage["total_tokens"],
+                },
+            },
+        )
+
+    @staticmethod
+    def _prompt(messages) -> str:
+        return "\n".join(str(message.content) for message in messages)
+
+    def _delay(self) -> float:
+        return self.latency.sample() if self.latency is not None else 0.0
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self._delay())
+        return self._result(self._prompt(messages))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self._delay())
+        return self._result(self._prompt(messages))
+
+    def _chunks(self, prompt: str) -> List[ChatGenerationChunk]:
+        content = self._content(prompt)
+        pieces = re.findall(r"\S+\s*", content) or [content]
+        chunks = [ChatGenerationChunk(message=AIMessageChunk(content=piece)) for piece in pieces]
+        chunks.append(ChatGenerationChunk(message=AIMessageChunk(
+            content="",
+            usage_metadata=self._usage(prompt, content),
+            response_metadata={"model_name": self.model_name},
+        )))
+        return chunks
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self._delay())
+        for chunk in self._chunks(self._prompt(messages)):
+            if self.token_interval:
+                time.sleep(self.token_interval)
+            if run_manager and chunk.message.content:
+                run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self._delay())
+        for chunk in self._chunks(self._prompt(messages)):
+            if self.token_interval:
+                await asyncio.sleep(self.token_interval)
+            if run_manager and chunk.message.content:
+                await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+    def with_structured_output(self, schema, include_raw: bool = False, **kwargs):
+        bound = self.model_copy(update={"structured_schema": schema})
+
+        def parse(message):
+            if not include_raw:
+                return schema.model_validate_json(message.content)
+            # as LangChain's models do, a parsing failure is returned instead of raised
+            try:
+                return {"raw": message, "parsed": schema.model_validate_json(message.content), "parsing_error": None}
+            except ValidationError as exc:
+                return {"raw": message, "parsed": None, "parsing_error": exc}
+
+        return bound | RunnableLambda(parse)
+
+
+class _FakeModels:
+    def __init__(self, client: "FakeGenaiClient", is_async: bool):
+        self._client = client
+        self._is_async = is_async
+
+    def generate_content(self, model: str, contents: str, config: Any = None):
+        if self._is_async:
+            return self._client._agenerate(model, contents)
+        time.sleep(self._client._delay())
+        return self._client.response(model, contents)
+
+
+class FakeGenaiClient:
+    """
+    A google-genai `Client` stand-in whose `generate_content` returns real
+    `GenerateContentResponse` objects with grounding chunks and supports.
+
+    Segment indices are UTF-8 byte offsets, as Gemini reports them. Calls whose
+    1-based number is in `fail_on_calls` raise, to exercise failure recovery.
+    With a `page_base_url`, e.g. a `stub_server.PageHandler`'s, the chunk uris
+    point at its redirect links so that the pages behind them can be fetched.
+    """
+
+    def __init__(
+            self,
+            latency: Optional[LatencyModel] = None,
+            sentences: int = 12,
+            chunks: int = 6,
+            non_ascii: bool = False,
+            fail_on_calls: Sequence[int] = (),
+            seed: int = 0,
+            page_base_url: str = "",
+    ):
+        self.latency = latency
+        self.sentences = sentences
+        self.chunks = chunks
+        self.non_ascii = non_ascii
+        self.fail_on_calls = set(fail_on_calls)
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.seed = seed
+        self.page_base_url = page_base_url.rstrip("/")
+        self.models = _FakeModels(self, is_async=False)
+        self.aio = SimpleNamespace(models=_FakeModels(self, is_async=True))
+
+    def _delay(self) -> float:
+        return self.latency.sample() if self.latency is not None else 0.0
+
+    async def _agenerate(self, model: str, contents: str):
+        await asyncio.sleep(self._delay())
+        return self.response(model, contents)
+
+    def response(self, model: str, contents: str) -> types.GenerateContentResponse:
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        if call in self.fail_on_calls:
+            raise RuntimeError(f"injected failure of search call {call}")
+        rng = _rng_for(self.seed, contents)
+        key = f"{zlib.crc32(contents.encode()):08x}"
+        base = (f"{self.page_base_url}/redirect" if self.page_base_url
+                else "https://vertexaisearch.cloud.google.com/grounding-api-redirect")
+        grounding_chunks = [
+            types.GroundingChunk(web=types.GroundingChunkWeb(
+                uri=f"{base}/{key}-{i}",
+                title=f"{rng.choice(_WORDS)}{i}.com",
+            ))
+            for i in range(self.chunks)
+        ]
+        sentences, supports, offset = [], [], 0
+        for _ in range(self.sentences):
+            sentence = _phrase(rng, rng.randint(8, 20)).capitalize()
+            if self.non_ascii:
+                sentence += " prévision à l'année"
+            sentence += ". "
+            encoded = len(sentence.encode("utf-8"))
+            supports.append(types.GroundingSupport(
+                segment=types.Segment(start_index=offset, end_index=offset + encoded - 1, text=sentence.strip()),
+                grounding_chunk_indices=rng.sample(range(self.chunks), min(self.chunks, rng.randint(1, 2))),
+            ))
+            sentences.append(sentence)
+            offset += encoded
+        text = "".join(sentences)
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(
+                content=types.Content(role="model", parts=[types.Part(text=text)]),
+                grounding_metadata=types.GroundingMetadata(
+                    grounding_chunks=grounding_chunks,
+                    grounding_supports=supports,
+                ),
+            )],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=count_fake_tokens(contents),
+                candidates_token_count=count_fake_tokens(text),
+                total_token_count=count_fake_tokens(contents) + count_fake_tokens(text),
+            ),
+        )
+
+
+class FakeClientRegistry:
+    """
+    Hands out fake clients through the `ClientRegistry` interface.
+
+    `model_options` maps model names to `FakeChatModel` fields of their own,
+    e.g. a lower `latency` and an `invalid_probability` for a small model.
+    """
+
+    def __init__(
+            self,
+            llm_latency: Optional[LatencyModel] = None,
+            search_latency: Optional[LatencyModel] = None,
+            seed: int = 0,
+            model_options: Optional[dict] = None,
+            **fake_options,
+    ):
+        self.llm_latency = llm_latency or LatencyModel(seed=seed)
+        self.search_latency = search_latency or LatencyModel(median=0.2, seed=seed + 1)
+        self.seed = seed
+        self.model_options = model_options or {}
+        self.fake_options = fake_options
+        self._lock = threading.Lock()
+        self._chat_models = {}
+        self._genai_client = None
+
+    def chat_model(self, model: str, **kwargs) -> FakeChatModel:
+        with self._lock:
+            llm = self._chat_models.get(model)
+            if llm is None:
+                options = {
+                    "latency": self.llm_latency,
+                    **{key: value for key, value in self.fake_options.items() if key in FakeChatModel.model_fields},
+                    **self.model_options.get(model, {}),
+                }
+                llm = FakeChatModel(model_name=model or "fake-chat", seed=self.seed, **options)
+                self._chat_models[model] = llm
+            return llm
+
+    def genai_client(self, **kwargs) -> FakeGenaiClient:
+        with self._lock:
+            if self._genai_client is None:
+                options = {
+                    key: value for key, value in self.fake_options.items()
+                    if key in ("sentences", "chunks", "non_ascii", "fail_on_calls", "page_base_url")
+                }
+                self._genai_client = FakeGenaiClient(self.search_latency, seed=self.seed, **options)
+            return self._genai_client
+
+    def stats(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
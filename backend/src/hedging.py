@@ -0,0 +1,198 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+# the first copy of a hedged sync call runs here so that the caller can stop waiting for it;
+# its caller blocks meanwhile, so the pool needs a thread per concurrent caller, started as needed
+_primaries = concurrent.futures.ThreadPoolExecutor(max_workers=256, thread_name_prefix="hedge-primary")
+# hedges get a bounded pool of their own, so they never queue behind the calls they duplicate;
+# with every hedge thread busy a slow call is not hedged at all
+MAX_SYNC_HEDGES = 32
+_hedges = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_SYNC_HEDGES, thread_name_prefix="hedge")
+_hedge_slots = threading.BoundedSemaphore(MAX_SYNC_HEDGES)
+
+
+class HedgeBudget:
+    """
+    Token bucket limiting hedges to a fraction of the calls made.
+
+    Every call earns `ratio` of a token, up to `burst` tokens, and every hedge
+    spends one, so under sustained slowness at most `ratio` of the calls are
+    duplicated and a degraded provider does not get twice the traffic.
+    """
+
+    def __init__(self, ratio: float, burst: float = 10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def earn(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Hedger:
+    """
+    Sends a duplicate of a call that has been running longer than usual.
+
+    "Usual" is a percentile of the latencies of the node's recent calls, so
+    the hedge delay follows the provider as it speeds up or slows down. The
+    first response to arrive wins and the other request is cancelled (a sync
+    call already running is abandoned instead; its result is discarded).
+    """
+
+    def __init__(self, node: str, window: int = 256):
+        self.node = node
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._budget = HedgeBudget(0.0)
+        self._stats = {"calls": 0, "hedges_fired": 0, "hedges_won": 0, "budget_denied": 0, "saturated": 0}
+
+    def delay(self, percentile: float, min_samples: int) -> Optional[float]:
+        """The elapsed time after which a call gets hedged, or None while there is too little history."""
+        with self._lock:
+            if len(self._latencies) < max(min_samples, 1):
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+    def _start(self, budget_ratio: float):
+        with self._lock:
+            self._stats["calls"] += 1
+            self._budget.ratio = budget_ratio
+            self._budget.earn()
+
+    def _may_hedge(self) -> bool:
+        with self._lock:
+            if self._budget.spend():
+                self._stats["hedges_fired"] += 1
+                return True
+            self._stats["budget_denied"] += 1
+            return False
+
+    def _hedge(self, func: Callable[[], T]) -> Optional[concurrent.futures.Future]:
+        """Sends a sync hedge on a free hedge thread, or returns None if there is none or no budget."""
+        if not _hedge_slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["saturated"] += 1
+            return None
+        if not self._may_hedge():
+            _hedge_slots.release()
+            return None
+        hedge = _hedges.submit(contextvars.copy_context().run, func)
+        hedge.add_done_callback(lambda _: _hedge_slots.release())
+        return hedge
+
+    def _record(self, latency: float, hedge_won: bool):
+        with self._lock:
+            self._latencies.append(latency)
+            self._stats["hedges_won"] += hedge_won
+
+    def call(self, func: Callable[[], T], percentile: float, budget: float, min_samples: int = 20) -> T:
+        """Runs `func`, hedging it with a second call if it is slow."""
+        if not percentile:
+            return func()
+        self._start(budget)
+        delay = self.delay(percentile, min_samples)
+        started = time.perf_counter()
+        if delay is None:
+            result = func()
+            self._record(time.perf_counter() - started, False)
+            return result
+
+        # run in a copy of the caller's context, so callbacks such as usage tracking still apply
+        primary = _primaries.submit(contextvars.copy_context().run, func)
+        done, _ = concurrent.futures.wait([primary], timeout=delay)
+        calls = [primary]
+        hedge = self._hedge(func) if not done else None
+        if hedge is not None:
+            calls.append(hedge)
+        pending = set(calls)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            winner = next((future for future in done if future.exception() is None), None)
+            if winner is not None or not pending:
+                break
+        for future in pending:
+            future.cancel()
+        if winner is None:
+            return primary.result()
+        self._record(time.perf_counter() - started, winner is not primary)
+        return winner.result()
+
+    async def acall(self, func: Callable[[], Awaitable[T]], percentile: float, budget: float,
+                    min_samples: int = 20) -> T:
+        """Async twin of `call`; `func` makes a new awaitable on every call."""
+        if not percentile:
+            return await func()
+        self._start(budget)
+        delay = self.delay(percentile, min_samples)
+        started = time.perf_counter()
+        if delay is None:
+            result = await func()
+            self._record(time.perf_counter() - started, False)
+            return result
+
+        primary = asyncio.ensure_future(func())
+        calls = [primary]
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if not done and self._may_hedge():
+                calls.append(asyncio.ensure_future(func()))
+            pending = set(calls)
+            winner = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None or not pending:
+                    break
+        finally:
+            for task in calls:
+                if not task.done():
+                    task.cancel()
+        if winner is None:
+            return primary.result()
+        self._record(time.perf_counter() - started, winner is not primary)
+        return winner.result()
+
+    def stats(self) -> dict:
+        """
+        Calls, hedges fired and won, hedges the budget refused, sync hedges
+        skipped as every hedge thread was busy, and the current p95.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["p95_latency"] = self.delay(95, 1)
+        return stats
+
+
+_hedgers = {}
+_hedgers_lock = threading.Lock()
+
+
+def get_hedger(node: str) -> Hedger:
+    """Returns the process-wide hedger of a node, so its latency history spans runs."""
+    with _hedgers_lock:
+        hedger = _hedgers.get(node)
+        if hedger is None:
+            hedger = _hedgers[node] = Hedger(node)
+        return hedger
+
+
+def hedge_stats() -> dict:
+    """Hedging counters of every node."""
+    with _hedgers_lock:
+        hedgers = list(_hedgers.values())
+    return {hedger.node: hedger.stats() for hedger in hedgers}
@@ -0,0 +1,321 @@
+"""
+On-disk BM25 index over a local document corpus.
+
+    python local_index.py add search_index docs.jsonl
+    python local_index.py search search_index "how did margins change" -k 5
+    python local_index.py merge search_index
+
+Documents are JSON lines with "url", "title" and "text". Every `add` writes a
+new immutable segment of postings, so documents can be added while the index
+is being searched; segments are merged once there are more than
+`max_segments` of them.
+"""
+import argparse
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import tempfile
+import threading
+from array import array
+from operator import itemgetter
+from typing import Iterable, List, Optional
+
+# words too common to be worth a posting list
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the this "
+    "to was were what when where which who why will with".split()
+)
+_TOKEN = re.compile(r"\w+")
+_SENTENCE = re.compile(r"(?<=[.!?])\s+")
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+def _write_atomic(path: str, data: bytes):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _map(path: str) -> Optional[mmap.mmap]:
+    # an empty file cannot be mapped
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _Segment:
+    """
+    An immutable batch of postings: a term dictionary loaded in memory and the
+    (doc id, term frequency) pairs of every term in one memory-mapped file.
+    """
+
+    def __init__(self, path: str, name: str):
+        self.name = name
+        with open(os.path.join(path, f"{name}.terms"), "rb") as f:
+            self.terms = json.load(f)
+        self._mapped = _map(os.path.join(path, f"{name}.post"))
+        self._postings = memoryview(self._mapped).cast("I") if self._mapped is not None else None
+
+    def postings(self, term: str):
+        """The flat doc id, term frequency, doc id, ... view of `term`'s postings, or None."""
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        start, count = entry
+        return self._postings[2 * start:2 * (start + count)]
+
+    @staticmethod
+    def write(path: str, name: str, postings: dict):
+        """Writes {term: [doc id, tf, doc id, tf, ...]} with the doc ids in increasing order."""
+        terms, pairs = {}, array("I")
+        for term in sorted(postings):
+            terms[term] = [len(pairs) // 2, len(postings[term]) // 2]
+            pairs.extend(postings[term])
+        _write_atomic(os.path.join(path, f"{name}.post"), pairs.tobytes())
+        _write_atomic(os.path.join(path, f"{name}.terms"), json.dumps(terms).encode("utf-8"))
+
+
+class LocalIndex:
+    """
+    An inverted index kept under the directory `path`, scored with BM25.
+
+    The documents are appended to `docs.jsonl`, with their byte offsets in
+    `docs.offsets` and their lengths in tokens in `lengths`; the postings live
+    in segment files. All of them are read through memory maps. `manifest.json`
+    records what has been committed and is replaced last on every change, so a
+    crashed `add` leaves the index as it was. One process at a time may add
+    documents; any number may search, and pick additions up on their next search.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75, max_segments: int = 8):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._manifest_mtime = None
+        self._norm_cache = None
+        os.makedirs(path, exist_ok=True)
+        for name in ("docs.jsonl", "docs.offsets", "lengths"):
+            open(os.path.join(path, name), "ab").close()
+        self._open()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _open(self):
+        try:
+            self._manifest_mtime = os.stat(self._file("manifest.json")).st_mtime_ns
+            with open(self._file("manifest.json")) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {"documents": 0, "docs_bytes": 0, "total_length": 0, "segments": [], "next_segment": 0}
+        self._manifest = manifest
+        self._segments = [_Segment(self.path, name) for name in manifest["segments"]]
+        self._docs = _map(self._file("docs.jsonl"))
+        offsets, lengths = _map(self._file("docs.offsets")), _map(self._file("lengths"))
+        self._offsets = memoryview(offsets).cast("Q") if offsets is not None else ()
+        self._lengths = memoryview(lengths).cast("I") if lengths is not None else ()
+
+    def refresh(self):
+        """Reopens the index if another process has committed to it since it was opened."""
+        try:
+            mtime = os.stat(self._file("manifest.json")).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._manifest_mtime:
+            with self._lock:
+                self._open()
+
+    def __len__(self) -> int:
+        return self._manifest["documents"]
+
+    def add(self, documents: Iterable[dict]) -> int:
+        """Indexes documents with "url", "title" and "text" as a new segment. Returns how many."""
+        with self._lock:
+            manifest = dict(self._manifest)
+            first = doc_id = manifest["documents"]
+            # drop whatever an interrupted add appended past the committed state
+            for name, size in (("docs.jsonl", manifest["docs_bytes"]), ("docs.offsets", 8 * doc_id),
+                               ("lengths", 4 * doc_id)):
+                os.truncate(self._file(name), size)
+            postings, offsets, lengths = {}, array("Q"), array("I")
+            position = manifest["docs_bytes"]
+            with open(self._file("docs.jsonl"), "ab") as docs:
+                for document in documents:
+                    line = json.dumps({key: document.get(key) or "" for key in ("url", "title", "text")})
+                    data = (line + "\n").encode("utf-8")
+                    docs.write(data)
+                    offsets.append(position)
+                    position += len(data)
+                    tokens = tokenize(f"{document.get('title') or ''} {document.get('text') or ''}")
+                    lengths.append(len(tokens))
+                    counts = {}
+                    for token in tokens:
+                        counts[token] = counts.get(token, 0) + 1
+                    for token, count in counts.items():
+                        postings.setdefault(token, []).extend((doc_id, count))
+                    doc_id += 1
+            if doc_id == first:
+                return 0
+            with open(self._file("docs.offsets"), "ab") as f:
+                f.write(offsets.tobytes())
+            with open(self._file("lengths"), "ab") as f:
+                f.write(lengths.tobytes())
+            name = f"seg-{manifest['next_segment']:06d}"
+            _Segment.write(self.path, name, postings)
+            manifest.update(
+                documents=doc_id, docs_bytes=position, total_length=manifest["total_length"] + sum(lengths),
+                segments=manifest["segments"] + [name], next_segment=manifest["next_segment"] + 1,
+            )
+            self._commit(manifest)
+        if len(self._segments) > self.max_segments:
+            self.merge()
+        return doc_id - first
+
+    def merge(self):
+        """Rewrites all segments as one, so a search reads one posting list per term."""
+        with self._lock:
+            if len(self._segments) < 2:
+                return
+            postings = {}
+            for segment in self._segments:
+                for term in segment.terms:
+                    # segments hold increasing doc id ranges, so concatenating keeps them sorted
+                    postings.setdefault(term, array("I")).extend(segment.postings(term))
+            manifest = dict(self._manifest)
+            name = f"seg-{manifest['next_segment']:06d}"
+            _Segment.write(self.path, name, postings)
+            old = manifest["segments"]
+            manifest.update(segments=[name], next_segment=manifest["next_segment"] + 1)
+            self._commit(manifest)
+            # searches in flight keep reading the unlinked files through their maps
+            for stale in old:
+                for suffix in (".post", ".terms"):
+                    os.remove(self._file(stale + suffix))
+
+    def _commit(self, manifest: dict):
+        _write_atomic(self._file("manifest.json"), json.dumps(manifest).encode("utf-8"))
+        self._open()
+
+    def document(self, doc_id: int) -> dict:
+        start = self._offsets[doc_id]
+        end = self._offsets[doc_id + 1] if doc_id + 1 < len(self) else self._manifest["docs_bytes"]
+        return json.loads(self._docs[start:end])
+
+    def search(self, query: str, k: int = 5) -> List[tuple]:
+        """Returns the (doc id, score) of the `k` best matches for `query`, best first."""
+        self.refresh()
+        # one consistent view, even if an add or a merge commits meanwhile
+        segments, lengths, manifest = self._segments, self._lengths, self._manifest
+        documents = manifest["documents"]
+        if not documents:
+            return []
+        norms = self._norms(lengths, manifest)
+        k1 = self.k1
+        scores = {}
+        for term in set(tokenize(query)):
+            lists = [postings for postings in (segment.postings(term) for segment in segments) if postings]
+            frequency = sum(len(postings) for postings in lists) // 2
+            if not frequency:
+                continue
+            idf = math.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+            for postings in lists:
+                for doc_id, tf in zip(postings[0::2], postings[1::2]):
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (k1 + 1) / (tf + norms[doc_id])
+        return heapq.nlargest(k, scores.items(), key=itemgetter(1))
+
+    def _norms(self, lengths, manifest: dict) -> list:
+        # the length normalization of every document, recomputed once per commit
+        # since the average length moves with every add
+        cached = self._norm_cache
+        if cached is None or cached[0] is not manifest:
+            average_length = manifest["total_length"] / manifest["documents"] or 1.0
+            k1, b = self.k1, self.b
+            cached = self._norm_cache = (
+                manifest, [k1 * (1 - b + b * length / average_length) for length in lengths]
+            )
+        return cached[1]
+
+    def stats(self) -> dict:
+        return {
+            "documents": len(self),
+            "segments": len(self._segments),
+            "terms": sum(len(segment.terms) for segment in self._segments),
+            "average_length": self._manifest["total_length"] / len(self) if len(self) else 0.0,
+        }
+
+
+def snippet(text: str, query: str, max_chars: int = 400) -> str:
+    """The sentences of `text` that best match `query`, starting from the best one."""
+    terms = set(tokenize(query))
+    sentences = [sentence for sentence in _SENTENCE.split(text.strip()) if sentence]
+    if not sentences:
+        return ""
+    best = max(range(len(sentences)), key=lambda i: len(terms.intersection(tokenize(sentences[i]))))
+    picked = sentences[best]
+    for sentence in sentences[best + 1:]:
+        if len(picked) + 1 + len(sentence) > max_chars:
+            break
+        picked += " " + sentence
+    return picked[:max_chars]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_local_index(path: str) -> LocalIndex:
+    """Returns the process-wide index at `path`, opening it on first use."""
+    key = os.path.abspath(path)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = LocalIndex(path)
+        return index
+
+
+def _read_documents(paths: List[str]):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def main(args):
+    index = LocalIndex(args.index)
+    if args.command == "add":
+        print(f"added {index.add(_read_documents(args.files))} documents")
+        print(json.dumps(index.stats()))
+    elif args.command == "merge":
+        index.merge()
+        print(json.dumps(index.stats()))
+    else:
+        for doc_id, score in index.search(args.query, args.k):
+            document = index.document(doc_id)
+            print(f"{score:7.3f}  {document['title']}  {document['url']}")
+            print(f"         {snippet(document['text'], args.query, 200)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="index JSONL files of documents")
+    add.add_argument("index")
+    add.add_argument("files", nargs="+")
+    merge = commands.add_parser("merge", help="merge the index's segments into one")
+    merge.add_argument("index")
+    search = commands.add_parser("search", help="print the best matches for a query")
+    search.add_argument("index")
+    search.add_argument("query")
+    search.add_argument("-k", type=int, default=5)
+    main(parser.parse_args())
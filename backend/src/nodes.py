@@ -1,16 +1,34 @@
 
 from langchain_core.runnables import RunnableConfig
 from langchain_core.messages import AIMessage
+from langgraph.config import get_stream_writer
+from langgraph.graph import END
 from langgraph.types import Send
 
-from state import WebSearchState, ReflectionState, QueryGenerationState, OverallState
+from state import RESET, WebSearchState, ReflectionState, QueryGenerationState, OverallState, merge_sources
 
 
 from configuration import Configuration
-from tools_and_schemas import SearchQueryList, Reflection
-from utils import get_current_date, resolve_urls, get_citations, insert_citation_markers
+from answer_cache import get_answer_cache
+from blob_store import ResolvedResults, get_blob_store, offload, ref_tokens, release_run
+from cascade import escalation_reason, get_cascade_stats
+from budget import UsageCollector, add_usage, budget_report, plan_next_loop, track_usage
+from concurrency import fan_in_registry, fan_out_limiter
+from context import build_summaries, condense, count_tokens
+from dedup import dedupe_queries
+from hedging import get_hedger
+from page_fetch import get_page_fetcher
+import rate_limit
+from search_backends import get_search_backend
+from search_cache import get_search_cache
+from speculation import speculation_registry
+from tracing import local_span, span
+from tools_and_schemas import FollowUpGuess, SearchQueryList, Reflection
+from utils import get_current_date, get_date_bucket, resolve_urls, get_citations, insert_citation_markers, source_label
+from utils import expand_short_urls, ShortUrlExpander
 
 from prompts import (reflection_instructions,
+                     gap_detector_instructions,
                      answer_instructions,
                      web_research_instructions,
                      query_writer_instructions)
@@ -18,39 +36,324 @@ from prompts import (reflection_instructions,
 
 from utils import get_research_topic
 
-from langchain_openai import ChatOpenAI
-
-from google.genai import Client
+from clients import get_client_registry
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
 import os
+import time
+import uuid
+from typing import Callable, Optional
 
+# threads a pool may grow to when no process-wide cap bounds its searches; they are
+# started only as needed, and a search queued for a thread would count against its
+# fan-in deadline without any cap holding it back
+_UNCAPPED_POOL_SIZE = 256
 
-def generate_query(state: OverallState, config: RunnableConfig) -> QueryGenerationState:
-    """LangGraph node that generates a search query based on the User's questions
-    Args:
-        state: Current Graph state containing user's question
-        config: Configuration for the runnable, including LLM provider settings
+
+@functools.lru_cache(maxsize=None)
+def _pool(name: str, workers: int) -> concurrent.futures.ThreadPoolExecutor:
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+
+def _search_executor(configurable: Configuration) -> concurrent.futures.ThreadPoolExecutor:
+    """Runs the searches of branches that may be released before their search finishes."""
+    # a thread for every search the process-wide cap lets run, so searches wait for slots, not threads
+    return _pool("web_research", configurable.max_concurrent_searches or _UNCAPPED_POOL_SIZE)
+
+
+def _speculation_executor(configurable: Configuration) -> concurrent.futures.ThreadPoolExecutor:
+    """Guesses follow-up queries and runs their searches in the background of sync runs."""
+    return _pool("speculation", _UNCAPPED_POOL_SIZE)
+
+
+# the ids of the runs searching inside a `forgetting_runs` block; the graph runs its
+# nodes in copies of the caller's context, which share the set
+_searching_runs = contextvars.ContextVar("searching_runs", default=None)
+
+
+def forget_run(run_id: Optional[str]):
+    """
+    Cancels the late and speculative searches a run left behind, drops its
+    fan-ins and unpins its blobs.
+    """
+    fan_in_registry.forget_run(run_id)
+    speculation_registry.forget_run(run_id)
+    release_run(run_id)
+
+
+@contextlib.contextmanager
+def forgetting_runs():
+    """
+    Forgets the runs that searched inside the block once it exits, however
+    they ended. `finalize_answer` forgets the runs that reach it; this covers
+    the ones that are cancelled or fail first.
+    """
+    run_ids = set()
+    token = _searching_runs.set(run_ids)
+    try:
+        yield
+    finally:
+        _searching_runs.reset(token)
+        for run_id in run_ids:
+            forget_run(run_id)
+
+
+def _searching(state: WebSearchState):
+    run_ids = _searching_runs.get()
+    if run_ids is not None:
+        run_ids.add(state.get("run_id"))
+
+
+def _answer_cache(configurable: Configuration):
+    if not configurable.answer_cache_ttl:
+        return None
+    return get_answer_cache(
+        configurable.answer_cache_path,
+        configurable.answer_cache_ttl,
+        configurable.answer_cache_threshold,
+        configurable.answer_cache_size,
+    )
+
+
+def check_answer_cache(state: OverallState, config: RunnableConfig) -> OverallState:
+    """LangGraph node that answers a repeat question from the answer cache.
+
+    On a hit the cached answer and its sources go straight into the state and
+    the run ends; on a miss the research starts with `generate_query`.
     """
     configurable = Configuration.from_runnable_config(config)
+    cache = _answer_cache(configurable)
+    hit = cache.get(get_research_topic(state["messages"])) if cache else None
+    # every question starts a new run, which its spans and concurrency caps are keyed on,
+    # and which counts its loops, usage and metrics from zero on a thread's later questions too
+    update = {
+        "run_id": uuid.uuid4().hex,
+        "research_loop_count": 0,
+        "budget_exhausted": False,
+        "usage": {RESET: True},
+        "skipped_queries": [{RESET: True}],
+    }
+    if hit is None:
+        return {**update, "cited_sources": [], "metrics": {RESET: True, "answer_cache": {"hit": False}}}
+    # the cached sources keep the short urls of another run, so they are not gathered
+    return {
+        **update,
+        "messages": [AIMessage(content=hit["answer"])],
+        "cited_sources": hit["sources_gathered"],
+        "metrics": {RESET: True, "answer_cache": {"hit": True, "similarity": hit["similarity"],
+                                                  "topic": hit["topic"]}},
+    }
+
+
+async def acheck_answer_cache(state: OverallState, config: RunnableConfig) -> OverallState:
+    """Async twin of `check_answer_cache`; lookups are in memory, so it does not block."""
+    return check_answer_cache(state, config)
+
+
+def route_answer_cache(state: OverallState) -> str:
+    """LangGraph routing function ending the run on an answer cache hit."""
+    return END if state["metrics"]["answer_cache"]["hit"] else "generate_query"
+
+
+@local_span("query_prompt")
+def _query_generation_prompt(state: OverallState, configurable: Configuration) -> str:
+    # the run's wall-clock budget starts with each new question
+    state["run_started_at"] = time.time()
     if state.get("initial_search_query_count") is None:
         state["initial_search_query_count"] = configurable.number_of_initial_queries
 
-    llm = ChatOpenAI(
-        model=configurable.query_generator_model,
+    return query_writer_instructions.format(
+        current_date=get_current_date(),
+        research_topic=get_research_topic(state["messages"]),
+        number_queries=state["initial_search_query_count"]
+    )
+
+
+def _chat_model(model: str, configurable: Configuration):
+    return get_client_registry().chat_model(
+        model=model,
         temperature=1.0,
-        max_retries=2,
-        api_key="API_KEY"
+        # retries go through the shared rate limiter instead
+        max_retries=0,
+        api_key=os.getenv("OPENAI_API_KEY", "API_KEY"),
+        pool_size=configurable.http_pool_size,
     )
-    structured_llm = llm.with_structured_output(SearchQueryList)
-    current_date = get_current_date()
 
-    # Format the prompt
-    formatted_prompt = query_writer_instructions.format(
-        current_date=current_date,
-        research_topic=get_research_topic(state["messages"]),
-        number_queries=state["initial_search_query_count"]
+
+def _genai_client(configurable: Configuration):
+    return get_client_registry().genai_client(
+        api_key=os.getenv("GEMINI_API_KEY"),
+        pool_size=configurable.http_pool_size,
+    )
+
+
+def _hedged(node: str, configurable: Configuration, func):
+    # duplicates the call if it runs past the node's adaptive latency percentile
+    return get_hedger(node).call(
+        func, configurable.hedge_percentile, configurable.hedge_budget, configurable.hedge_min_samples
+    )
+
+
+async def _ahedged(node: str, configurable: Configuration, func):
+    return await get_hedger(node).acall(
+        func, configurable.hedge_percentile, configurable.hedge_budget, configurable.hedge_min_samples
+    )
+
+
+# completion tokens charged against a model's tokens/min until the response reports its usage
+_COMPLETION_TOKENS_ESTIMATE = 512
+
+
+def _limited(node: str, model: str, configurable: Configuration, prompt: str, func, actual_tokens=None,
+             **retry):
+    # queues the call for the model's shared rate limits and retries it on 429s and 5xx
+    return rate_limit.call(
+        rate_limit.get_rate_limiter(
+            *_provider_model(node, model), configurable.rate_limits, configurable.rate_limit_store
+        ),
+        func, node, count_tokens(prompt) + _COMPLETION_TOKENS_ESTIMATE, configurable.max_retries,
+        actual_tokens, **retry,
+    )
+
+
+async def _alimited(node: str, model: str, configurable: Configuration, prompt: str, func, actual_tokens=None,
+                    **retry):
+    return await rate_limit.acall(
+        rate_limit.get_rate_limiter(
+            *_provider_model(node, model), configurable.rate_limits, configurable.rate_limit_store
+        ),
+        func, node, count_tokens(prompt) + _COMPLETION_TOKENS_ESTIMATE, configurable.max_retries,
+        actual_tokens, **retry,
+    )
+
+
+def _provider_model(node: str, model: str) -> tuple:
+    return ("gemini" if node in ("web_research", "speculative_search") else "openai"), model
+
+
+def _llm_tokens(usage: UsageCollector):
+    # the tokens the usage collector records from here on, i.e. those of the call about to be made
+    before = usage.prompt_tokens + usage.completion_tokens
+    return lambda result: usage.prompt_tokens + usage.completion_tokens - before
+
+
+def _search_tokens(response):
+    metadata = getattr(response, "usage_metadata", None)
+    return getattr(metadata, "total_token_count", None)
+
+
+def _structured_call(node: str, model: str, schema, configurable: Configuration, prompt: str, usage,
+                     include_raw: bool = False, hedger: str = ""):
+    llm = _chat_model(model, configurable).with_structured_output(schema, include_raw=include_raw)
+    return _hedged(hedger or node, configurable, lambda: _limited(
+        node, model, configurable, prompt, lambda: llm.invoke(prompt), _llm_tokens(usage),
+    ))
+
+
+async def _astructured_call(node: str, model: str, schema, configurable: Configuration, prompt: str, usage,
+                            include_raw: bool = False, hedger: str = ""):
+    llm = _chat_model(model, configurable).with_structured_output(schema, include_raw=include_raw)
+    return await _ahedged(hedger or node, configurable, lambda: _alimited(
+        node, model, configurable, prompt, lambda: llm.ainvoke(prompt), _llm_tokens(usage),
+    ))
+
+
+def _cascaded(node: str, schema, configurable: Configuration, prompt: str, usage, check=None) -> tuple:
+    """
+    Calls `node`'s model for a `schema` output, trying its cascade model first
+    if it has one. Returns the output and the record of the cascade.
+    """
+    model = configurable.model_for(node)
+    small = configurable.cascade_models.get(node)
+    if not small:
+        return _structured_call(node, model, schema, configurable, prompt, usage), {"model": model}
+    start = time.perf_counter()
+    try:
+        # the small model is hedged on its own latency, not the large one's
+        result = _structured_call(node, small, schema, configurable, prompt, usage, True, f"{node}/{small}")
+        reason = escalation_reason(result, configurable.cascade_min_confidence, check)
+    except Exception as exc:
+        result, reason = None, f"error: {type(exc).__name__}"
+    small_seconds = time.perf_counter() - start
+    if reason is None:
+        saved = get_cascade_stats(node).record(None, small_seconds)
+        return result["parsed"], {"model": small, "escalated": False, "saved_s": saved}
+    start = time.perf_counter()
+    output = _structured_call(node, model, schema, configurable, prompt, usage)
+    saved = get_cascade_stats(node).record(reason, small_seconds, time.perf_counter() - start)
+    return output, {"model": model, "escalated": True, "reason": reason, "saved_s": saved}
+
+
+async def _acascaded(node: str, schema, configurable: Configuration, prompt: str, usage, check=None) -> tuple:
+    """Async twin of `_cascaded`."""
+    model = configurable.model_for(node)
+    small = configurable.cascade_models.get(node)
+    if not small:
+        return await _astructured_call(node, model, schema, configurable, prompt, usage), {"model": model}
+    start = time.perf_counter()
+    try:
+        result = await _astructured_call(node, small, schema, configurable, prompt, usage, True, f"{node}/{small}")
+        reason = escalation_reason(result, configurable.cascade_min_confidence, check)
+    except Exception as exc:
+        result, reason = None, f"error: {type(exc).__name__}"
+    small_seconds = time.perf_counter() - start
+    if reason is None:
+        saved = get_cascade_stats(node).record(None, small_seconds)
+        return result["parsed"], {"model": small, "escalated": False, "saved_s": saved}
+    start = time.perf_counter()
+    output = await _astructured_call(node, model, schema, configurable, prompt, usage)
+    saved = get_cascade_stats(node).record(reason, small_seconds, time.perf_counter() - start)
+    return output, {"model": model, "escalated": True, "reason": reason, "saved_s": saved}
+
+
+def _has_queries(result: SearchQueryList) -> bool:
+    return any(query.strip() for query in result.query)
+
+
+@local_span("query_dedup")
+def _query_generation_update(
+        state: OverallState, result: SearchQueryList, configurable: Configuration, usage, routed: dict
+) -> QueryGenerationState:
+    queries, suppressed = dedupe_queries(
+        result.query, state.get("search_query"), configurable.query_dedup_threshold
     )
-    result = structured_llm.invoke(formatted_prompt)
-    return {"query_list": result.query}
+    return {
+        "query_list": queries,
+        "suppressed_queries": suppressed,
+        "run_id": state.get("run_id") or uuid.uuid4().hex,
+        "run_started_at": state["run_started_at"],
+        "usage": usage.as_update(),
+        "metrics": {"generate_query": {"routing": routed}},
+    }
+
+
+def generate_query(state: OverallState, config: RunnableConfig) -> QueryGenerationState:
+    """LangGraph node that generates a search query based on the User's questions
+    Args:
+        state: Current Graph state containing user's question
+        config: Configuration for the runnable, including LLM provider settings
+    """
+    configurable = Configuration.from_runnable_config(config)
+    formatted_prompt = _query_generation_prompt(state, configurable)
+    with track_usage("generate_query", configurable.model_prices) as usage:
+        result, routed = _cascaded(
+            "generate_query", SearchQueryList, configurable, formatted_prompt, usage, _has_queries
+        )
+    return _query_generation_update(state, result, configurable, usage, routed)
+
+
+async def agenerate_query(state: OverallState, config: RunnableConfig) -> QueryGenerationState:
+    """Async twin of `generate_query`, awaiting the LLM instead of blocking a thread."""
+    configurable = Configuration.from_runnable_config(config)
+    formatted_prompt = _query_generation_prompt(state, configurable)
+    with track_usage("generate_query", configurable.model_prices) as usage:
+        result, routed = await _acascaded(
+            "generate_query", SearchQueryList, configurable, formatted_prompt, usage, _has_queries
+        )
+    return _query_generation_update(state, result, configurable, usage, routed)
 
 
 def continue_to_web_research(state: QueryGenerationState):
@@ -58,37 +361,139 @@ def continue_to_web_research(state: QueryGenerationState):
 
     This is used to spawn n number of web research nodes, one for each search query.
     """
+    # ids, and so short urls, follow on from the searches of a thread's earlier questions,
+    # whose sources are still gathered, like the follow-ups of a reflection do
+    ran = len(state.get("search_query") or [])
     return [
-        Send("web_research", {"search_query": search_query, "id": int(idx)})
+        Send("web_research", {
+            "search_query": search_query,
+            "id": ran + int(idx),
+            "run_id": state.get("run_id"),
+            "loop": 0,
+            "branches": len(state["query_list"]),
+            "max_research_loops": state.get("max_research_loops"),
+        })
         for idx, search_query in enumerate(state["query_list"])
     ]
 
-def web_research(state: WebSearchState, config: RunnableConfig) -> OverallState:
-    """LangGraph node that performs web research using the native Google Search API.
-    Args:
-         state: Current graph state containing the search query and research loop count
-         config: Configuration for the runnable, include search API settings
 
-    Returns:
-        Dictionary with state update, including sources gathered, research_loop_count, and
-        web_research_results
-    """
-    configurable = Configuration.from_runnable_config(config)
+def _web_research_request(state: WebSearchState, configurable: Configuration) -> dict:
     formatted_prompt = web_research_instructions.format(
         current_date=get_current_date(),
         research_topic=state["search_query"]
     )
-
-    genai_client = Client(api_key=os.getenv("GEMINI_API_KEY"))
-
-    response = genai_client.models.generate_content(
-        model=configurable.query_generator_model,
-        contents=formatted_prompt,
-        config={
+    return {
+        "model": configurable.model_for("web_research"),
+        "contents": formatted_prompt,
+        "config": {
             "tools": [{"google_search": {}}],
             "temperature": 0,
         },
+    }
+
+
+def _search_backend(configurable: Configuration):
+    return get_search_backend(
+        configurable.search_backend, configurable.search_index_path, configurable.search_results
+    )
+
+
+def _search_cache(configurable: Configuration):
+    if not configurable.search_cache_ttl:
+        return None
+    return get_search_cache(
+        configurable.search_cache_path,
+        configurable.search_cache_ttl,
+        configurable.search_cache_size,
+        configurable.search_cache_disk_size,
+    )
+
+
+def _blob_store(configurable: Configuration):
+    return get_blob_store(configurable.blob_store, configurable.blob_store_path, configurable.blob_ttl,
+                          configurable.blob_memory_bytes)
+
+
+def _research_results(state: OverallState, configurable: Configuration) -> dict:
+    # texts are read from the blob store only if they make it into the prompt;
+    # one evicted since, e.g. under a resumed checkpoint, is read as its digest
+    items = state["web_research_result"]
+    return {
+        "results": ResolvedResults(items, _blob_store(configurable), state.get("web_research_digest")),
+        "result_tokens": [ref_tokens(item) for item in items],
+    }
+
+
+def _page_fetcher(configurable: Configuration):
+    if not configurable.fetch_pages:
+        return None
+    return get_page_fetcher(
+        configurable.fetch_cache_path,
+        configurable.fetch_cache_ttl,
+        configurable.fetch_per_host,
+        configurable.fetch_timeout,
+        configurable.fetch_max_bytes,
+        configurable.fetch_cache_size,
+        configurable.fetch_private_hosts,
     )
+
+
+def _page_urls(response, configurable: Configuration) -> list:
+    # the distinct pages of the search, in the order Gemini ranked them
+    urls = []
+    for chunk in response.candidates[0].grounding_metadata.grounding_chunks or []:
+        if chunk.web.uri not in urls:
+            urls.append(chunk.web.uri)
+    return urls[:configurable.fetch_max_pages]
+
+
+def _fetch_pages(state: WebSearchState, configurable: Configuration, response):
+    """Fetches the pages behind the search's grounding chunks, if `fetch_pages` is set."""
+    fetcher = _page_fetcher(configurable)
+    if fetcher is None:
+        return None
+    urls = _page_urls(response, configurable)
+    with span("fetch_pages", "provider", pages=len(urls)):
+        return fetcher.fetch(urls, state["search_query"], configurable.fetch_chunk_tokens,
+                             configurable.fetch_top_chunks)
+
+
+async def _afetch_pages(state: WebSearchState, configurable: Configuration, response):
+    """Async twin of `_fetch_pages`."""
+    fetcher = _page_fetcher(configurable)
+    if fetcher is None:
+        return None
+    urls = _page_urls(response, configurable)
+    with span("fetch_pages", "provider", pages=len(urls)):
+        return await fetcher.afetch(urls, state["search_query"], configurable.fetch_chunk_tokens,
+                                    configurable.fetch_top_chunks)
+
+
+def _excerpt_sources(response, resolved_urls: dict, excerpts: list) -> tuple:
+    # the excerpts are cited like the search's own text, so that the answer can cite
+    # them and finalize_answer expands their short urls
+    titles = {chunk.web.uri: chunk.web.title for chunk in response.candidates[0].grounding_metadata.grounding_chunks}
+    lines, sources = [], []
+    for excerpt in excerpts:
+        label = source_label(titles.get(excerpt["url"]))
+        if label is None or excerpt["url"] not in resolved_urls:
+            # cited like the search's own chunks, which skip a source they cannot label
+            continue
+        source = {
+            "label": label,
+            "short_url": resolved_urls[excerpt["url"]],
+            "value": excerpt["url"],
+        }
+        lines.append(f"- {excerpt['text']} [{source['label']}]({source['short_url']})")
+        sources.append(source)
+    if not lines:
+        return "", []
+    return "\n\nPassages from the cited pages:\n" + "\n".join(lines), sources
+
+
+@local_span("citations")
+def _web_research_update(state: WebSearchState, response, configurable: Configuration, usage,
+                         fetched=None) -> OverallState:
     # resolve the urls to short urls for saving tokens and time
     resolved_urls = resolve_urls(
         response.candidates[0].grounding_metadata.grounding_chunks, state["id"]
@@ -96,48 +501,516 @@ def web_research(state: WebSearchState, config: RunnableConfig) -> OverallState:
 
     citations = get_citations(response, resolved_urls)
     modified_text = insert_citation_markers(response.text, citations)
-    sources_gathered = [item for citation in citations for item in citation["segments"]]
+    # a chunk cited by several supports is one source
+    sources_gathered = merge_sources([], [item for citation in citations for item in citation["segments"]])
+    update = {}
+    if fetched is not None:
+        if fetched["excerpts"]:
+            excerpts, sources = _excerpt_sources(response, resolved_urls, fetched["excerpts"])
+            modified_text += excerpts
+            sources_gathered = merge_sources(sources_gathered, sources)
+        update["fetched_pages"] = [{**page, "query": state["search_query"]} for page in fetched["pages"]]
 
     return {
+        **update,
         "sources_gathered": sources_gathered,
         "search_query": [state["search_query"]],
-        "web_research_result": [modified_text],
+        # the full text goes to the blob store; the state carries a reference
+        "web_research_result": [offload(_blob_store(configurable), modified_text, state.get("run_id"))],
+        # condensed once here, so later loops can reuse it instead of the full text
+        "web_research_digest": [condense(modified_text, configurable.digest_tokens)],
+        "usage": usage.as_update(),
     }
 
 
-def reflection(state: OverallState, config: RunnableConfig) -> ReflectionState:
+def _search_slot(state: WebSearchState, configurable: Configuration, node: str) -> dict:
+    if node == "speculative_search":
+        # speculative searches already hold a slot of their own
+        return {"run_id": None}
+    return {
+        "run_id": state.get("run_id"),
+        "per_run": configurable.max_concurrent_searches_per_run,
+        "per_process": configurable.max_concurrent_searches,
+    }
+
+
+def _search(state: WebSearchState, configurable: Configuration, request: dict, node: str = "web_research",
+            started: Optional[Callable] = None):
     """
-    LangGraph node that identifies knowledge gaps and generates potential follow-up series.
-    :param state:
-    :param config:
-    :return:
+    Runs the grounded search, from the cache when it can. Returns (response, is_fresh).
+    `started` is called once the search holds its slot, i.e. actually starts.
+    """
+    backend = _search_backend(configurable)
+    if backend is not None:
+        if started is not None:
+            started()
+        # other backends answer locally or cache for themselves
+        with span(f"search/{configurable.search_backend}", "provider"):
+            return backend.search(state["search_query"]), True
+    cache = _search_cache(configurable)
+    cache_key = (request["model"], state["search_query"], get_date_bucket())
+    response = cache.get(*cache_key) if cache else None
+    if response is not None:
+        return response, False
+    with fan_out_limiter.slot(**_search_slot(state, configurable, node)):
+        if started is not None:
+            started()
+        models = _genai_client(configurable).models
+        response = _hedged(node, configurable, lambda: _limited(
+            node, request["model"], configurable, request["contents"],
+            lambda: models.generate_content(**request), _search_tokens,
+        ))
+    if cache:
+        cache.put(*cache_key, response)
+    return response, True
+
+
+async def _asearch(state: WebSearchState, configurable: Configuration, request: dict,
+                   node: str = "web_research", started: Optional[Callable] = None):
+    """Async twin of `_search`."""
+    backend = _search_backend(configurable)
+    if backend is not None:
+        if started is not None:
+            started()
+        with span(f"search/{configurable.search_backend}", "provider"):
+            return await backend.asearch(state["search_query"]), True
+    cache = _search_cache(configurable)
+    cache_key = (request["model"], state["search_query"], get_date_bucket())
+    response = cache.get(*cache_key) if cache else None
+    if response is not None:
+        return response, False
+    async with fan_out_limiter.aslot(**_search_slot(state, configurable, node)):
+        if started is not None:
+            started()
+        models = _genai_client(configurable).aio.models
+        response = await _ahedged(node, configurable, lambda: _alimited(
+            node, request["model"], configurable, request["contents"],
+            lambda: models.generate_content(**request), _search_tokens,
+        ))
+    if cache:
+        cache.put(*cache_key, response)
+    return response, True
+
+
+def _fan_in(state: WebSearchState, configurable: Configuration):
+    if not state.get("branches") or (configurable.fan_in_quorum >= 1 and not configurable.fan_in_deadline):
+        return None
+    return fan_in_registry.get(
+        state.get("run_id"),
+        state.get("loop", 0),
+        state["branches"],
+        configurable.fan_in_quorum,
+        configurable.fan_in_deadline,
+    )
+
+
+def _skipped_update(state: WebSearchState, configurable: Configuration, fan_in, search) -> OverallState:
+    if configurable.late_searches == "fold":
+        # the next loop re-runs the query and picks this search up where it got to
+        fan_in_registry.keep_late(state.get("run_id"), state["search_query"], search)
+    else:
+        search.cancel()
+    deadline_passed = fan_in.deadline is not None and time.monotonic() >= fan_in.deadline
+    return {
+        "skipped_queries": [{
+            "query": state["search_query"],
+            "loop": state.get("loop", 0),
+            "reason": "deadline" if deadline_passed else "quorum",
+        }]
+    }
+
+
+def _searched_update(state: WebSearchState, configurable: Configuration, request: dict, searched,
+                     fetched=None) -> OverallState:
+    response, is_fresh = searched
+    usage = UsageCollector("web_research", configurable.model_prices)
+    if is_fresh:
+        usage.add_gemini(request["model"], response)
+    return _web_research_update(state, response, configurable, usage, fetched)
+
+
+def _speculating(state: WebSearchState, configurable: Configuration) -> bool:
+    # the branches of the last loop have no follow-ups left to guess
+    return configurable.speculate_follow_ups and state.get("loop", 0) + 1 < _max_research_loops(state, configurable)
+
+
+def _gap_prompt(state: WebSearchState, configurable: Configuration, update: OverallState) -> str:
+    return gap_detector_instructions.format(
+        search_query=state["search_query"],
+        number_queries=configurable.speculative_queries,
+        current_date=get_current_date(),
+        # the digest is short and keeps the cited sentences
+        result=update["web_research_digest"][0],
+    )
+
+
+def _guess_state(state: WebSearchState, query: str) -> WebSearchState:
+    return {"search_query": query, "run_id": state.get("run_id")}
+
+
+def _speculative_slot(state: WebSearchState, configurable: Configuration) -> dict:
+    # slots of their own, so speculation never holds up a branch
+    return {"run_id": f"{state.get('run_id')}/speculative", "per_run": configurable.max_speculative_searches}
+
+
+def _speculative_search(guess, state: WebSearchState, configurable: Configuration, request: dict):
+    with fan_out_limiter.slot(**_speculative_slot(state, configurable)):
+        if not guess.start():
+            return None
+        promoted = rate_limit.promotion.set(guess.promotion)
+        try:
+            return _search(state, configurable, request, "speculative_search")
+        finally:
+            rate_limit.promotion.reset(promoted)
+            guess.finished = time.monotonic()
+
+
+async def _aspeculative_search(guess, state: WebSearchState, configurable: Configuration, request: dict):
+    async with fan_out_limiter.aslot(**_speculative_slot(state, configurable)):
+        if not guess.start():
+            return None
+        promoted = rate_limit.promotion.set(guess.promotion)
+        try:
+            return await _asearch(state, configurable, request, "speculative_search")
+        finally:
+            rate_limit.promotion.reset(promoted)
+            guess.finished = time.monotonic()
+
+
+def _guess_and_search(state: WebSearchState, configurable: Configuration, prompt: str, speculative):
+    """
+    Guesses the follow-ups one branch's result points to, and starts their
+    searches. Speculation is best effort: a guess that fails is a miss.
+    """
+    model = configurable.model_for("speculate")
+    llm = _chat_model(model, configurable).with_structured_output(FollowUpGuess)
+    with track_usage("speculation", configurable.model_prices) as usage:
+        speculative.add_usage(usage)
+        try:
+            guessed = _limited("speculate", model, configurable, prompt, lambda: llm.invoke(prompt),
+                               _llm_tokens(usage))
+        except Exception:
+            return
+    for query in guessed.follow_up_queries[:configurable.speculative_queries]:
+        guess_state = _guess_state(state, query)
+        request = _web_research_request(guess_state, configurable)
+        speculative.add_search(query, request["model"], lambda guess: _speculation_executor(configurable).submit(
+            contextvars.copy_context().run, _speculative_search, guess, guess_state, configurable, request,
+        ))
+
+
+async def _aguess_and_search(state: WebSearchState, configurable: Configuration, prompt: str, speculative):
+    """Async twin of `_guess_and_search`."""
+    model = configurable.model_for("speculate")
+    llm = _chat_model(model, configurable).with_structured_output(FollowUpGuess)
+    with track_usage("speculation", configurable.model_prices) as usage:
+        speculative.add_usage(usage)
+        try:
+            guessed = await _alimited("speculate", model, configurable, prompt, lambda: llm.ainvoke(prompt),
+                                      _llm_tokens(usage))
+        except Exception:
+            return
+    for query in guessed.follow_up_queries[:configurable.speculative_queries]:
+        guess_state = _guess_state(state, query)
+        request = _web_research_request(guess_state, configurable)
+        speculative.add_search(query, request["model"], lambda guess: asyncio.ensure_future(
+            _aspeculative_search(guess, guess_state, configurable, request)
+        ))
+
+
+def _speculate(state: WebSearchState, configurable: Configuration, update: OverallState):
+    """With `speculate_follow_ups`, starts guessing the branch's follow-ups in the background."""
+    if not _speculating(state, configurable):
+        return
+    speculative = speculation_registry.get(state.get("run_id"), state.get("loop", 0), configurable.model_prices)
+    speculative.add_detector(_speculation_executor(configurable).submit(
+        contextvars.copy_context().run, _guess_and_search, state, configurable,
+        _gap_prompt(state, configurable, update), speculative,
+    ))
+
+
+async def _aspeculate(state: WebSearchState, configurable: Configuration, update: OverallState):
+    """Async twin of `_speculate`; the guessing runs as a task of the run's event loop."""
+    if not _speculating(state, configurable):
+        return
+    speculative = speculation_registry.get(state.get("run_id"), state.get("loop", 0), configurable.model_prices)
+    speculative.add_detector(asyncio.ensure_future(
+        _aguess_and_search(state, configurable, _gap_prompt(state, configurable, update), speculative)
+    ))
+
+
+def _take_guess(state: WebSearchState, future_type: type, late) -> tuple:
+    """
+    The speculative search reflection matched to this branch's query, unless a
+    late search of the query is already running, and when the branch took it.
+    """
+    guess = speculation_registry.take(state.get("run_id"), state["search_query"], future_type)
+    if guess is not None and late is not None:
+        guess.abandon()
+        guess = None
+    return guess, time.monotonic()
+
+
+def _guessed(guess) -> Optional[tuple]:
+    """The result of a taken guess's finished search, or None if it failed, for the branch to search itself."""
+    future = guess.future
+    if future.cancelled() or future.exception() is not None:
+        return None
+    return future.result()
+
+
+def _settle_guess(state: WebSearchState, guess, taken: float):
+    speculation_registry.settle(state.get("run_id"), state.get("loop", 0),
+                                guess.saved(taken) if guess is not None else None)
+
+
+def web_research(state: WebSearchState, config: RunnableConfig) -> OverallState:
+    """LangGraph node that performs web research using the native Google Search API,
+    or the search backend selected by `search_backend`. With `fetch_pages`, the
+    pages behind the results are fetched and their best passages added.
+
+    With a fan-in quorum or deadline configured, the search runs on a worker
+    thread and the branch returns without a result once its loop is released,
+    recording the query in `skipped_queries`. With `speculate_follow_ups`, a
+    query reflection matched to a speculative search takes that search over,
+    and each branch starts guessing the next loop's follow-ups as it finishes.
+    Args:
+         state: Current graph state containing the search query and research loop count
+         config: Configuration for the runnable, include search API settings
+
+    Returns:
+        Dictionary with state update, including sources gathered, research_loop_count, and
+        web_research_results
+    """
+    configurable = Configuration.from_runnable_config(config)
+    _searching(state)
+    request = _web_research_request(state, configurable)
+    fan_in = _fan_in(state, configurable)
+    if fan_in is None:
+        guess, taken = _take_guess(state, concurrent.futures.Future, None)
+        if guess is not None:
+            concurrent.futures.wait([guess.future])
+        searched = _guessed(guess) if guess is not None else None
+    else:
+        search = fan_in_registry.take_late(state.get("run_id"), state["search_query"])
+        if not isinstance(search, concurrent.futures.Future):
+            search = None
+        guess, taken = _take_guess(state, concurrent.futures.Future, search)
+        if guess is not None:
+            search = guess.future
+        if search is not None:
+            # a late or speculative search is already running
+            fan_in.start()
+        else:
+            # in a copy of the branch's context, so the search's spans join the branch's
+            search = _search_executor(configurable).submit(
+                contextvars.copy_context().run, _search, state, configurable, request, "web_research", fan_in.start,
+            )
+        completed = fan_in.wait(search)
+        fan_in_registry.settle(state.get("run_id"), state.get("loop", 0), completed)
+        if not completed:
+            _settle_guess(state, None, taken)
+            return _skipped_update(state, configurable, fan_in, search)
+        searched = _guessed(guess) if guess is not None else search.result()
+    if searched is None:
+        # the speculative search failed; speculation is best effort, so this is a miss
+        guess = None
+        searched = _search(state, configurable, request)
+    _settle_guess(state, guess, taken)
+    update = _searched_update(state, configurable, request, searched,
+                              _fetch_pages(state, configurable, searched[0]))
+    _speculate(state, configurable, update)
+    return update
+
+
+async def aweb_research(state: WebSearchState, config: RunnableConfig) -> OverallState:
+    """Async twin of `web_research`, using the google-genai async client.
+
+    The branch waits for a slot under the per-run and per-process caps before
+    calling Gemini, so a large fan-out queues coroutines instead of threads.
     """
     configurable = Configuration.from_runnable_config(config)
+    _searching(state)
+    request = _web_research_request(state, configurable)
+    fan_in = _fan_in(state, configurable)
+    if fan_in is None:
+        guess, taken = _take_guess(state, asyncio.Future, None)
+        if guess is not None:
+            # waits without cancelling the search along with the branch, or raising its error
+            await asyncio.wait([guess.future])
+        searched = _guessed(guess) if guess is not None else None
+    else:
+        search = fan_in_registry.take_late(state.get("run_id"), state["search_query"])
+        if not isinstance(search, asyncio.Future) or search.get_loop() is not asyncio.get_running_loop():
+            search = None
+        guess, taken = _take_guess(state, asyncio.Future, search)
+        if guess is not None:
+            search = guess.future
+        if search is not None:
+            # a late or speculative search is already running
+            fan_in.start()
+        else:
+            search = asyncio.ensure_future(_asearch(state, configurable, request, "web_research", fan_in.start))
+        try:
+            completed = await fan_in.await_(search)
+        except asyncio.CancelledError:
+            search.cancel()
+            raise
+        fan_in_registry.settle(state.get("run_id"), state.get("loop", 0), completed)
+        if not completed:
+            _settle_guess(state, None, taken)
+            return _skipped_update(state, configurable, fan_in, search)
+        searched = _guessed(guess) if guess is not None else search.result()
+    if searched is None:
+        guess = None
+        searched = await _asearch(state, configurable, request)
+    _settle_guess(state, guess, taken)
+    update = _searched_update(state, configurable, request, searched,
+                              await _afetch_pages(state, configurable, searched[0]))
+    await _aspeculate(state, configurable, update)
+    return update
+
+
+def _skipped_this_loop(state: OverallState) -> list:
+    # branches of the loop being reflected on that the fan-in released unfinished
+    loop = state["research_loop_count"] - 1
+    return [skip["query"] for skip in state.get("skipped_queries") or [] if skip["loop"] == loop]
+
+
+@local_span("reflection_context")
+def _reflection_prompt(state: OverallState, configurable: Configuration):
     state["research_loop_count"] = state.get("research_loop_count", 0) + 1
-    reasoning_model = state.get("reasoning_model") or configurable.reasoning_model
 
+    # digests of earlier loops plus this loop's raw results, within the token budget
+    summaries, tokens = build_summaries(
+        digests=state.get("web_research_digest") or [],
+        fresh_from=state.get("number_of_ran_queries") or 0,
+        max_tokens=configurable.reflection_context_tokens,
+        separator="\n\n---\n\n",
+        **_research_results(state, configurable),
+    )
+    skipped = _skipped_this_loop(state)
+    if skipped:
+        summaries += (
+            "\n\n---\n\nThese searches did not finish in time and their results are missing: "
+            + "; ".join(skipped)
+        )
     current_date = get_current_date()
     formatted_prompt = reflection_instructions.format(
         current_date=current_date,
         research_topic=get_research_topic(state["messages"]),
-        summaries="\n\n---\n\n".join(state["web_research_result"])
+        summaries=summaries
     )
-    llm = ChatOpenAI(
-        model=configurable.query_generator_model,
-        temperature=1.0,
-        max_retries=2,
-        api_key="API_KEY"
+    prompt_tokens = count_tokens(formatted_prompt)
+    loop_metrics = {
+        "loop": state["research_loop_count"],
+        "prompt_tokens": prompt_tokens,
+        "unbounded_prompt_tokens":
+            prompt_tokens - tokens["summary_tokens"] + tokens["unbounded_summary_tokens"],
+    }
+    return formatted_prompt, loop_metrics
+
+
+def _is_consistent(result: Reflection) -> bool:
+    # a gap needs a follow-up to close it
+    return result.is_sufficient or any(query.strip() for query in result.follow_up_queries)
+
+
+def _max_research_loops(state: OverallState, configurable: Configuration) -> int:
+    return (
+        state.get("max_research_loops")
+        if state.get("max_research_loops") is not None
+        else configurable.max_research_loops
+    )
+
+
+def _claim_speculation(state: OverallState, configurable: Configuration, finishing: bool,
+                       follow_up_queries: list) -> tuple:
+    """
+    With `speculate_follow_ups`, hands the speculative searches that match the
+    follow-ups about to run to their branches and cancels the rest. Returns
+    the record of the claim, or None, and the usage of the speculation.
+    """
+    if not configurable.speculate_follow_ups:
+        return None, {}
+    if finishing or state["research_loop_count"] >= _max_research_loops(state, configurable):
+        follow_up_queries = []
+    return speculation_registry.claim(
+        state.get("run_id"), state["research_loop_count"] - 1, follow_up_queries,
+        configurable.speculation_match_threshold,
+    )
+
+
+def _reflection_update(
+        state: OverallState, result: Reflection, configurable: Configuration, loop_metrics: dict, usage
+) -> ReflectionState:
+    follow_up_queries = result.follow_up_queries
+    if configurable.late_searches == "fold":
+        # skipped searches go first, so that budget trimming keeps them
+        follow_up_queries = _skipped_this_loop(state) + follow_up_queries
+    # follow-ups often paraphrase queries that already ran in an earlier loop
+    follow_up_queries, suppressed = dedupe_queries(
+        follow_up_queries, state["search_query"], configurable.query_dedup_threshold
+    )
+    # drop the follow-ups, or the whole next loop, that would overrun the run's budget
+    kept_queries, budget_exhausted = plan_next_loop(
+        {**state, "usage": add_usage(state.get("usage"), usage.as_update())},
+        configurable,
+        follow_up_queries,
+    )
+    if result.is_sufficient:
+        kept_queries, budget_exhausted = follow_up_queries, False
+    speculation, speculated_usage = _claim_speculation(
+        state, configurable, result.is_sufficient or budget_exhausted, kept_queries
     )
-    result = llm.with_structured_output(Reflection).invoke(formatted_prompt)
+    if speculation is not None:
+        loop_metrics["speculation"] = speculation
     return {
         "is_sufficient": result.is_sufficient,
         "knowledge_gap": result.knowledge_gap,
-        "follow_up_queries": result.follow_up_queries,
-        "research_loop_count": result.research_loop_count,
-        "number_of_ran_queries": len(state["search_query"])
+        "follow_up_queries": kept_queries,
+        "suppressed_queries": suppressed,
+        "budget_exhausted": budget_exhausted,
+        "budget_trimmed_queries": follow_up_queries[len(kept_queries):],
+        # the guessing and the wasted speculative searches are charged to the loop they guessed for
+        "usage": add_usage(usage.as_update(), speculated_usage),
+        "research_loop_count": state["research_loop_count"],
+        "number_of_ran_queries": len(state["search_query"]),
+        "metrics": {
+            "reflection": {
+                "loops": (state.get("metrics") or {}).get("reflection", {}).get("loops", []) + [loop_metrics],
+            }
+        },
     }
 
 
+def reflection(state: OverallState, config: RunnableConfig) -> ReflectionState:
+    """
+    LangGraph node that identifies knowledge gaps and generates potential follow-up series.
+    :param state:
+    :param config:
+    :return:
+    """
+    configurable = Configuration.from_runnable_config(config)
+    formatted_prompt, loop_metrics = _reflection_prompt(state, configurable)
+    with track_usage("reflection", configurable.model_prices) as usage:
+        result, loop_metrics["routing"] = _cascaded(
+            "reflection", Reflection, configurable, formatted_prompt, usage, _is_consistent
+        )
+    return _reflection_update(state, result, configurable, loop_metrics, usage)
+
+
+async def areflection(state: OverallState, config: RunnableConfig) -> ReflectionState:
+    """Async twin of `reflection`."""
+    configurable = Configuration.from_runnable_config(config)
+    formatted_prompt, loop_metrics = _reflection_prompt(state, configurable)
+    with track_usage("reflection", configurable.model_prices) as usage:
+        result, loop_metrics["routing"] = await _acascaded(
+            "reflection", Reflection, configurable, formatted_prompt, usage, _is_consistent
+        )
+    return _reflection_update(state, result, configurable, loop_metrics, usage)
+
+
 def evaluate_search(state: ReflectionState, config: RunnableConfig,
 ) -> OverallState:
 
@@ -151,12 +1024,13 @@ def evaluate_search(state: ReflectionState, config: RunnableConfig,
     :return: A String literal indicating the next node to visit ("web_research" or "finalize_summary")
     """
     configurable = Configuration.from_runnable_config(config)
-    max_research_loops = (
-        state.get("max_research_loops")
-        if state.get("max_research_loops") is not None
-        else configurable.max_reseach_loops
-    )
-    if state["is_sufficient"] or state["research_loop_count"] >= max_research_loops:
+    max_research_loops = _max_research_loops(state, configurable)
+    if (
+            state["is_sufficient"]
+            or state["research_loop_count"] >= max_research_loops
+            or not state["follow_up_queries"]
+            or state.get("budget_exhausted")
+    ):
         return "finalize_answer"
     else:
         return [
@@ -164,65 +1038,168 @@ def evaluate_search(state: ReflectionState, config: RunnableConfig,
                 "web_research",
                 {
                     "search_query": follow_up_query,
-                    "id": state["number_of_ran_queries"] + int(idx)
+                    "id": state["number_of_ran_queries"] + int(idx),
+                    "run_id": state.get("run_id"),
+                    "loop": state["research_loop_count"],
+                    "branches": len(state["follow_up_queries"]),
+                    "max_research_loops": state.get("max_research_loops"),
                 },
             )
             for idx, follow_up_query in enumerate(state["follow_up_queries"])
         ]
 
 
-def finalize_answer(state: OverallState, config: RunnableConfig):
-    """Langgraph node that finalizes the research query
-    Prepares the final output by de-duplicating and formatting sources, then
-    combining them with the running summary to create a well-structured research
-    report with proper citations.
-    Args:
-        state: Current graph state containing the running summary and sources gathered.
-
-    Returns:
-        Dictionaries with state update, including running_summary key containing the
-        formatted final summary with sources.
-    """
-    configurable = Configuration.from_runnable_config(config)
-    reasoning_model = state.get("reasoning_model") or configurable.reasoning_model
+@local_span("answer_context")
+def _answer_prompt(state: OverallState, configurable: Configuration) -> str:
+    summaries, _ = build_summaries(
+        digests=state.get("web_research_digest") or [],
+        fresh_from=0,
+        max_tokens=configurable.answer_context_tokens,
+        separator="\n---\n\n",
+        **_research_results(state, configurable),
+    )
     current_date = get_current_date()
-    formatted_prompt = answer_instructions.format(
+    return answer_instructions.format(
         current_date=current_date,
         research_topic=get_research_topic(state["messages"]),
-        summaries="\n---\n\n".join(state["web_research_result"]),
-    )
-    llm = ChatOpenAI(
-        model=reasoning_model,
-        temperature=1.0,
-        max_retries=2,
-        api_key="API_KEY"
+        summaries=summaries,
     )
-    result = llm.invoke(formatted_prompt)
 
-    unique_sources = []
-    for source in state["sources_gathered"]:
-        if source["short_url"] in result.content:
-            result.content = result.content.replace(
-                source["short_url"], source["value"]
-            )
-            unique_sources.append(source)
+
+def _answer_llm(state: OverallState, configurable: Configuration):
+    reasoning_model = state.get("reasoning_model") or configurable.model_for("finalize_answer")
+    return _chat_model(reasoning_model, configurable)
+
+
+class _AnswerStream:
+    """
+    Collects the streamed answer, rewriting short urls as the tokens arrive.
+
+    Every rewritten piece is written to LangGraph's "custom" stream mode as
+    {"answer_token": ...}, preceded by one {"time_to_first_token": seconds}
+    event measured from the start of the node.
+    """
+
+    def __init__(self, state: OverallState):
+        self.expander = ShortUrlExpander(state["sources_gathered"])
+        self.writer = get_stream_writer()
+        self.started = time.perf_counter()
+        self.time_to_first_token = None
+        self.pieces = []
+
+    def _emit(self, text: str):
+        if text:
+            self.pieces.append(text)
+            self.writer({"answer_token": text})
+
+    def push(self, token):
+        if not isinstance(token, str) or not token:
+            return
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self.started
+            self.writer({"time_to_first_token": self.time_to_first_token})
+        self._emit(self.expander.feed(token))
+
+    def update(self) -> OverallState:
+        self._emit(self.expander.flush())
+        return {
+            "messages": [AIMessage(content="".join(self.pieces))],
+            "cited_sources": self.expander.cited_sources,
+            "metrics": {
+                "finalize_answer": {
+                    "time_to_first_token": self.time_to_first_token,
+                    "duration": time.perf_counter() - self.started,
+                }
+            },
+        }
+
+
+def _answer_update(state: OverallState, content: str) -> OverallState:
+    content, unique_sources = expand_short_urls(content, state["sources_gathered"])
 
     return {
-        "messages": [AIMessage(content=result.content)],
-        "sources_gathered": unique_sources,
+        "messages": [AIMessage(content=content)],
+        "cited_sources": unique_sources,
     }
 
 
+def _cache_answer(update: OverallState, state: OverallState, configurable: Configuration):
+    cache = _answer_cache(configurable)
+    if cache is not None:
+        cache.put(get_research_topic(state["messages"]), update["messages"][-1].content,
+                  update["cited_sources"])
 
 
+def _with_budget_report(update: OverallState, state: OverallState, configurable: Configuration, usage):
+    update["usage"] = usage.as_update()
+    final_state = {**state, "usage": add_usage(state.get("usage"), update["usage"])}
+    update["metrics"] = {**update.get("metrics", {}), "budget": budget_report(final_state, configurable)}
+    return update
 
 
+def finalize_answer(state: OverallState, config: RunnableConfig):
+    """Langgraph node that finalizes the research query
+    Prepares the final output by de-duplicating and formatting sources, then
+    combining them with the running summary to create a well-structured research
+    report with proper citations.
 
+    With `stream_answer` enabled, the answer is streamed token by token through
+    the "custom" stream mode with its short urls already rewritten.
+    Args:
+        state: Current graph state containing the running summary and sources gathered.
 
+    Returns:
+        Dictionaries with state update, including running_summary key containing the
+        formatted final summary with sources.
+    """
+    configurable = Configuration.from_runnable_config(config)
+    formatted_prompt = _answer_prompt(state, configurable)
+    # searches skipped in the last loop have nowhere left to go, and its texts are read
+    forget_run(state.get("run_id"))
+    llm = _answer_llm(state, configurable)
+    model = state.get("reasoning_model") or configurable.model_for("finalize_answer")
+    with track_usage("finalize_answer", configurable.model_prices) as usage:
+        if not configurable.stream_answer:
+            message = _limited("finalize_answer", model, configurable, formatted_prompt,
+                               lambda: llm.invoke(formatted_prompt), _llm_tokens(usage))
+            update = _answer_update(state, message.content)
+        else:
+            stream = _AnswerStream(state)
 
+            def answer():
+                for chunk in llm.stream(formatted_prompt):
+                    stream.push(chunk.content)
 
+            # once tokens have reached the client, a retry would repeat them
+            _limited("finalize_answer", model, configurable, formatted_prompt, answer, _llm_tokens(usage),
+                     can_retry=lambda exc: stream.time_to_first_token is None)
+            update = stream.update()
+    _cache_answer(update, state, configurable)
+    return _with_budget_report(update, state, configurable, usage)
 
 
+async def afinalize_answer(state: OverallState, config: RunnableConfig):
+    """Async twin of `finalize_answer`."""
+    configurable = Configuration.from_runnable_config(config)
+    formatted_prompt = _answer_prompt(state, configurable)
+    # searches skipped in the last loop have nowhere left to go, and its texts are read
+    forget_run(state.get("run_id"))
+    llm = _answer_llm(state, configurable)
+    model = state.get("reasoning_model") or configurable.model_for("finalize_answer")
+    with track_usage("finalize_answer", configurable.model_prices) as usage:
+        if not configurable.stream_answer:
+            message = await _alimited("finalize_answer", model, configurable, formatted_prompt,
+                                      lambda: llm.ainvoke(formatted_prompt), _llm_tokens(usage))
+            update = _answer_update(state, message.content)
+        else:
+            stream = _AnswerStream(state)
 
+            async def answer():
+                async for chunk in llm.astream(formatted_prompt):
+                    stream.push(chunk.content)
 
-
+            await _alimited("finalize_answer", model, configurable, formatted_prompt, answer, _llm_tokens(usage),
+                            can_retry=lambda exc: stream.time_to_first_token is None)
+            update = stream.update()
+    _cache_answer(update, state, configurable)
+    return _with_budget_report(update, state, configurable, usage)
@@ -0,0 +1,381 @@
+import asyncio
+import codecs
+import contextlib
+import html
+import ipaddress
+import json
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from html.parser import HTMLParser
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+from context import count_tokens
+from local_index import tokenize
+
+MAX_REDIRECTS = 5
+# elements whose text is never part of a page's main text
+SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg", "nav", "header", "footer", "aside", "form",
+                "button", "select", "iframe"}
+# elements that end a block of text
+BLOCK_TAGS = {"p", "div", "section", "article", "main", "li", "ul", "ol", "table", "tr", "td", "th", "br",
+              "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "dd", "dt", "figcaption"}
+
+
+class TextExtractor(HTMLParser):
+    """
+    Incremental extraction of a page's main text, fed the HTML as it arrives.
+
+    Text outside navigation, scripts and other boilerplate elements is split
+    into blocks at block-level tags. Blocks shorter than `min_words`, or mostly
+    made of link text like menus and tag clouds, are dropped. Finished blocks
+    are grouped into chunks of about `chunk_tokens` tokens, available from
+    `chunks` as soon as they are complete.
+    """
+
+    def __init__(self, chunk_tokens: int = 200, min_words: int = 6):
+        super().__init__(convert_charrefs=True)
+        self.chunk_tokens = chunk_tokens
+        self.min_words = min_words
+        self.chunks = []
+        self._skipping = []
+        self._text, self._link_chars, self._in_link = [], 0, 0
+        self._chunk, self._chunk_tokens = [], 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skipping.append(tag)
+        elif tag == "a":
+            self._in_link += 1
+        elif tag in BLOCK_TAGS:
+            self._end_block()
+
+    def handle_endtag(self, tag):
+        if self._skipping and tag == self._skipping[-1]:
+            self._skipping.pop()
+        elif tag == "a":
+            self._in_link = max(0, self._in_link - 1)
+        elif tag in BLOCK_TAGS:
+            self._end_block()
+
+    def handle_data(self, data):
+        if self._skipping:
+            return
+        self._text.append(data)
+        if self._in_link:
+            self._link_chars += len(data.strip())
+
+    def _end_block(self):
+        block = " ".join("".join(self._text).split())
+        link_chars, self._text, self._link_chars = self._link_chars, [], 0
+        if len(block.split()) < self.min_words or link_chars > len(block) / 2:
+            return
+        tokens = count_tokens(block)
+        if self._chunk and self._chunk_tokens + tokens > self.chunk_tokens:
+            self._end_chunk()
+        self._chunk.append(block)
+        self._chunk_tokens += tokens
+
+    def _end_chunk(self):
+        if self._chunk:
+            self.chunks.append(" ".join(self._chunk))
+        self._chunk, self._chunk_tokens = [], 0
+
+    def finish(self) -> List[str]:
+        self.close()
+        self._end_block()
+        self._end_chunk()
+        return self.chunks
+
+
+def rank_chunks(query: str, chunks: List[dict], top_k: int, k1: float = 1.2, b: float = 0.75) -> List[dict]:
+    """The `top_k` of `chunks` ({"text", ...}) that best match `query` by BM25, each with its "score"."""
+    terms = set(tokenize(query))
+    if not chunks or not terms:
+        return []
+    counted = []
+    for chunk in chunks:
+        counts = {}
+        for token in tokenize(chunk["text"]):
+            counts[token] = counts.get(token, 0) + 1
+        counted.append((sum(counts.values()), counts))
+    average_length = sum(length for length, _ in counted) / len(counted) or 1.0
+    frequency = {term: sum(1 for _, counts in counted if term in counts) for term in terms}
+    scored = []
+    for chunk, (length, counts) in zip(chunks, counted):
+        score = 0.0
+        for term in terms:
+            tf = counts.get(term)
+            if tf:
+                idf = math.log(1 + (len(chunks) - frequency[term] + 0.5) / (frequency[term] + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+        if score > 0:
+            scored.append({**chunk, "score": score})
+    return sorted(scored, key=lambda chunk: -chunk["score"])[:top_k]
+
+
+class PageFetcher:
+    """
+    Fetches and extracts the pages behind search results.
+
+    Requests go through one pooled httpx client, at most `per_host` at a time
+    to any host and `max_connections` overall, each within `timeout` seconds
+    and reading at most `max_bytes` of the body; the text is extracted while
+    the body streams in. Extracted pages are cached by URL and chunk size:
+    within `ttl` seconds a page is not requested again, and after that it is
+    revalidated with its ETag or Last-Modified, a 304 reusing the cached text.
+    Beyond `max_pages` entries the least recently fetched ones are evicted.
+    `path` names the SQLite file of the cache; without it the cache is kept in
+    memory. The per-host limits of the `max_hosts` most recently requested
+    hosts are kept, besides those of hosts with requests in flight.
+
+    Every hop, the first and each redirect, must be http(s) to a host that
+    resolves to public addresses only, so that a search result cannot point the
+    fetcher at the loopback, private or link-local services of the machine it
+    runs on. `allow_private` lifts that check, for tests against local servers.
+
+    The client and the cache live on an event loop thread of their own, so
+    sync and async callers on any loop share the same pool.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 24 * 3600, max_connections: int = 64,
+                 per_host: int = 4, timeout: float = 10.0, max_bytes: int = 2_000_000, max_pages: int = 10000,
+                 max_hosts: int = 1024, allow_private: bool = False):
+        self.path = path
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self._inserts = 0
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_hosts = max_hosts
+        self.allow_private = allow_private
+        self._stats = {"requests": 0, "fetched": 0, "cache_hits": 0, "not_modified": 0, "truncated": 0,
+                       "failed": 0, "bytes": 0}
+        # host -> [its semaphore, the requests holding or awaiting it], least recently used first
+        self._hosts = OrderedDict()
+        self._client = None
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False, isolation_level=None)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(pages)")]
+        if columns and "chunk_tokens" not in columns:
+            # a cache keyed by URL alone, from before chunk sizes were part of the key
+            self._db.execute("DROP TABLE pages")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " url TEXT NOT NULL, chunk_tokens INTEGER NOT NULL, final_url TEXT, etag TEXT, last_modified TEXT,"
+            " chunks TEXT NOT NULL, fetched REAL NOT NULL, PRIMARY KEY (url, chunk_tokens))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS pages_fetched ON pages (fetched)")
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="page-fetch", daemon=True)
+        self._thread.start()
+
+    def _http(self):
+        # imported and built on first use, on the fetcher's loop
+        import httpx
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                follow_redirects=False,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                headers={"User-Agent": "pro-search-agent/1.0", "Accept": "text/html,text/plain;q=0.9"},
+            )
+        return self._client
+
+    @contextlib.asynccontextmanager
+    async def _host_slot(self, url: str):
+        host = urlsplit(url).netloc
+        slot = self._hosts.get(host)
+        if slot is None:
+            slot = self._hosts[host] = [asyncio.Semaphore(self.per_host), 0]
+        self._hosts.move_to_end(host)
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            self._evict_hosts()
+
+    def _evict_hosts(self):
+        if len(self._hosts) <= self.max_hosts:
+            return
+        # a host with requests in flight keeps its semaphore, or a new one would let more through
+        for host in [host for host, slot in self._hosts.items() if not slot[1]]:
+            if len(self._hosts) <= self.max_hosts:
+                break
+            del self._hosts[host]
+
+    async def _check_target(self, location: str):
+        """Raises ValueError unless `location` is http(s) to a host with public addresses only."""
+        parts = urlsplit(location)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"refusing to fetch {location!r}: not an http(s) URL")
+        if self.allow_private:
+            return
+        infos = await self._loop.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        for info in infos:
+            address = ipaddress.ip_address(info[4][0].split("%")[0])
+            if not address.is_global:
+                raise ValueError(f"refusing to fetch {parts.hostname}: it resolves to {address}, not a public address")
+
+    async def _page(self, url: str, chunk_tokens: int) -> dict:
+        row = self._db.execute(
+            "SELECT final_url, etag, last_modified, chunks, fetched FROM pages WHERE url = ? AND chunk_tokens = ?",
+            (url, chunk_tokens),
+        ).fetchone()
+        if row is not None and time.time() - row[4] < self.ttl:
+            self._stats["cache_hits"] += 1
+            return {"url": url, "final_url": row[0], "status": "cached", "chunks": json.loads(row[3])}
+        headers = {}
+        if row is not None and row[1]:
+            headers["If-None-Match"] = row[1]
+        if row is not None and row[2]:
+            headers["If-Modified-Since"] = row[2]
+        page = await self._download(url, headers, chunk_tokens)
+        if page["status"] == "not_modified":
+            self._stats["not_modified"] += 1
+            self._db.execute("UPDATE pages SET fetched = ? WHERE url = ? AND chunk_tokens = ?",
+                             (time.time(), url, chunk_tokens))
+            return {**page, "final_url": row[0], "chunks": json.loads(row[3])}
+        self._db.execute(
+            "INSERT OR REPLACE INTO pages (url, chunk_tokens, final_url, etag, last_modified, chunks, fetched) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (url, chunk_tokens, page["final_url"], page.pop("etag"), page.pop("last_modified"),
+             json.dumps(page["chunks"]), time.time()),
+        )
+        self._evict()
+        return page
+
+    def _evict(self):
+        # counted every hundred inserts rather than on each one
+        self._inserts += 1
+        if not self.max_pages or self._inserts % 100:
+            return
+        excess = self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0] - self.max_pages
+        if excess > 0:
+            self._db.execute(
+                "DELETE FROM pages WHERE rowid IN (SELECT rowid FROM pages ORDER BY fetched LIMIT ?)", (excess,)
+            )
+
+    async def _download(self, url: str, headers: dict, chunk_tokens: int) -> dict:
+        # redirects are followed here rather than by httpx, so that every hop waits for
+        # a slot of its own host: search results all start at the same redirecting host
+        location = url
+        for _ in range(MAX_REDIRECTS + 1):
+            await self._check_target(location)
+            async with self._host_slot(location):
+                self._stats["requests"] += 1
+                # the timeout starts once the host has a slot, not while queueing for one
+                page = await asyncio.wait_for(self._request(url, location, headers, chunk_tokens), self.timeout)
+            if page["status"] != "redirect":
+                return page
+            location = page["location"]
+        raise ValueError(f"more than {MAX_REDIRECTS} redirects")
+
+    async def _request(self, url: str, location: str, headers: dict, chunk_tokens: int) -> dict:
+        async with self._http().stream("GET", location, headers=headers) as response:
+            if response.has_redirect_location:
+                return {"status": "redirect", "location": str(response.url.join(response.headers["location"]))}
+            return await self._extract(url, response, chunk_tokens)
+
+    async def _extract(self, url: str, response, chunk_tokens: int) -> dict:
+        if response.status_code == 304:
+            return {"url": url, "status": "not_modified"}
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "text/html")
+        if not content_type.startswith(("text/html", "application/xhtml", "text/plain")):
+            raise ValueError(f"unsupported content type {content_type.split(';')[0]}")
+        decoder = codecs.getincrementaldecoder(response.charset_encoding or "utf-8")(errors="replace")
+        extractor = TextExtractor(chunk_tokens)
+        plain = content_type.startswith("text/plain")
+        size, truncated = 0, False
+        body = response.aiter_bytes()
+        try:
+            async for data in body:
+                if size + len(data) > self.max_bytes:
+                    data, truncated = data[:self.max_bytes - size], True
+                size += len(data)
+                text = decoder.decode(data)
+                # plain text is a block per paragraph
+                extractor.feed(html.escape(text).replace("\n\n", "<p>") if plain else text)
+                if truncated:
+                    break
+        finally:
+            # closed here rather than whenever it is collected, which may be after the loop stops
+            await body.aclose()
+        tail = decoder.decode(b"", final=True)
+        extractor.feed(html.escape(tail) if plain else tail)
+        self._stats["fetched"] += 1
+        self._stats["bytes"] += size
+        self._stats["truncated"] += truncated
+        return {
+            "url": url, "final_url": str(response.url), "status": "truncated" if truncated else "fetched",
+            "chunks": extractor.finish(), "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+        }
+
+    async def _fetch(self, urls: List[str], query: str, chunk_tokens: int, top_k: int) -> dict:
+        async def one(url):
+            try:
+                return await self._page(url, chunk_tokens)
+            except Exception as exc:
+                self._stats["failed"] += 1
+                return {"url": url, "status": "failed", "chunks": [], "error": f"{type(exc).__name__}: {exc}"}
+
+        pages = await asyncio.gather(*(one(url) for url in urls))
+        chunks = [{"url": page["url"], "text": text} for page in pages for text in page["chunks"]]
+        return {
+            "pages": [{**page, "chunks": len(page["chunks"])} for page in pages],
+            "excerpts": rank_chunks(query, chunks, top_k),
+        }
+
+    def fetch(self, urls: List[str], query: str, chunk_tokens: int = 200, top_k: int = 3) -> dict:
+        """
+        Fetches `urls` concurrently and returns {"pages": the status of each,
+        "excerpts": the `top_k` chunks of all of them that best match `query`}.
+        """
+        return asyncio.run_coroutine_threadsafe(self._fetch(urls, query, chunk_tokens, top_k), self._loop).result()
+
+    async def afetch(self, urls: List[str], query: str, chunk_tokens: int = 200, top_k: int = 3) -> dict:
+        """Async twin of `fetch`; cancelling it cancels the requests."""
+        future = asyncio.run_coroutine_threadsafe(self._fetch(urls, query, chunk_tokens, top_k), self._loop)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        return dict(self._stats)
+
+    def close(self):
+        async def shutdown():
+            if self._client is not None:
+                await self._client.aclose()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._db.close()
+
+
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+
+def get_page_fetcher(path: Optional[str], ttl: float, per_host: int, timeout: float, max_bytes: int,
+                     max_pages: int = 10000, allow_private: bool = False) -> PageFetcher:
+    """Returns the process-wide fetcher for these settings, creating it on first use."""
+    key = (path or None, ttl, per_host, timeout, max_bytes, max_pages, allow_private)
+    with _fetchers_lock:
+        fetcher = _fetchers.get(key)
+        if fetcher is None:
+            fetcher = _fetchers[key] = PageFetcher(path or None, ttl, per_host=per_host, timeout=timeout,
+                                                   max_bytes=max_bytes, max_pages=max_pages,
+                                                   allow_private=allow_private)
+        return fetcher
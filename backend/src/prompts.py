@@ -15,6 +15,7 @@ Format:
 - Format your response as a JSON object with ALL three of these exact keys:
    - "rationale": Brief explanation of why these queries are relevant
    - "query": A list of search queries
+   - "confidence": How confident you are, from 0 to 1, that the queries cover the topic
 
 Example:
 
@@ -23,6 +24,7 @@ Topic: What revenue grew more last year apple stock or the number of people buyi
 {{
     "rationale": "To answer this comparative growth question accurately, we need specific data points on Apple's stock performance and iPhone sales metrics. These queries target the precise financial information needed: company revenue trends, product-specific unit sales figures, and stock price movement over the same fiscal period for direct comparison.",
     "query": ["Apple total revenue growth fiscal year 2024", "iPhone unit sales growth fiscal year 2024", "Apple stock price growth fiscal year 2024"],
+    "confidence": 0.9,
 }}
 ```
 
@@ -56,17 +58,19 @@ Requirements:
 - Ensure the follow-up query is self-contained and includes necessary context for web search.
 
 Output Format:
-- Format your response as a JSON object with these exact keys:
+- Format your response as a JSON object with ALL four of these exact keys:
    - "is_sufficient": true or false
    - "knowledge_gap": Describe what information is missing or needs clarification
    - "follow_up_queries": Write a specific question to address this gap
+   - "confidence": How confident you are, from 0 to 1, in this assessment
 
 Example:
 ```json
 {{
     "is_sufficient": true, // or false
     "knowledge_gap": "The summary lacks information about performance metrics and benchmarks", // "" if is_sufficient is true
-    "follow_up_queries": ["What are typical performance benchmarks and metrics used to evaluate [specific technology]?"] // [] if is_sufficient is true
+    "follow_up_queries": ["What are typical performance benchmarks and metrics used to evaluate [specific technology]?"], // [] if is_sufficient is true
+    "confidence": 0.8
 }}
 ```
 
@@ -77,6 +81,28 @@ Summaries:
 {summaries}
 """
 
+gap_detector_instructions = """You are a research assistant skimming one search result about "{search_query}" while the other searches of the research are still running.
+Instructions:
+- Guess the knowledge gaps a review of all the results would find in this one, and the follow-up queries it would ask to close them.
+- Don't produce more than {number_queries} queries.
+- Ensure each follow-up query is self-contained and includes necessary context for web search.
+- The current date is {current_date}.
+
+Output Format:
+- Format your response as a JSON object with this exact key:
+   - "follow_up_queries": A list of follow-up queries
+
+Example:
+```json
+{{
+    "follow_up_queries": ["What are typical performance benchmarks and metrics used to evaluate [specific technology]?"]
+}}
+```
+
+Search result:
+{result}
+"""
+
 answer_instructions = """Generate a high-quality answer to the user's question based on the provided summaries.
 
 Instructions:
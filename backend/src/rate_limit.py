@@ -0,0 +1,587 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import random
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Callable, Optional
+
+import tracing
+
+# lower runs first: in-flight sessions finish before new branches start, and
+# speculative follow-ups go out only when nothing else is waiting
+PRIORITIES = {"finalize_answer": 0, "reflection": 1, "generate_query": 1, "web_research": 2,
+              "speculate": 3, "speculative_search": 3}
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class Promotion:
+    """
+    Raises the calls made under it to another node's priority once `promote`d,
+    including those already queued: a speculative search a branch came to wait
+    on is no longer speculative.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.node = None
+        self._queued = []
+
+    def _track(self, limiter: "RateLimiter", entry: list):
+        with self._lock:
+            self._queued.append((limiter, entry))
+
+    def promote(self, node: str):
+        with self._lock:
+            self.node = node
+            queued, self._queued = self._queued, []
+        for limiter, entry in queued:
+            limiter._promote(entry, PRIORITIES.get(node, 1))
+
+
+# the promotion the calls of the current context are queued under, if any
+promotion = contextvars.ContextVar("promotion", default=None)
+
+
+def _status_and_retry_after(exc: BaseException):
+    """The HTTP status and Retry-After seconds of a provider error, when it carries them."""
+    # imported lazily, as in clients; by the time a provider call fails it is loaded anyway
+    import httpx
+
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    response = getattr(exc, "response", None)
+    if status is None and isinstance(response, httpx.Response):
+        status = response.status_code
+    retry_after = None
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        try:
+            retry_after = float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    return (status if isinstance(status, int) else None), retry_after
+
+
+def is_retryable(exc: BaseException) -> bool:
+    import httpx
+
+    status, _ = _status_and_retry_after(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # connection failures and timeouts from either SDK
+    return isinstance(exc, (httpx.TransportError, TimeoutError)) or type(exc).__name__ in (
+        "APIConnectionError", "APITimeoutError",
+    )
+
+
+class _Bucket:
+    def __init__(self, per_minute: float):
+        self.limit = per_minute
+        self.rate = per_minute / 60.0
+        # a second's worth of burst: providers enforce their limits over windows shorter than a minute
+        self.capacity = max(1.0, per_minute / 60.0)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        # a request larger than the bucket waits for a full bucket, then overdraws it
+        missing = min(amount, self.capacity) - self.level
+        return 0.0 if missing <= 0 else missing / self.rate
+
+
+class SharedBuckets:
+    """
+    The buckets of rate limiters kept in a SQLite file, so that every process
+    using the file, e.g. the workers of one job queue, draws on the same limits.
+
+    A row per limiter holds the levels of its request and token buckets, the
+    adaptive request rate and the end of a 429 pause. Each grant is a short
+    write transaction refilling the buckets by the wall-clock time since the
+    last one and taking from them, so a grant costs well under a millisecond
+    against calls that take hundreds.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            " name TEXT PRIMARY KEY, requests REAL, tokens REAL, requests_rate REAL,"
+            " updated REAL NOT NULL, paused_until REAL NOT NULL DEFAULT 0, granted INTEGER NOT NULL DEFAULT 0)"
+        )
+
+    def take(self, name: str, requests: Optional[_Bucket], tokens: Optional[_Bucket], amount: float) -> float:
+        """
+        Takes a request and `amount` tokens of `name`'s limits, given by the
+        limiter's local `requests` and `tokens` buckets. Returns 0 if it did, or
+        else how long until they would be there.
+        """
+        with self._lock:
+            db = self._db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = db.execute(
+                    "SELECT requests, tokens, requests_rate, updated, paused_until, granted FROM rate_limits"
+                    " WHERE name = ?",
+                    (name,),
+                ).fetchone()
+                if row is None:
+                    row = (None, None, None, now, 0.0, 0)
+                if now < row[4]:
+                    db.execute("COMMIT")
+                    return row[4] - now
+                shared = []
+                for bucket, level, rate in ((requests, row[0], row[2]), (tokens, row[1], None)):
+                    if bucket is None:
+                        shared.append(None)
+                        continue
+                    copy = _Bucket(bucket.limit)
+                    copy.level = copy.capacity if level is None else level
+                    copy.rate = min(copy.rate, rate) if rate else copy.rate
+                    copy.updated = row[3]
+                    copy.refill(now)
+                    shared.append(copy)
+                shared_requests, shared_tokens = shared
+                wait = max(
+                    shared_requests.wait_for(1) if shared_requests else 0.0,
+                    shared_tokens.wait_for(amount) if shared_tokens else 0.0,
+                )
+                if not wait:
+                    if shared_requests:
+                        shared_requests.level -= 1
+                    if shared_tokens:
+                        shared_tokens.level -= amount
+                db.execute(
+                    "INSERT OR REPLACE INTO rate_limits"
+                    " (name, requests, tokens, requests_rate, updated, paused_until, granted)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (name, shared_requests.level if shared_requests else None,
+                     shared_tokens.level if shared_tokens else None,
+                     shared_requests.rate if shared_requests else None, now, row[4], row[5] + (not wait)),
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return wait
+
+    def _update(self, sql: str, args: tuple):
+        with self._lock:
+            self._db.execute(sql, args)
+
+    def refund(self, name: str, tokens: float):
+        """Returns the request and `tokens` of a call that was granted but never made."""
+        self._update(
+            "UPDATE rate_limits SET requests = requests + 1, tokens = tokens + ?, granted = granted - 1"
+            " WHERE name = ?",
+            (tokens, name),
+        )
+
+    def settle(self, name: str, tokens: float):
+        self._update("UPDATE rate_limits SET tokens = tokens - ? WHERE name = ? AND tokens IS NOT NULL",
+                     (tokens, name))
+
+    def on_success(self, name: str, limit: float):
+        rate = limit / 60.0
+        self._update(
+            "UPDATE rate_limits SET requests_rate = MIN(?, requests_rate + ?) WHERE name = ? AND requests_rate < ?",
+            (rate, rate / 20, name, rate),
+        )
+
+    def on_rate_limited(self, name: str, pause: float, limit: float):
+        """Pauses every process's calls under `name` and halves their request rate."""
+        self._update(
+            "UPDATE rate_limits SET paused_until = MAX(paused_until, ?),"
+            " requests_rate = MAX(requests_rate / 2, ?) WHERE name = ?",
+            (time.time() + pause, limit / 60.0 / 20, name),
+        )
+
+    def stats(self) -> dict:
+        """Per limiter: the calls granted by every process, the current request rate and any 429 pause."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name, granted, requests_rate, paused_until FROM rate_limits"
+            ).fetchall()
+        now = time.time()
+        return {
+            name: {"granted": granted, "requests_per_minute": rate * 60 if rate else 0,
+                   "paused_s": max(0.0, paused_until - now)}
+            for name, granted, rate, paused_until in rows
+        }
+
+
+class RateLimiter:
+    """
+    Process-wide token buckets for one provider model, on requests and tokens per minute.
+
+    Callers queue by priority and take their requests and estimated tokens from
+    both buckets before calling the provider; the estimate is corrected with
+    the real usage afterwards. A 429 pauses the queue for its Retry-After (or a
+    jittered backoff) and halves the request rate, which then creeps back up by
+    a twentieth of the limit per success. A limit of 0 leaves that bucket open;
+    the queue still backs off on 429s.
+
+    A scheduler thread grants permits, so sync callers wait on an event and
+    async callers on a future of their own loop; a cancelled async caller
+    leaves the queue, or returns its permit if it was granted already. Once
+    `share`d, the buckets, the adaptive rate and 429 pauses live in a
+    `SharedBuckets` store instead, and the local buckets only carry the limits.
+    The store's transactions run outside the queue's lock, one at a time, so
+    callers enqueueing meanwhile do not wait on its file.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        self.name = name
+        self._cond = threading.Condition()
+        self._queue = []
+        self._order = itertools.count()
+        self._thread = None
+        # whether a thread is taking the queue head's permit from the shared store
+        self._taking = False
+        self.paused_until = 0.0
+        self._requests = None
+        self._tokens = None
+        self.configure(requests_per_minute, tokens_per_minute)
+        self.shared = None
+        self._waits = defaultdict(lambda: deque(maxlen=1024))
+        self._stats = {"granted": 0, "rate_limited": 0, "retries": 0}
+
+    def share(self, shared: Optional[SharedBuckets]):
+        with self._cond:
+            self.shared = shared
+            self._cond.notify_all()
+
+    def configure(self, requests_per_minute: float, tokens_per_minute: float):
+        with self._cond:
+            if (self._requests.limit if self._requests else 0) != requests_per_minute:
+                self._requests = _Bucket(requests_per_minute) if requests_per_minute else None
+            if (self._tokens.limit if self._tokens else 0) != tokens_per_minute:
+                self._tokens = _Bucket(tokens_per_minute) if tokens_per_minute else None
+            self._cond.notify_all()
+
+    def _grant_ready(self) -> Optional[float]:
+        """Grants queue heads that fit; returns how long until the head fits, if it does not."""
+        now = time.monotonic()
+        for bucket in (self._requests, self._tokens):
+            if bucket is not None:
+                bucket.refill(now)
+        while self._queue:
+            if now < self.paused_until:
+                return self.paused_until - now
+            entry = self._queue[0]
+            _, _, tokens, node, enqueued, grant = entry
+            if self.shared is not None:
+                if self._taking:
+                    # the thread taking it grants on until the head has to wait, then notifies
+                    return None
+                shared = self.shared
+                self._taking = True
+                self._cond.release()
+                try:
+                    wait = shared.take(self.name, self._requests, self._tokens, tokens)
+                finally:
+                    self._cond.acquire()
+                    self._taking = False
+                if wait > 0:
+                    return wait
+                # the entry may have moved while the lock was free, or left the queue on cancellation
+                if not self._dequeue(entry):
+                    self._cond.release()
+                    try:
+                        shared.refund(self.name, tokens)
+                    finally:
+                        self._cond.acquire()
+                    now = time.monotonic()
+                    continue
+            else:
+                wait = max(
+                    self._requests.wait_for(1) if self._requests else 0.0,
+                    self._tokens.wait_for(tokens) if self._tokens else 0.0,
+                )
+                if wait > 0:
+                    return wait
+                heapq.heappop(self._queue)
+                if self._requests:
+                    self._requests.level -= 1
+                if self._tokens:
+                    self._tokens.level -= tokens
+            self._waits[node].append(now - enqueued)
+            self._stats["granted"] += 1
+            grant()
+        return None
+
+    def _run(self):
+        with self._cond:
+            while True:
+                self._cond.wait(timeout=self._grant_ready())
+
+    def _enqueue(self, tokens: float, node: str, grant: Callable[[], None]):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"rate-limit-{self.name}", daemon=True)
+                self._thread.start()
+            promoted = promotion.get()
+            priority = PRIORITIES.get(promoted.node if promoted and promoted.node else node, 1)
+            entry = [priority, next(self._order), tokens, node, time.monotonic(), grant]
+            heapq.heappush(self._queue, entry)
+            if promoted is not None:
+                promoted._track(self, entry)
+            # a call that fits goes out right away, without a hop through the scheduler thread
+            self._grant_ready()
+            self._cond.notify_all()
+        return entry
+
+    def _dequeue(self, entry: list) -> bool:
+        """Removes `entry` from the queue; False if it has left it already."""
+        index = next((i for i, queued in enumerate(self._queue) if queued is entry), None)
+        if index is None:
+            return False
+        self._queue.pop(index)
+        heapq.heapify(self._queue)
+        return True
+
+    def _withdraw(self, entry: list):
+        """Drops the entry of a cancelled caller, or gives back its permit if it was granted."""
+        with self._cond:
+            if self._dequeue(entry):
+                self._cond.notify_all()
+                return
+            shared = self.shared
+            if shared is None:
+                if self._requests:
+                    self._requests.level += 1
+                if self._tokens:
+                    self._tokens.level += entry[2]
+                self._cond.notify_all()
+                return
+        shared.refund(self.name, entry[2])
+        with self._cond:
+            self._cond.notify_all()
+
+    def _promote(self, entry: list, priority: int):
+        with self._cond:
+            # a call already granted has left the queue
+            if priority >= entry[0] or not any(queued is entry for queued in self._queue):
+                return
+            entry[0] = priority
+            heapq.heapify(self._queue)
+            self._grant_ready()
+            self._cond.notify_all()
+
+    def acquire(self, tokens: float, node: str):
+        """Blocks until the call may go out."""
+        granted = threading.Event()
+        self._enqueue(tokens, node, granted.set)
+        granted.wait()
+
+    async def aacquire(self, tokens: float, node: str):
+        """Waits, without blocking the event loop, until the call may go out."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        entry = self._enqueue(tokens, node, grant)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            self._withdraw(entry)
+            raise
+
+    def settle(self, estimated: float, actual: Optional[float]):
+        """Charges the difference between the estimated and the reported tokens of a call."""
+        if actual is None or self._tokens is None:
+            return
+        with self._cond:
+            if self.shared is not None:
+                self.shared.settle(self.name, actual - estimated)
+                return
+            self._tokens.level -= actual - estimated
+
+    def on_retry(self):
+        with self._cond:
+            self._stats["retries"] += 1
+
+    def on_success(self):
+        with self._cond:
+            bucket = self._requests
+            if self.shared is not None:
+                if bucket is not None:
+                    self.shared.on_success(self.name, bucket.limit)
+                return
+            if bucket is not None and bucket.rate < bucket.limit / 60.0:
+                bucket.rate = min(bucket.limit / 60.0, bucket.rate + bucket.limit / 60.0 / 20)
+
+    def on_rate_limited(self, retry_after: Optional[float], attempt: int) -> float:
+        """Pauses the queue after a 429 and slows the request rate; returns the pause."""
+        # jitter the provider's hint too, so the callers it held back do not return at once
+        pause = retry_after * random.uniform(1.0, 1.1) if retry_after is not None else backoff(attempt)
+        with self._cond:
+            self._stats["rate_limited"] += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            if self.shared is not None:
+                self.shared.on_rate_limited(self.name, pause, self._requests.limit if self._requests else 0)
+            elif self._requests is not None:
+                self._requests.rate = max(self._requests.rate / 2, self._requests.limit / 60.0 / 20)
+            self._cond.notify_all()
+        return pause
+
+    def stats(self) -> dict:
+        """Grants, 429s, retries, the current request rate and the queue wait per node."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queued"] = len(self._queue)
+            stats["requests_per_minute"] = self._requests.rate * 60 if self._requests else 0
+            waits = {node: sorted(samples) for node, samples in self._waits.items() if samples}
+        stats["queue_wait"] = {
+            node: {
+                "count": len(samples),
+                "mean": sum(samples) / len(samples),
+                "p95": samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+                "max": samples[-1],
+            }
+            for node, samples in waits.items()
+        }
+        return stats
+
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _span_name(limiter: Optional[RateLimiter], node: str) -> str:
+    return limiter.name if limiter is not None else node
+
+
+def _record_wait(limiter: RateLimiter, queued: float):
+    # calls granted at once are the common case and not worth a span
+    now = time.time()
+    if now - queued > 1e-3:
+        tracing.record(f"{limiter.name} queue", "queue", queued, now)
+
+
+def call(
+        limiter: Optional[RateLimiter],
+        func: Callable[[], Any],
+        node: str,
+        estimated_tokens: float,
+        max_retries: int = 2,
+        actual_tokens: Optional[Callable[[Any], Optional[float]]] = None,
+        can_retry: Callable[[BaseException], bool] = lambda exc: True,
+):
+    """
+    Runs a provider call through the limiter, retrying retryable failures with
+    jittered backoff. The one retry loop replaces the clients' own, so retries
+    do not multiply across layers.
+    """
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            queued = time.time()
+            limiter.acquire(estimated_tokens, node)
+            _record_wait(limiter, queued)
+        try:
+            with tracing.span(_span_name(limiter, node), "provider", attempt=attempt):
+                result = func()
+        except Exception as exc:
+            if attempt == max_retries or not is_retryable(exc) or not can_retry(exc):
+                raise
+            time.sleep(_after_failure(limiter, exc, attempt))
+            continue
+        if limiter is not None:
+            limiter.on_success()
+            limiter.settle(estimated_tokens, actual_tokens(result) if actual_tokens else None)
+        return result
+
+
+async def acall(
+        limiter: Optional[RateLimiter],
+        func: Callable[[], Any],
+        node: str,
+        estimated_tokens: float,
+        max_retries: int = 2,
+        actual_tokens: Optional[Callable[[Any], Optional[float]]] = None,
+        can_retry: Callable[[BaseException], bool] = lambda exc: True,
+):
+    """Async twin of `call`; `func` makes a new awaitable on every attempt."""
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            queued = time.time()
+            await limiter.aacquire(estimated_tokens, node)
+            _record_wait(limiter, queued)
+        try:
+            with tracing.span(_span_name(limiter, node), "provider", attempt=attempt):
+                result = await func()
+        except Exception as exc:
+            if attempt == max_retries or not is_retryable(exc) or not can_retry(exc):
+                raise
+            await asyncio.sleep(_after_failure(limiter, exc, attempt))
+            continue
+        if limiter is not None:
+            limiter.on_success()
+            limiter.settle(estimated_tokens, actual_tokens(result) if actual_tokens else None)
+        return result
+
+
+def _after_failure(limiter: Optional[RateLimiter], exc: BaseException, attempt: int) -> float:
+    """How long to sleep before retrying a failed call."""
+    status, retry_after = _status_and_retry_after(exc)
+    if limiter is not None:
+        limiter.on_retry()
+        if status == 429:
+            # the limiter now holds every caller back, so this one re-queues right away
+            limiter.on_rate_limited(retry_after, attempt)
+            return 0.0
+    return retry_after if retry_after is not None else backoff(attempt)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_shared = {}
+
+
+def get_shared_buckets(path: str) -> SharedBuckets:
+    """Returns the process-wide connection to the rate limit store at `path`."""
+    with _limiters_lock:
+        shared = _shared.get(path)
+        if shared is None:
+            shared = _shared[path] = SharedBuckets(path)
+        return shared
+
+
+def get_rate_limiter(provider: str, model: str, limits: Optional[dict] = None, store: str = "") -> RateLimiter:
+    """
+    Returns the process-wide limiter of a provider model. `limits` maps model
+    names to (requests per minute, tokens per minute). With a `store`, the
+    limits are shared with the other processes using that SQLite file.
+    """
+    requests_per_minute, tokens_per_minute = (limits or {}).get(model, (0, 0))
+    shared = get_shared_buckets(store) if store else None
+    with _limiters_lock:
+        limiter = _limiters.get((provider, model))
+        if limiter is None:
+            limiter = _limiters[(provider, model)] = RateLimiter(
+                f"{provider}/{model}", requests_per_minute, tokens_per_minute
+            )
+    limiter.configure(requests_per_minute, tokens_per_minute)
+    if limiter.shared is not shared:
+        limiter.share(shared)
+    return limiter
+
+
+def rate_limit_stats() -> dict:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
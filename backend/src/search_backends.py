@@ -0,0 +1,96 @@
+import importlib
+import threading
+from typing import Any, Optional, Protocol
+from urllib.parse import urlparse
+
+from local_index import LocalIndex, get_local_index, snippet
+from search_cache import response_from_snapshot
+
+
+class SearchBackend(Protocol):
+    """
+    What web_research needs from a search provider other than Gemini.
+
+    Both methods return an object shaped like a grounded google-genai response:
+    a `text` and `candidates[0].grounding_metadata` with `grounding_chunks`
+    (each with `web.uri` and `web.title`) and `grounding_supports` (each with a
+    `segment` in UTF-8 byte offsets into the text and its
+    `grounding_chunk_indices`). `resolve_urls`, `get_citations` and
+    `insert_citation_markers` then turn it into sources and citations exactly
+    as they do Gemini's answers. A `usage_metadata` is recorded if present.
+    """
+
+    def search(self, query: str) -> Any: ...
+
+    async def asearch(self, query: str) -> Any: ...
+
+
+def _chunk_title(document: dict) -> str:
+    # Gemini's chunk titles are domains, and `get_citations` labels a source with the
+    # part before the first "."; the document title, or else the url's host, is the label
+    label = document["title"] or urlparse(document["url"]).hostname or "local"
+    return f"{label.replace('.', ' ').strip()}.local"
+
+
+class LocalSearchBackend:
+    """Answers a query with the best-matching passages of the documents in a `LocalIndex`."""
+
+    def __init__(self, index: LocalIndex, results: int = 5, snippet_chars: int = 400):
+        self.index = index
+        self.results = results
+        self.snippet_chars = snippet_chars
+
+    def search(self, query: str):
+        text, chunks, supports = "", [], []
+        for doc_id, _ in self.index.search(query, self.results):
+            document = self.index.document(doc_id)
+            passage = snippet(document["text"], query, self.snippet_chars)
+            if not passage:
+                continue
+            if text:
+                text += "\n\n"
+            start = len(text.encode("utf-8"))
+            text += f"{document['title']}: {passage}" if document["title"] else passage
+            # one support per passage, ending where its citation marker goes
+            supports.append({
+                "start_index": start,
+                "end_index": len(text.encode("utf-8")),
+                "has_segment": True,
+                "grounding_chunk_indices": [len(chunks)],
+            })
+            chunks.append({"uri": document["url"], "title": _chunk_title(document)})
+        if not chunks:
+            text = f"No documents in the local index match \"{query}\"."
+        return response_from_snapshot({"text": text, "grounding_chunks": chunks, "grounding_supports": supports})
+
+    async def asearch(self, query: str):
+        # a search takes well under the cost of handing it to a thread
+        return self.search(query)
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_search_backend(spec: str, index_path: str, results: int) -> Optional[SearchBackend]:
+    """
+    Returns the process-wide backend for `spec`: None for "gemini", whose
+    grounded search web_research runs itself, a `LocalSearchBackend` over the
+    index at `index_path` for "local", or for "package.module:factory" whatever
+    `factory(index_path, results)` returns.
+    """
+    if spec in ("", "gemini"):
+        return None
+    key = (spec, index_path, results)
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is None:
+            if spec == "local":
+                backend = LocalSearchBackend(get_local_index(index_path), results)
+            else:
+                module, _, factory = spec.partition(":")
+                if not factory:
+                    raise ValueError(f"search backend must be gemini, local or module:factory, got {spec!r}")
+                backend = getattr(importlib.import_module(module), factory)(index_path, results)
+            _backends[key] = backend
+        return backend
@@ -0,0 +1,207 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Optional
+
+from utils import normalize_query
+
+
+def snapshot_response(response) -> dict:
+    """
+    Extracts the text and the raw grounding metadata of a Gemini response.
+
+    Only the branch-independent parts are kept, so that `resolve_urls`,
+    `get_citations` and `insert_citation_markers` can be re-run with the branch
+    id of whichever request hits the cache.
+    """
+    chunks, supports = [], []
+    candidates = getattr(response, "candidates", None) or []
+    metadata = getattr(candidates[0], "grounding_metadata", None) if candidates else None
+    if metadata is not None:
+        for chunk in metadata.grounding_chunks or []:
+            web = getattr(chunk, "web", None)
+            chunks.append({
+                "uri": getattr(web, "uri", None),
+                "title": getattr(web, "title", None),
+            })
+        for support in metadata.grounding_supports or []:
+            segment = getattr(support, "segment", None)
+            supports.append({
+                "start_index": getattr(segment, "start_index", None) if segment else None,
+                "end_index": getattr(segment, "end_index", None) if segment else None,
+                "has_segment": segment is not None,
+                "grounding_chunk_indices": list(getattr(support, "grounding_chunk_indices", None) or []),
+            })
+    return {"text": response.text, "grounding_chunks": chunks, "grounding_supports": supports}
+
+
+def response_from_snapshot(snapshot: dict):
+    """Rebuilds a response object with the attributes the citation helpers read."""
+    chunks = [
+        SimpleNamespace(web=SimpleNamespace(uri=chunk["uri"], title=chunk["title"]))
+        for chunk in snapshot["grounding_chunks"]
+    ]
+    supports = [
+        SimpleNamespace(
+            segment=SimpleNamespace(start_index=support["start_index"], end_index=support["end_index"])
+            if support["has_segment"] else None,
+            grounding_chunk_indices=support["grounding_chunk_indices"],
+        )
+        for support in snapshot["grounding_supports"]
+    ]
+    metadata = SimpleNamespace(grounding_chunks=chunks, grounding_supports=supports)
+    return SimpleNamespace(
+        text=snapshot["text"],
+        candidates=[SimpleNamespace(grounding_metadata=metadata)],
+    )
+
+
+class SearchCache:
+    """
+    Two-tier cache of web_research grounding responses.
+
+    Entries are keyed on (model, normalized query, date bucket) and live in an
+    in-memory LRU tier backed, when `path` is given, by a SQLite tier that
+    survives restarts. Both tiers expire entries after `ttl` seconds and evict
+    the least recently used entries beyond their size limits.
+    """
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            ttl: float = 24 * 3600,
+            max_memory_entries: int = 1024,
+            max_disk_entries: int = 100_000,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._stats = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0,
+            "expired": 0, "evicted": 0, "writes": 0,
+        }
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def key(model: str, query: str, date_bucket: str) -> str:
+        return json.dumps([model, normalize_query(query), date_bucket])
+
+    def get(self, model: str, query: str, date_bucket: str) -> Optional[Any]:
+        """Returns a rebuilt response for the key, or None on a miss."""
+        key = self.key(model, query, date_bucket)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, snapshot = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return response_from_snapshot(snapshot)
+                del self._memory[key]
+                self._stats["expired"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created = row
+                    if now - created <= self.ttl:
+                        self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                        snapshot = json.loads(value)
+                        self._remember(key, created, snapshot)
+                        self._stats["disk_hits"] += 1
+                        return response_from_snapshot(snapshot)
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._stats["expired"] += 1
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, model: str, query: str, date_bucket: str, response) -> None:
+        """Stores the text and grounding metadata of a Gemini response."""
+        key = self.key(model, query, date_bucket)
+        snapshot = snapshot_response(response)
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, snapshot)
+            self._stats["writes"] += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(snapshot), now, now),
+                )
+                self._evict_disk(now)
+
+    def _remember(self, key: str, created: float, snapshot: dict):
+        self._memory[key] = (created, snapshot)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self._stats["evicted"] += 1
+
+    def _evict_disk(self, now: float):
+        expired = self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,)).rowcount
+        self._stats["expired"] += max(expired, 0)
+        (count,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_disk_entries:
+            evicted = self._db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (count - self.max_disk_entries,),
+            ).rowcount
+            self._stats["evicted"] += evicted
+
+    def stats(self) -> dict:
+        """Hit/miss counters, with the overall hit rate."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_search_cache(
+        path: Optional[str], ttl: float, max_memory_entries: int, max_disk_entries: int
+) -> SearchCache:
+    """Returns the process-wide cache for these settings, creating it on first use."""
+    key = (path or None, ttl, max_memory_entries, max_disk_entries)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = SearchCache(path or None, ttl, max_memory_entries, max_disk_entries)
+            _caches[key] = cache
+        return cache
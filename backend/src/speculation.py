@@ -0,0 +1,290 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Optional
+
+import dedup
+import rate_limit
+from budget import UsageCollector, add_usage
+from utils import normalize_query, percentile
+
+
+class Guess:
+    """A follow-up query guessed from one branch's result, and its speculative search."""
+
+    def __init__(self, query: str, model: str):
+        self.query = query
+        self.model = model
+        self.future = None
+        # the search's provider calls queue under it, to be raised once a branch takes it over
+        self.promotion = rate_limit.Promotion()
+        self._lock = threading.Lock()
+        self.abandoned = False
+        # set by the search itself, so they are known before anyone waiting on it wakes up
+        self.started = None
+        self.finished = None
+
+    def start(self) -> bool:
+        """Marks the search started once it has a slot, unless a branch already gave up on it."""
+        with self._lock:
+            if self.abandoned:
+                return False
+            self.started = time.monotonic()
+            return True
+
+    def abandon(self):
+        """Cancels the search; a thread already waiting for its slot skips it once it gets one."""
+        with self._lock:
+            self.abandoned = True
+        self.future.cancel()
+
+    def take(self) -> bool:
+        """
+        Hands the search to a branch if it has started, raising its calls to
+        the branch's priority; one still queued for a slot is abandoned, as the
+        branch's own search would not wait behind it.
+        """
+        with self._lock:
+            started = self.started is not None
+        if not started:
+            self.abandon()
+        else:
+            self.promotion.promote("web_research")
+        return started
+
+    def saved(self, taken: float) -> float:
+        """
+        The seconds the search had run, or taken in full, by the time a branch
+        took it over at `taken`, i.e. the latency that branch saved.
+        """
+        return min(self.finished or math.inf, taken) - self.started
+
+
+class SpeculativeLoop:
+    """
+    The follow-up searches started while the branches of one loop finish.
+
+    Each finished branch guesses the follow-ups reflection will ask from its
+    own result and starts their searches, until reflection claims the loop and
+    the buffer closes; guesses arriving after that are dropped.
+    """
+
+    def __init__(self, prices: Optional[dict] = None):
+        self.lock = threading.Lock()
+        self.closed = False
+        self.prices = prices
+        self.detectors = []
+        self.guesses = {}
+        self.usages = []
+
+    def add_detector(self, future: Any):
+        with self.lock:
+            if not self.closed:
+                self.detectors.append(future)
+                return
+        future.cancel()
+
+    def add_usage(self, usage: UsageCollector):
+        with self.lock:
+            self.usages.append(usage)
+
+    def add_search(self, query: str, model: str, start: Callable[[Guess], Any]) -> bool:
+        """
+        Starts the speculative search of a guessed query with `start`, which
+        returns its future, unless the loop is claimed or already has the query.
+        """
+        key = normalize_query(query)
+        with self.lock:
+            if self.closed or key in self.guesses:
+                return False
+            guess = self.guesses[key] = Guess(query, model)
+            guess.future = start(guess)
+            return True
+
+
+class SpeculationStats:
+    """
+    How speculation fares across runs: the share of reflection's follow-ups a
+    speculative search matched and was already running for when their branch
+    took it over (the hit rate), and the latency it saved, per search and per
+    loop.
+
+    A loop saves the difference between when its last branch would have
+    finished searching from scratch and when it did finish.
+    """
+
+    def __init__(self, window: int = 1024):
+        self._lock = threading.Lock()
+        self._counts = {"loops": 0, "guesses": 0, "follow_ups": 0, "matched": 0, "hits": 0, "cancelled": 0}
+        self._search_saved = deque(maxlen=window)
+        self._loop_saved = deque(maxlen=window)
+
+    def record_claim(self, guesses: int, follow_ups: int, matched: int, cancelled: int):
+        with self._lock:
+            self._counts["loops"] += 1
+            self._counts["guesses"] += guesses
+            self._counts["follow_ups"] += follow_ups
+            self._counts["matched"] += matched
+            self._counts["cancelled"] += cancelled
+
+    def record_hit(self, saved: float):
+        # a matched search that had not started by the time its branch ran is no hit
+        with self._lock:
+            self._counts["hits"] += 1
+            self._search_saved.append(saved)
+
+    def record_loop(self, saved: float):
+        with self._lock:
+            self._loop_saved.append(saved)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+            search_saved, loop_saved = list(self._search_saved), list(self._loop_saved)
+        return {
+            **counts,
+            "hit_rate": counts["hits"] / counts["follow_ups"] if counts["follow_ups"] else 0.0,
+            "guesses_used": counts["hits"] / counts["guesses"] if counts["guesses"] else 0.0,
+            "search_saved_p50_s": percentile(search_saved, 50),
+            "loop_saved_mean_s": sum(loop_saved) / len(loop_saved) if loop_saved else None,
+            "loop_saved_p50_s": percentile(loop_saved, 50),
+        }
+
+
+class SpeculationRegistry:
+    """
+    Holds the speculative searches of each (run, loop) until reflection's
+    follow-ups claim them, and hands the claimed ones to the next loop's
+    branches, like `FanInRegistry` does with the searches of released branches.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loops = {}
+        self._claimed = {}
+        self._timings = {}
+        self._stats = SpeculationStats()
+
+    def get(self, run_id: Optional[str], loop: int, prices: Optional[dict] = None) -> SpeculativeLoop:
+        with self._lock:
+            speculative = self._loops.get((run_id, loop))
+            if speculative is None:
+                speculative = self._loops[(run_id, loop)] = SpeculativeLoop(prices)
+            return speculative
+
+    def claim(self, run_id: Optional[str], loop: int, follow_ups: list, threshold: float) -> tuple:
+        """
+        Closes the loop's buffer and matches each follow-up to the guess it
+        repeats or paraphrases (at `threshold` similarity or above), for the
+        next loop's branches to `take`. Unmatched searches and unfinished
+        guessing are cancelled.
+
+        Returns the record of the claim and the usage of the speculation that
+        went to waste: the guessing, and the searches that finished unmatched.
+        """
+        with self._lock:
+            speculative = self._loops.pop((run_id, loop), None)
+        if speculative is None:
+            return {"guesses": 0, "follow_ups": len(follow_ups), "matched": []}, {}
+        with speculative.lock:
+            speculative.closed = True
+            detectors, guesses = speculative.detectors, dict(speculative.guesses)
+        for detector in detectors:
+            detector.cancel()
+
+        index = dedup.index_factory()
+        for guess in guesses.values():
+            index.add(guess.query)
+        matched, claimed = [], {}
+        for follow_up in follow_ups:
+            key = normalize_query(follow_up)
+            if key in guesses:
+                match, similarity = key, 1.0
+            else:
+                matches = [(normalize_query(query), similarity)
+                           for query, similarity in index.query(follow_up, threshold or 1.0)]
+                match, similarity = next(((key, s) for key, s in matches if key in guesses), (None, 0.0))
+            if match is None:
+                continue
+            guess = guesses.pop(match)
+            claimed[(run_id, follow_up)] = guess
+            matched.append({"query": follow_up, "guess": guess.query, "similarity": similarity})
+
+        wasted = UsageCollector("speculation", speculative.prices)
+        for guess in guesses.values():
+            guess.abandon()
+            if guess.future.done() and not guess.future.cancelled() and guess.future.exception() is None:
+                # an abandoned search returns None
+                searched = guess.future.result()
+                if searched is not None and searched[1]:
+                    wasted.add_gemini(guess.model, searched[0])
+        with self._lock:
+            self._claimed.update(claimed)
+            if follow_ups:
+                self._timings[(run_id, loop + 1)] = {"branches": len(follow_ups), "ends": []}
+        self._stats.record_claim(len(guesses) + len(matched), len(follow_ups), len(matched), len(guesses))
+        usage = wasted.as_update()
+        for collector in speculative.usages:
+            usage = add_usage(usage, collector.as_update())
+        return {"guesses": len(guesses) + len(matched), "follow_ups": len(follow_ups), "matched": matched}, usage
+
+    def take(self, run_id: Optional[str], query: str, future_type: type) -> Optional[Guess]:
+        """
+        Returns, and forgets, the speculative search claimed for this query, if
+        it has started and is a `future_type` the caller can wait on.
+        """
+        with self._lock:
+            guess = self._claimed.pop((run_id, query), None)
+        if guess is None:
+            return None
+        future = guess.future
+        if not isinstance(future, future_type) or (
+                isinstance(future, asyncio.Future) and future.get_loop() is not asyncio.get_running_loop()):
+            guess.abandon()
+            return None
+        return guess if guess.take() else None
+
+    def settle(self, run_id: Optional[str], loop: int, saved: Optional[float]):
+        """
+        Records that a branch of a claimed loop finished searching, having
+        saved `saved` seconds on a speculative search, or None for a miss.
+        """
+        if saved is not None:
+            self._stats.record_hit(saved)
+        now = time.monotonic()
+        with self._lock:
+            timing = self._timings.get((run_id, loop))
+            if timing is None:
+                return
+            timing["ends"].append((now, now + (saved or 0.0)))
+            if len(timing["ends"]) < timing["branches"]:
+                return
+            del self._timings[(run_id, loop)]
+        self._stats.record_loop(max(end for _, end in timing["ends"]) - max(end for end, _ in timing["ends"]))
+
+    def forget_run(self, run_id: Optional[str]):
+        """Cancels the speculation a finished run left behind."""
+        with self._lock:
+            loops = [self._loops.pop(key) for key in [key for key in self._loops if key[0] == run_id]]
+            claimed = [self._claimed.pop(key) for key in [key for key in self._claimed if key[0] == run_id]]
+            for key in [key for key in self._timings if key[0] == run_id]:
+                del self._timings[key]
+        for speculative in loops:
+            with speculative.lock:
+                speculative.closed = True
+                detectors, guesses = speculative.detectors, list(speculative.guesses.values())
+            for detector in detectors:
+                detector.cancel()
+            for guess in guesses:
+                guess.abandon()
+        for guess in claimed:
+            guess.abandon()
+
+    def stats(self) -> dict:
+        return self._stats.stats()
+
+
+# shared by every graph run in the process
+speculation_registry = SpeculationRegistry()
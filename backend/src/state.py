@@ -1,8 +1,67 @@
-from typing import TypedDict
+from typing import Optional, TypedDict
 from langgraph.graph import add_messages
 from typing_extensions import Annotated
 import operator
 
+from budget import add_usage
+
+
+# a key of an update that starts an accumulated value over instead of adding to it,
+# sent by the first node of every run so that a thread's later runs start from zero
+RESET = "__reset__"
+
+
+def resettable(reducer):
+    """Wraps a reducer of dicts so that an update carrying RESET replaces the value."""
+    def reduce(left: Optional[dict], right: Optional[dict]) -> dict:
+        if right and right.get(RESET):
+            return reducer({}, {key: value for key, value in right.items() if key != RESET})
+        return reducer(left, right)
+    return reduce
+
+
+def add_records(left: Optional[list], right: Optional[list]) -> list:
+    """Concatenates lists of records; an update starting with a RESET record replaces the list."""
+    if right and right[0].get(RESET):
+        return list(right[1:])
+    return (left or []) + (right or [])
+
+
+@resettable
+def merge_metrics(left: dict, right: dict) -> dict:
+    """Merges per-node metric dictionaries, the newer entry winning for each node."""
+    return {**(left or {}), **(right or {})}
+
+
+def merge_sources(left: Optional[list], right: Optional[list]) -> list:
+    """
+    State reducer appending source records, deduplicated by URL.
+
+    A grounding chunk is cited by many supports and the same page is found by
+    several branches, each under its own short url. The first record of a URL
+    is kept, and the short urls of later ones are added to its "aliases" so
+    the answer can cite the page under any of them.
+    """
+    merged = list(left or [])
+    by_url = {source["value"]: i for i, source in enumerate(merged)}
+    for source in right or []:
+        i = by_url.get(source["value"])
+        if i is None:
+            by_url[source["value"]] = len(merged)
+            merged.append(source)
+            continue
+        kept = merged[i]
+        short_urls = [source.get("short_url"), *source.get("aliases", [])]
+        new = [
+            url for url in short_urls
+            if url and url != kept.get("short_url") and url not in kept.get("aliases", [])
+        ]
+        if new:
+            # records in earlier checkpoints are shared, so never mutate them
+            merged[i] = {**kept, "aliases": [*kept.get("aliases", []), *new]}
+    return merged
+
+
 class OverallState(TypedDict):
     # messages have the type "list". `add_messages` function in the annotation
     # defines how this state key should be updated. Here it appends messages to
@@ -10,12 +69,40 @@ class OverallState(TypedDict):
     messages: Annotated[list, add_messages]
     # it appends new lists to the existing list via concatenation (+)
     search_query: Annotated[list, operator.add]
-    web_search_results = Annotated[list, operator.add]
-    sources_gathered = Annotated[list, operator.add]
+    # blob store references ({"blob": sha256, "tokens": n}) to the research texts,
+    # or the texts themselves when the blob store is "none"
+    web_research_result: Annotated[list, operator.add]
+    # every source the thread's searches found, which later answers can still cite
+    sources_gathered: Annotated[list, merge_sources]
+    # the sources the latest answer cites, replaced by every run
+    cited_sources: list
+    # a condensed digest of each entry of web_research_result, in the same order
+    web_research_digest: Annotated[list, operator.add]
     initial_search_query_count: int
     max_research_loops: int
+    # loops of the current run; usage, metrics and skipped_queries are per run too
     research_loop_count: int
     reasoning_model: str
+    # the number of search queries that had run at the last reflection
+    number_of_ran_queries: int
+    # queries dropped as near-duplicates before the web_research fan-out;
+    # each one is a search that did not have to run
+    suppressed_queries: Annotated[list, operator.add]
+    # per-node measurements, e.g. metrics["finalize_answer"]["time_to_first_token"]
+    metrics: Annotated[dict, merge_metrics]
+    # token usage and cost of every provider call, overall and per node
+    usage: Annotated[dict, resettable(add_usage)]
+    run_started_at: float
+    # set by reflection when the next loop would not fit the run's budget
+    budget_exhausted: bool
+    # follow-up queries dropped to keep the next loop within budget
+    budget_trimmed_queries: Annotated[list, operator.add]
+    # identifies the run so that its web_research branches can share a concurrency cap
+    run_id: str
+    # branches released before their search finished: {"query", "loop", "reason"}
+    skipped_queries: Annotated[list, add_records]
+    # the pages web_research fetched with `fetch_pages`: {"url", "query", "status", "chunks", ...}
+    fetched_pages: Annotated[list, operator.add]
 
 
 class Query(TypedDict):
@@ -25,19 +112,33 @@ class Query(TypedDict):
 
 class QueryGenerationState(TypedDict):
     query_list: list[Query]
+    run_id: str
+    # read when fanning out: the ids of the branches follow on from the thread's earlier searches
+    search_query: Annotated[list, operator.add]
+    max_research_loops: int
 
 
 class WebSearchState(TypedDict):
     search_query: str
     id: str
+    run_id: str
+    # the research loop that sent the branch, and how many branches it sent
+    loop: int
+    branches: int
+    # the run's own loop limit, if it set one
+    max_research_loops: Optional[int]
 
 
 class ReflectionState(TypedDict):
     is_sufficient: bool
     knowledge_gap: str
-    follow_up_queries: Annotated[list, operator.add]
+    # replaced on every loop, so that only the latest follow-ups are fanned out
+    follow_up_queries: list
     research_loop_count: int
     number_of_ran_queries: int
+    max_research_loops: int
+    budget_exhausted: bool
+    run_id: str
 
 
 
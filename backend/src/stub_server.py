@@ -0,0 +1,213 @@
+import json
+import random
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers OpenAI chat-completion and Gemini generateContent requests with canned
+    payloads. HTTP/1.1 keeps connections alive, like the real providers do.
+    """
+    protocol_version = "HTTP/1.1"
+    # buffer each response into a single write so delayed ACKs do not stall keep-alive calls
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        self.server.connections.add(self.client_address)
+        self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.path.endswith("/chat/completions"):
+            self._send_json(200, chat_completion(request.get("model", "stub")))
+        elif ":generateContent" in self.path:
+            self._send_json(200, generate_content())
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+
+class RateLimitedHandler(StubHandler):
+    """
+    A `StubHandler` that enforces a provider-style rate limit: past
+    `server.rate_limit` requests in a `server.rate_window` seconds fixed window,
+    requests get a 429 with a Retry-After header, counted in `server.rate_limited`.
+    """
+
+    def _over_limit(self) -> float:
+        # returns the seconds until the window resets when the request is over the limit
+        with self.server.window_lock:
+            now = time.monotonic()
+            if now - self.server.window_started >= self.server.rate_window:
+                self.server.window_started, self.server.window_requests = now, 0
+            self.server.window_requests += 1
+            if self.server.window_requests <= self.server.rate_limit:
+                return 0.0
+            self.server.rate_limited += 1
+            return self.server.window_started + self.server.rate_window - now
+
+    def do_POST(self):
+        retry_after = self._over_limit()
+        if not retry_after:
+            return super().do_POST()
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.server.requests += 1
+        error = {"code": 429, "message": "rate limit exceeded", "status": "RESOURCE_EXHAUSTED",
+                 "type": "rate_limit_error"}
+        self._send_json(429, {"error": error}, {"Retry-After": f"{retry_after:.3f}"})
+
+
+_PAGE_WORDS = (
+    "revenue growth market share quarter fiscal forecast analyst report supply chain demand pricing margin "
+    "segment outlook regulation competitor adoption benchmark latency hardware software services region"
+).split()
+
+
+def page_html(key: str, paragraphs: int = 12) -> str:
+    """A deterministic article page for `key`, wrapped in the usual navigation and script boilerplate."""
+    rng = random.Random(zlib.crc32(key.encode()))
+    body = "".join(
+        f"<p>{' '.join(rng.choice(_PAGE_WORDS) for _ in range(rng.randint(20, 60))).capitalize()}.</p>\n"
+        for _ in range(paragraphs)
+    )
+    return (
+        f"<!doctype html><html><head><title>Page {key}</title><style>p {{ margin: 0 }}</style>"
+        f"<script>var tracking = 'not text';</script></head><body>"
+        f"<nav><a href='/'>Home</a> <a href='/news'>News</a> <a href='/about'>About us and our team</a></nav>"
+        f"<article><h1>Report on {key}</h1>\n{body}</article>"
+        f"<footer>Copyright and cookie notice, all rights reserved, do not index this text.</footer>"
+        f"</body></html>"
+    )
+
+
+class PageHandler(StubHandler):
+    """
+    A `StubHandler` that also serves web pages over GET:
+
+    - `/pages/<key>`: the article of `page_html(key)`, with an ETag answered by 304s
+    - `/redirect/<key>`: a 302 to `/pages/<key>`, like the search results' redirect links
+    - `/large/<key>`: a page of `server.page_bytes` bytes, to exercise size caps
+
+    `?delay=<seconds>` holds the response back. `server.active_pages` and
+    `server.max_active_pages` count the page requests being served at once.
+    """
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        params = dict(part.split("=", 1) for part in query.split("&") if "=" in part)
+        with self.server.window_lock:
+            self.server.requests += 1
+            self.server.active_pages += 1
+            self.server.max_active_pages = max(self.server.max_active_pages, self.server.active_pages)
+        try:
+            time.sleep(float(params.get("delay", self.server.latency)))
+            kind, _, key = path.strip("/").partition("/")
+            if kind == "redirect":
+                self.send_response(302)
+                self.send_header("Location", f"/pages/{key}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif kind in ("pages", "large"):
+                etag = f'"{zlib.crc32(key.encode()):08x}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = page_html(key).encode()
+                if kind == "large":
+                    body = body * (self.server.page_bytes // len(body) + 1)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, e.g. at its size cap
+            pass
+        finally:
+            with self.server.window_lock:
+                self.server.active_pages -= 1
+
+
+def chat_completion(model: str, content: str = "stub answer") -> dict:
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+    }
+
+
+def generate_content(text: str = "stub search result.") -> dict:
+    return {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": text}]},
+            "finishReason": "STOP",
+            "groundingMetadata": {
+                "groundingChunks": [{"web": {"uri": "https://example.com/a", "title": "example.com"}}],
+                "groundingSupports": [{
+                    "segment": {"startIndex": 0, "endIndex": len(text)},
+                    "groundingChunkIndices": [0],
+                }],
+            },
+        }],
+        "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 5, "totalTokenCount": 15},
+    }
+
+
+@contextmanager
+def run_stub_server(handler=StubHandler, latency: float = 0.0, rate_limit: int = 0, rate_window: float = 60.0):
+    """Serves `handler` on a free localhost port and yields its base URL."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.rate_limit = rate_limit
+    server.rate_window = rate_window
+    server.rate_limited = 0
+    server.window_lock = threading.Lock()
+    server.window_started = time.monotonic()
+    server.window_requests = 0
+    server.requests = 0
+    server.connections = set()
+    server.active_pages = 0
+    server.max_active_pages = 0
+    server.not_modified = 0
+    server.page_bytes = 5_000_000
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}", server
+    finally:
+        server.shutdown()
+        server.server_close()
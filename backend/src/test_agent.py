@@ -1 +1,840 @@
-from agent import graph
+import asyncio
+import concurrent.futures
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+from langchain_core.messages import HumanMessage
+from langgraph.checkpoint.memory import InMemorySaver
+
+from agent import build_graph, graph
+from answer_cache import AnswerCache
+from batch import _asks, thread_id
+from blob_store import DiskBlobStore, MemoryBlobStore, ResolvedResults, get_blob_store, release_run
+
+from bench_cold_start import import_breakdown
+from budget import plan_next_loop
+from checkpoints import SqliteCheckpointer, checkpointer_from_env
+from cascade import get_cascade_stats
+from clients import ClientRegistry, set_client_registry
+from concurrency import FanIn, fan_in_registry
+from configuration import Configuration
+from dedup import dedupe_queries
+from fake_providers import FakeClientRegistry, LatencyModel
+import context
+import hedging
+import nodes
+from hedging import Hedger
+from nodes import _excerpt_sources, _speculating, forgetting_runs, web_research
+import rate_limit
+from rate_limit import Promotion, RateLimiter
+from page_fetch import PageFetcher
+from search_backends import get_search_backend
+from search_cache import SearchCache
+from speculation import Guess, speculation_registry
+from stub_server import PageHandler, run_stub_server
+from tracing import Tracer, analyze, get_tracer, load_events
+from utils import (ShortUrlExpander, byte_to_char_offsets, expand_short_urls, get_citations, resolve_urls,
+                   source_label)
+from workers import JobQueue
+
+
+def test_import_does_not_load_provider_sdks():
+    breakdown = import_breakdown("agent")
+    slowest = sorted(breakdown["modules"], key=lambda module: -module[2])[:10]
+    print(f"import agent: {breakdown['total_s'] * 1e3:.1f}ms")
+    for name, own, cumulative in slowest:
+        print(f"{name:<48} {own * 1e3:>9.1f} {cumulative * 1e3:>9.1f}")
+    assert breakdown["providers_loaded"] == []
+
+
+def test_client_registry_reuses_clients_and_their_connections():
+    with run_stub_server() as (url, server):
+        registry = ClientRegistry()
+        try:
+            llm = registry.chat_model("stub", api_key="API_KEY", base_url=f"{url}/v1")
+            assert registry.chat_model("stub", api_key="API_KEY", base_url=f"{url}/v1") is llm
+            assert registry.chat_model("other", api_key="API_KEY", base_url=f"{url}/v1") is not llm
+            for _ in range(4):
+                llm.invoke("hello")
+            client = registry.genai_client(api_key="API_KEY", base_url=url)
+            assert registry.genai_client(api_key="API_KEY", base_url=url) is client
+            for _ in range(3):
+                client.models.generate_content(model="stub", contents="hello")
+            stats = registry.stats()
+        finally:
+            registry.close()
+    # one keep-alive connection per provider served every call
+    assert stats["openai"] == {"requests": 4, "connections_opened": 1, "connections_reused": 3}
+    assert stats["gemini"] == {"requests": 3, "connections_opened": 1, "connections_reused": 2}
+    assert len(server.connections) == 2
+
+
+def test_configuration_is_shared_for_equal_configs():
+    first = Configuration.from_runnable_config({"configurable": {"max_research_loops": 3, "thread_id": "a"}})
+    second = Configuration.from_runnable_config({"configurable": {"max_research_loops": 3, "thread_id": "b"}})
+    other = Configuration.from_runnable_config({"configurable": {"max_research_loops": 4}})
+    assert first is second
+    assert other.max_research_loops == 4
+
+
+def test_local_search_backend_cites_like_gemini(tmp_path):
+    backend = get_search_backend("local", str(tmp_path), 5)
+    backend.index.add([
+        {"url": "https://wiki.internal/a", "title": "Café prices", "text": "Prices rose in Q3. Margins held."},
+        {"url": "https://wiki.internal/b", "title": "Churn", "text": "Churn fell once prices settled."},
+    ])
+    backend.index.add([{"url": "https://wiki.internal/c", "title": "Hiring", "text": "Headcount grew."}])
+    response = backend.search("margins prices")
+    resolved = resolve_urls(response.candidates[0].grounding_metadata.grounding_chunks, 7)
+    citations = get_citations(response, resolved)
+    assert [c["segments"][0]["value"] for c in citations] == ["https://wiki.internal/a", "https://wiki.internal/b"]
+    assert citations[0]["segments"][0]["label"] == "Café prices"
+    assert response.text[citations[0]["start_index"]:citations[0]["end_index"]].endswith("Margins held.")
+
+
+def test_search_cache_restores_responses_that_cite_identically(tmp_path):
+    text = "Café prices rose. Margins held."
+    chunks = [SimpleNamespace(web=SimpleNamespace(uri="https://vertex/a", title="a.example")),
+              SimpleNamespace(web=SimpleNamespace(uri="https://vertex/b", title="b.example"))]
+    supports = [
+        SimpleNamespace(segment=SimpleNamespace(start_index=0, end_index=len("Café prices rose.".encode())),
+                        grounding_chunk_indices=[0, 1]),
+        SimpleNamespace(segment=None, grounding_chunk_indices=[1]),
+    ]
+    metadata = SimpleNamespace(grounding_chunks=chunks, grounding_supports=supports)
+    response = SimpleNamespace(text=text, candidates=[SimpleNamespace(grounding_metadata=metadata)])
+    path = str(tmp_path / "search.sqlite")
+    cache = SearchCache(path)
+    cache.put("gemini", "cafe prices", "2026-10", response)
+    cache.close()
+
+    restored_cache = SearchCache(path)
+    restored = restored_cache.get("gemini", "Cafe  prices", "2026-10")
+    assert restored_cache.stats()["disk_hits"] == 1
+    restored_cache.close()
+
+    def cite(response):
+        return get_citations(response, resolve_urls(response.candidates[0].grounding_metadata.grounding_chunks, 3))
+    assert cite(restored) == cite(response) and cite(restored)
+    assert restored.text == text
+
+
+def test_next_loop_is_trimmed_to_the_searches_the_budget_still_covers():
+    usage = {"total_tokens": 600, "cost": 0.6, "by_node": {
+        "reflection": {"calls": 1, "total_tokens": 100, "cost": 0.1},
+        "web_research": {"calls": 2, "total_tokens": 400, "cost": 0.4},
+    }}
+    state = {"usage": usage, "research_loop_count": 1, "run_started_at": time.time()}
+    queries = [f"q{i}" for i in range(5)]
+
+    def plan(tokens=0, cost=0.0, seconds=0.0, state=state):
+        limits = SimpleNamespace(max_run_tokens=tokens, max_run_cost=cost, max_run_seconds=seconds)
+        return plan_next_loop(state, limits, queries)
+    assert plan() == (queries, False)
+    # 1500 tokens less the 600 spent and two reflections in reserve leave room for three 200-token searches
+    assert plan(tokens=1500) == (queries[:3], False)
+    assert plan(tokens=1500, cost=1.3) == (queries[:2], False)
+    assert plan(tokens=700) == ([], True)
+    assert plan(tokens=900) == ([], True)
+    # a loop as long as the first would overrun the time budget
+    assert plan(seconds=15, state={**state, "run_started_at": time.time() - 10}) == ([], True)
+    assert plan(seconds=30, state={**state, "run_started_at": time.time() - 10}) == (queries, False)
+
+
+def test_cached_searches_are_keyed_on_the_year_and_month(tmp_path):
+    path = str(tmp_path / "searches.sqlite")
+    previous = set_client_registry(FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0)))
+    try:
+        graph.invoke(
+            {"messages": [HumanMessage(content="How did margins change?")], "initial_search_query_count": 1},
+            {"configurable": {"thread_id": uuid.uuid4().hex, "blob_store": "memory", "search_cache_path": path,
+                              "search_cache_ttl": 3600, "max_research_loops": 1}},
+        )
+    finally:
+        set_client_registry(previous)
+    db = sqlite3.connect(path)
+    try:
+        keys = [json.loads(key) for (key,) in db.execute("SELECT key FROM responses")]
+    finally:
+        db.close()
+    # the same month of another year is another bucket
+    assert keys and {key[2] for key in keys} == {datetime.now().strftime("%Y-%m")}
+
+
+def test_trace_links_branches_to_their_sender(tmp_path):
+    trace_path = str(tmp_path / "trace.json")
+    previous = set_client_registry(FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0)))
+    try:
+        graph.invoke(
+            {"messages": [HumanMessage(content="How did margins change?")], "initial_search_query_count": 2},
+            {"configurable": {"thread_id": uuid.uuid4().hex, "trace_path": trace_path, "blob_store": "memory",
+                              "search_cache_ttl": 0, "max_research_loops": 1}},
+        )
+    finally:
+        set_client_registry(previous)
+    get_tracer(trace_path).flush()
+    events = load_events(trace_path)
+    branches = [e for e in events if e.get("cat") == "node" and e["name"] == "web_research"]
+    assert [e["args"]["parent_id"] for e in branches] == ["generate_query", "generate_query"]
+    assert any(e.get("cat") == "provider" and e["args"]["parent_id"] == "generate_query" for e in events)
+    [report] = analyze(events)
+    assert [step["span"].split(".")[0] for step in report["critical_path"]] == [
+        "check_answer_cache", "generate_query", "web_research", "reflection", "finalize_answer",
+    ]
+
+
+def test_processes_sharing_a_trace_file_write_one_header(tmp_path):
+    def flush(tracer, barrier):
+        barrier.wait()
+        tracer.flush()
+
+    # one tracer per process, all flushing their first batch at once; the race is retried on fresh files
+    for attempt in range(10):
+        path = str(tmp_path / f"trace{attempt}.json")
+        tracers = [Tracer(path) for _ in range(8)]
+        for i, tracer in enumerate(tracers):
+            tracer._buffer.append({"name": f"span {i}", "ph": "X", "ts": i, "dur": 1, "pid": i, "tid": 0})
+        barrier = threading.Barrier(len(tracers))
+        with concurrent.futures.ThreadPoolExecutor(len(tracers)) as pool:
+            list(pool.map(flush, tracers, [barrier] * len(tracers)))
+        with open(path, encoding="utf-8") as f:
+            assert f.read().count("[") == 1
+        assert sorted(event["pid"] for event in load_events(path)) == list(range(8))
+    assert len(os.listdir(tmp_path)) == 10
+
+
+def test_page_fetcher_caps_hosts_and_revalidates_its_cache():
+    with run_stub_server(PageHandler, latency=0.02) as (url, server):
+        fetcher = PageFetcher(per_host=2, max_bytes=50_000, allow_private=True)
+        try:
+            urls = [f"{url}/redirect/page-{i}" for i in range(6)] + [f"{url}/large/big"]
+            result = fetcher.fetch(urls, "pricing margin", top_k=3)
+            assert [page["status"] for page in result["pages"]] == ["fetched"] * 6 + ["truncated"]
+            assert server.max_active_pages == 2
+            assert len(result["excerpts"]) == 3 and "pricing" in result["excerpts"][0]["text"].lower()
+            assert {page["status"] for page in fetcher.fetch(urls[:2], "pricing")["pages"]} == {"cached"}
+            # pages are cached per chunk size, so another size never gets chunks of the wrong size
+            resized = fetcher.fetch(urls[:1], "pricing", chunk_tokens=50)["pages"]
+            assert [page["status"] for page in resized] == ["fetched"]
+            fetcher.ttl = 0
+            assert {page["status"] for page in fetcher.fetch(urls[:2], "pricing")["pages"]} == {"not_modified"}
+            assert server.not_modified == 2
+        finally:
+            fetcher.close()
+
+
+def test_page_fetcher_refuses_private_hosts_on_every_hop():
+    with run_stub_server(PageHandler, latency=0.0) as (url, server):
+        fetcher = PageFetcher(max_hosts=2)
+        check = fetcher._check_target
+
+        async def public_redirects(location):
+            # as if the search results' redirect host were a public one
+            if "/redirect/" not in location:
+                await check(location)
+
+        fetcher._check_target = public_redirects
+        try:
+            urls = [f"{url}/pages/direct", f"{url}/redirect/hop", "file:///etc/passwd"]
+            pages = fetcher.fetch(urls, "pricing")["pages"]
+            assert [page["status"] for page in pages] == ["failed"] * 3
+            assert "not a public address" in pages[1]["error"] and "not an http(s) URL" in pages[2]["error"]
+            # the redirect was followed up to the private hop, and no further
+            assert server.requests == 1
+
+            async def request(host):
+                async with fetcher._host_slot(f"http://{host}/"):
+                    pass
+
+            for host in ["a.example", "b.example", "c.example"]:
+                asyncio.run_coroutine_threadsafe(request(host), fetcher._loop).result()
+            assert list(fetcher._hosts) == ["b.example", "c.example"]
+        finally:
+            fetcher.close()
+
+
+def test_job_queue_claims_lapsed_jobs_again(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    assert queue.enqueue([{"id": "a", "question": "A?"}, {"id": "b", "question": "B?"}], max_attempts=2) == 2
+    assert queue.enqueue([{"id": "a", "question": "A?"}]) == 0
+    first = queue.claim("w1", visibility_timeout=0.05)
+    assert (first["id"], first["attempts"]) == ("a", 1)
+    time.sleep(0.1)
+    # a lapsed claim puts the job back in line behind the jobs queued before it lapsed
+    assert queue.claim("w2", visibility_timeout=60)["id"] == "b"
+    again = queue.claim("w2", visibility_timeout=60)
+    # a retry keeps the job's row, and so its checkpoint thread
+    assert (again["id"], again["attempts"], again["seq"]) == ("a", 2, first["seq"])
+    # the worker that lost the claim cannot complete the job
+    assert not queue.complete("a", "w1", {"id": "a", "status": "ok"})
+    assert queue.complete("a", "w2", {"id": "a", "status": "ok"})
+    assert queue.fail("b", "w2", "RuntimeError: boom", retry_at=0)
+    assert queue.claim("w2", visibility_timeout=60)["attempts"] == 2
+    assert queue.fail("b", "w2", "RuntimeError: boom", retry_at=0)
+    assert queue.claim("w2", visibility_timeout=60) is None
+    assert [(result["status"], result["attempts"]) for result in queue.results()] == [("ok", 2), ("error", 2)]
+
+
+def test_cascade_escalates_invalid_small_model_output():
+    previous = set_client_registry(FakeClientRegistry(
+        LatencyModel("constant", 0.0), LatencyModel("constant", 0.0),
+        model_options={"small-invalid": {"invalid_probability": 1.0}},
+    ))
+    configurable = {"thread_id": uuid.uuid4().hex, "blob_store": "memory", "search_cache_ttl": 0,
+                    "max_research_loops": 1, "query_generator_model": "large", "reflection_model": "reflector",
+                    "cascade_models": {"generate_query": "small-invalid", "reflection": "small"}}
+    try:
+        state = graph.invoke({"messages": [HumanMessage(content="How did margins change?")]},
+                             {"configurable": configurable})
+    finally:
+        set_client_registry(previous)
+    routing = state["metrics"]["generate_query"]["routing"]
+    assert (routing["model"], routing["escalated"], routing["reason"]) == ("large", True, "invalid")
+    [loop] = state["metrics"]["reflection"]["loops"]
+    assert (loop["routing"]["model"], loop["routing"]["escalated"]) == ("small", False)
+    assert get_cascade_stats("generate_query").stats()["reasons"]["invalid"] >= 1
+    assert Configuration.from_runnable_config({"configurable": configurable}).model_for("reflection") == "reflector"
+
+
+def test_speculative_searches_answer_predictable_follow_ups():
+    previous = set_client_registry(FakeClientRegistry(
+        LatencyModel("constant", 0.1), LatencyModel("constant", 0.1), predictable_follow_ups=1.0,
+        sufficient_probability=0.0, model_options={"guesser": {"latency": LatencyModel("constant", 0.0)}},
+    ))
+    configurable = {"thread_id": uuid.uuid4().hex, "blob_store": "memory", "search_cache_ttl": 0,
+                    "max_research_loops": 2, "speculate_follow_ups": True, "speculation_model": "guesser",
+                    # reflection may name the same gap twice
+                    "query_dedup_threshold": 0.8}
+    hits = speculation_registry.stats()["hits"]
+    try:
+        state = graph.invoke({"messages": [HumanMessage(content="How did margins change?")]},
+                             {"configurable": configurable})
+    finally:
+        set_client_registry(previous)
+    speculation = state["metrics"]["reflection"]["loops"][0]["speculation"]
+    assert speculation["follow_ups"] and len(speculation["matched"]) == speculation["follow_ups"]
+    assert speculation["guesses"] == 6
+    assert speculation_registry.stats()["hits"] - hits == speculation["follow_ups"]
+    assert state["usage"]["by_node"]["speculation"]["calls"] >= 3
+
+
+def test_dedupe_keeps_queries_on_different_years_and_entities():
+    kept, suppressed = dedupe_queries(
+        ["Apple total revenue fiscal year 2023", "Apple total revenue fiscal year 2024",
+         "Apple total revenue in fiscal year 2024", "Microsoft total revenue fiscal year 2024"],
+        ["apple total revenue, fiscal year 2023"],
+        threshold=0.8,
+    )
+    assert kept == ["Apple total revenue fiscal year 2024", "Microsoft total revenue fiscal year 2024"]
+    assert [(item["query"], item["duplicate_of"]) for item in suppressed] == [
+        ("Apple total revenue fiscal year 2023", "apple total revenue, fiscal year 2023"),
+        ("Apple total revenue in fiscal year 2024", "Apple total revenue fiscal year 2024"),
+    ]
+    # a capital starting the query names no entity
+    kept, suppressed = dedupe_queries(["Electric vehicle pricing trends 2024"],
+                                      ["electric vehicle pricing trends in 2024"], 0.8)
+    assert kept == [] and suppressed[0]["duplicate_of"] == "electric vehicle pricing trends in 2024"
+    kept, _ = dedupe_queries(["Tesla sales in the EU 2024"], ["Tesla sales in the US 2024"], 0.5)
+    assert kept == ["Tesla sales in the EU 2024"]
+    assert Configuration().query_dedup_threshold == 0
+
+
+def test_answer_cache_does_not_answer_another_year():
+    cache = AnswerCache(ttl=60)
+    cache.put("What was Apple total revenue in fiscal year 2023?", "ANSWER-2023", [])
+    assert cache.get("What was Apple total revenue in fiscal year 2024?") is None
+    assert cache.get("What was Microsoft total revenue in fiscal year 2023?") is None
+    hit = cache.get("What was Apple's total revenue in fiscal year 2023?")
+    assert hit["answer"] == "ANSWER-2023" and hit["similarity"] < 1
+    # rephrased, and in another case
+    cache.put("How did Apple revenue change in 2023?", "ANSWER-CHANGE", [])
+    assert cache.get("how did apple revenue change during 2023?")["answer"] == "ANSWER-CHANGE"
+    assert cache.get("Why did Apple revenue change in 2023?") is None
+
+
+def test_batch_threads_differ_per_question_and_config():
+    item = {"id": "1", "question": "What was Apple total revenue in fiscal year 2023?"}
+    other = {"id": "1", "question": "What was Apple total revenue in fiscal year 2024?"}
+    assert thread_id("batch", item, {}) == thread_id("batch", dict(item), {})
+    assert thread_id("batch", item, {}) != thread_id("batch", other, {})
+    assert thread_id("batch", item, {}) != thread_id("batch", item, {"max_research_loops": 1})
+    snapshot = SimpleNamespace(values={"messages": [HumanMessage(content=item["question"])]})
+    assert _asks(snapshot, item) and not _asks(snapshot, other)
+
+
+def test_graph_keeps_no_checkpoints_unless_asked(monkeypatch, tmp_path):
+    monkeypatch.delenv("CHECKPOINTER", raising=False)
+    assert checkpointer_from_env() is None
+    monkeypatch.setenv("CHECKPOINTER", "sqlite")
+    monkeypatch.setenv("CHECKPOINT_PATH", str(tmp_path / "checkpoints.sqlite"))
+    assert checkpointer_from_env() is not None
+
+
+def test_a_resumed_run_searches_only_the_branch_that_failed(tmp_path):
+    registry = FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0),
+                                  fail_on_calls=[2])
+    client = registry.genai_client()
+    respond, searched = client.response, []
+
+    def recorded(model, contents):
+        searched.append(contents)
+        return respond(model, contents)
+    client.response = recorded
+    graph = build_graph().compile(checkpointer=SqliteCheckpointer(str(tmp_path / "checkpoints.sqlite")))
+    config = {"configurable": {"thread_id": uuid.uuid4().hex, "blob_store": "memory", "search_cache_ttl": 0,
+                               "max_research_loops": 1, "number_of_initial_queries": 3}}
+
+    async def run():
+        try:
+            await graph.ainvoke({"messages": [HumanMessage(content="How did margins change?")]}, config)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("the second search should have failed the run")
+        failed, ran = searched[1], len(searched)
+        state = await graph.ainvoke(None, config)
+        return failed, searched[ran:], state
+    previous = set_client_registry(registry)
+    try:
+        failed, resumed, state = asyncio.run(run())
+    finally:
+        set_client_registry(previous)
+    # the branches that finished kept their writes; only the failed one searched again
+    assert resumed == [failed]
+    assert len(state["search_query"]) == 3 and state["messages"][-1].content
+
+
+def test_each_question_on_a_thread_counts_from_zero():
+    thread = build_graph().compile(checkpointer=InMemorySaver())
+    previous = set_client_registry(FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0)))
+    config = {"configurable": {"thread_id": uuid.uuid4().hex, "blob_store": "memory", "search_cache_ttl": 0,
+                               "max_research_loops": 2}}
+    try:
+        first = thread.invoke({"messages": [HumanMessage(content="How did margins change?")]}, config)
+        second = thread.invoke({"messages": [HumanMessage(content="And how did churn change?")]}, config)
+    finally:
+        set_client_registry(previous)
+    for state in (first, second):
+        assert 1 <= state["research_loop_count"] <= 2
+        assert len(state["metrics"]["reflection"]["loops"]) == state["research_loop_count"]
+        assert "__reset__" not in state["metrics"] and "__reset__" not in state["usage"]
+    # the second run's usage is its own, not added onto the first's
+    assert second["usage"]["by_node"]["generate_query"]["calls"] == 1
+
+
+def test_a_later_question_on_a_thread_cites_under_short_urls_of_its_own():
+    thread = build_graph().compile(checkpointer=InMemorySaver())
+    previous = set_client_registry(FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0)))
+    config = {"configurable": {"thread_id": uuid.uuid4().hex, "blob_store": "memory", "search_cache_ttl": 0,
+                               "max_research_loops": 1}}
+    try:
+        first = thread.invoke({"messages": [HumanMessage(content="How did margins change?")]}, config)
+        second = thread.invoke({"messages": [HumanMessage(content="And how did churn change?")]}, config)
+    finally:
+        set_client_registry(previous)
+    # the first question's sources are still gathered; no short url may stand for two pages
+    pages = {}
+    for source in second["sources_gathered"]:
+        for short_url in [source["short_url"], *source.get("aliases", [])]:
+            pages.setdefault(short_url, set()).add(source["value"])
+    assert len(second["sources_gathered"]) > len(first["sources_gathered"])
+    assert all(len(values) == 1 for values in pages.values())
+
+
+def test_final_sources_are_the_ones_the_answer_cites():
+    previous = set_client_registry(FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0)))
+    config = {"configurable": {"blob_store": "memory", "search_cache_ttl": 0, "max_research_loops": 1}}
+    try:
+        state = graph.invoke({"messages": [HumanMessage(content="How did segment margins change?")]}, config)
+    finally:
+        set_client_registry(previous)
+    answer = state["messages"][-1].content
+    cited = [source["value"] for source in state["cited_sources"]]
+    gathered = [source["value"] for source in state["sources_gathered"]]
+    assert cited and set(cited) < set(gathered)
+    assert all(url in answer for url in cited)
+    assert not [url for url in gathered if url in answer and url not in cited]
+
+
+def test_async_runs_share_one_process_cap_on_searches():
+    registry = FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.02))
+    client = registry.genai_client()
+    generate, active, peak = client._agenerate, [0], [0]
+
+    async def counted(*args, **kwargs):
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        try:
+            return await generate(*args, **kwargs)
+        finally:
+            active[0] -= 1
+    client._agenerate = counted
+
+    async def run(cap: int, question: str):
+        config = {"configurable": {"blob_store": "memory", "search_cache_ttl": 0, "max_research_loops": 2,
+                                   "number_of_initial_queries": 5, "max_concurrent_searches": cap}}
+        return await build_graph().compile().ainvoke({"messages": [HumanMessage(content=question)]}, config)
+
+    async def runs():
+        return await asyncio.gather(run(2, "How did margins change?"), run(3, "How did churn change?"),
+                                    run(3, "How did pricing change?"))
+    previous = set_client_registry(registry)
+    try:
+        states = asyncio.run(runs())
+    finally:
+        set_client_registry(previous)
+    assert all(len(state["search_query"]) >= 5 for state in states)
+    # the runs capped at 3 share the slots of the one capped at 2
+    assert peak[0] == 2
+
+
+def test_reflection_context_stays_in_budget_on_digests_made_once_per_result(monkeypatch):
+    condensed, summaries = [], []
+    condense, build_summaries = context.condense, nodes.build_summaries
+
+    def counted_condense(text, *args, **kwargs):
+        condensed.append(text)
+        return condense(text, *args, **kwargs)
+
+    def recorded_summaries(**kwargs):
+        text, tokens = build_summaries(**kwargs)
+        summaries.append((kwargs["max_tokens"], len(kwargs["results"]), tokens))
+        return text, tokens
+    monkeypatch.setattr(nodes, "condense", counted_condense)
+    monkeypatch.setattr(context, "condense", counted_condense)
+    monkeypatch.setattr(nodes, "build_summaries", recorded_summaries)
+    registry = FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0),
+                                  sufficient_probability=0.0)
+    previous = set_client_registry(registry)
+    config = {"configurable": {"blob_store": "memory", "search_cache_ttl": 0, "max_research_loops": 3,
+                               "reflection_context_tokens": 600, "answer_context_tokens": 0}}
+    try:
+        state = graph.invoke({"messages": [HumanMessage(content="How did segment margins change?")]}, config)
+    finally:
+        set_client_registry(previous)
+    reflections = [call for call in summaries if call[0] == 600]
+    assert len(reflections) == 3 and reflections[-1][1] > reflections[0][1]
+    # later loops would not fit unbounded; they stay within the budget all the same
+    assert reflections[-1][2]["unbounded_summary_tokens"] > 600
+    assert all(tokens["summary_tokens"] <= 600 for _, _, tokens in reflections)
+    # each result was condensed once, by its own branch, never again by a later loop
+    assert len(condensed) == len(state["web_research_result"]) == len(state["web_research_digest"])
+
+
+def test_fan_in_releases_on_quorum_or_on_a_deadline_from_the_first_search():
+    quorum = FanIn(branches=4, quorum=0.5, deadline=0)
+    assert quorum.needed == 2
+    quorum.settle(True)
+    assert not quorum.released
+    quorum.settle(True)
+    assert quorum.released and not quorum.wait(concurrent.futures.Future())
+
+    fan_in = FanIn(branches=2, quorum=1.0, deadline=0.05)
+    time.sleep(0.08)
+    # searches queued for a slot have not used up any of the deadline
+    assert not fan_in.released
+    search = concurrent.futures.Future()
+    threading.Timer(0.02, fan_in.start).start()
+    started = time.monotonic()
+    assert not fan_in.wait(search)
+    assert 0.06 <= time.monotonic() - started < 1
+
+    async def wait_async():
+        late = FanIn(branches=2, quorum=1.0, deadline=0.05)
+        asyncio.get_running_loop().call_later(0.02, late.start)
+        return await late.await_(asyncio.get_running_loop().create_future())
+
+    assert asyncio.run(asyncio.wait_for(wait_async(), 1)) is False
+
+
+def test_sync_hedges_are_skipped_while_the_hedge_pool_is_busy(monkeypatch):
+    hedger = Hedger("test")
+    for _ in range(5):
+        hedger.call(lambda: None, percentile=50, budget=1.0, min_samples=5)
+    calls = []
+
+    def slow():
+        calls.append(threading.current_thread().name)
+        time.sleep(0.05)
+
+    monkeypatch.setattr(hedging, "_hedge_slots", threading.BoundedSemaphore(1))
+    hedger.call(slow, percentile=50, budget=1.0, min_samples=5)
+    assert hedger.stats()["hedges_fired"] == 1
+    assert sorted(name.split("_")[0] for name in calls) == ["hedge", "hedge-primary"]
+    hedging._hedge_slots.acquire()
+    hedger.call(slow, percentile=50, budget=1.0, min_samples=5)
+    assert hedger.stats()["hedges_fired"] == 1 and hedger.stats()["saturated"] == 1
+
+
+def test_a_run_that_fails_midway_leaves_no_speculation_behind():
+    previous = set_client_registry(FakeClientRegistry(
+        LatencyModel("constant", 0.0), LatencyModel("constant", 0.0),
+        model_options={"broken": {"invalid_probability": 1.0}},
+    ))
+    configurable = {"thread_id": uuid.uuid4().hex, "blob_store": "memory", "search_cache_ttl": 0,
+                    "max_research_loops": 2, "speculate_follow_ups": True, "reflection_model": "broken",
+                    "max_retries": 0}
+    try:
+        with forgetting_runs():
+            try:
+                graph.invoke({"messages": [HumanMessage(content="How did margins change?")]},
+                             {"configurable": configurable})
+            except Exception:
+                pass
+            else:
+                raise AssertionError("reflection should have failed")
+            assert speculation_registry._loops
+    finally:
+        set_client_registry(previous)
+    assert not speculation_registry._loops and not fan_in_registry._fan_ins
+
+
+def test_blob_stores_evict_old_and_least_recently_used_texts(tmp_path):
+    memory = MemoryBlobStore(max_bytes=10)
+    first, second = memory.put("aaaa"), memory.put("bbbb")
+    memory.get(first)
+    memory.put("cccc")
+    assert memory.get(first) == "aaaa" and len(memory) == 2
+    try:
+        memory.get(second)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("the least recently used text should have been evicted")
+
+    disk = DiskBlobStore(str(tmp_path), ttl=60)
+    old, fresh = disk.put("old text"), disk.put("fresh text")
+    os.utime(disk._file(old), (time.time() - 120, time.time() - 120))
+    assert disk.sweep() == 1
+    assert disk.get(fresh) == "fresh text" and not os.path.exists(disk._file(old))
+
+
+def test_blobs_of_runs_in_flight_are_kept_and_missing_ones_read_as_digests(tmp_path):
+    memory = MemoryBlobStore(max_bytes=10)
+    pinned = memory.put("aaaa", run_id="slow run")
+    memory.put("bbbb")
+    memory.put("cccc")
+    assert memory.get(pinned) == "aaaa"
+    memory.pins.release("slow run")
+    memory.put("dddd")
+    assert len(memory) == 2
+
+    disk = DiskBlobStore(str(tmp_path), ttl=60)
+    kept = disk.put("a running run's text", run_id="slow run")
+    os.utime(disk._file(kept), (time.time() - 120, time.time() - 120))
+    assert disk.sweep() == 0
+    disk.pins.release("slow run")
+    assert disk.sweep() == 1
+
+    # a checkpoint resumed after its blobs expired reads their digests instead
+    results = ResolvedResults([{"blob": kept, "tokens": 5}, "inline text"], disk, ["the digest", "inline"])
+    assert list(results) == ["the digest", "inline text"]
+
+    store = get_blob_store("memory", "")
+    key = store.put("a text of a run that ended", run_id="ended run")
+    assert key in store.pins
+    release_run("ended run")
+    assert key not in store.pins
+    try:
+        get_blob_store("disk", "")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a disk store without a path should be refused")
+
+
+def test_a_failed_speculative_search_falls_back_to_the_branch_searching():
+    guess = Guess("How did margins change in 2024?", "gemini-2.0-flash")
+    guess.future = concurrent.futures.Future()
+    assert guess.start()
+    guess.future.set_exception(RuntimeError("speculative search failed"))
+    run_id = uuid.uuid4().hex
+    speculation_registry._claimed[(run_id, guess.query)] = guess
+    previous = set_client_registry(FakeClientRegistry(LatencyModel("constant", 0.0), LatencyModel("constant", 0.0)))
+    try:
+        update = web_research(
+            {"search_query": guess.query, "id": 0, "run_id": run_id, "loop": 1, "branches": 1},
+            {"configurable": {"blob_store": "none", "search_cache_ttl": 0}},
+        )
+    finally:
+        set_client_registry(previous)
+    assert update["search_query"] == [guess.query] and update["web_research_result"][0]
+    # a run's own loop limit leaves its last loop nothing to guess for
+    configurable = Configuration(speculate_follow_ups=True, max_research_loops=3)
+    assert _speculating({"loop": 0}, configurable)
+    assert not _speculating({"loop": 0, "max_research_loops": 1}, configurable)
+
+
+def test_rate_limiter_buckets_hold_calls_until_they_refill():
+    limiter = RateLimiter("buckets", requests_per_minute=60, tokens_per_minute=600)
+    granted = []
+    # a call larger than the token bucket waits for a full one, then overdraws it
+    limiter._enqueue(50, "web_research", lambda: granted.append("large"))
+    limiter._enqueue(1, "web_research", lambda: granted.append("next"))
+    assert granted == ["large"]
+    with limiter._cond:
+        assert abs(limiter._tokens.level + 40) < 0.5
+        assert 0.9 < limiter._requests.wait_for(1) <= 1.0
+        assert 4.0 < limiter._tokens.wait_for(1) <= 4.1
+    limiter.settle(50, 20)
+    with limiter._cond:
+        assert abs(limiter._tokens.level + 10) < 0.5
+    # a 429 halves the request rate, and each success wins back a twentieth of the limit
+    limiter.on_rate_limited(0.0, 0)
+    assert limiter.stats()["requests_per_minute"] == 30
+    limiter.on_success()
+    assert limiter.stats()["requests_per_minute"] == 33
+
+
+def test_cancelled_waiters_give_back_their_place_and_permit():
+    limiter = RateLimiter("cancelled", requests_per_minute=60)
+    granted = []
+    limiter._enqueue(1, "web_research", lambda: granted.append("first"))
+
+    async def cancel_a_waiter():
+        waiter = asyncio.ensure_future(limiter.aacquire(1, "web_research"))
+        await asyncio.sleep(0.01)
+        assert limiter.stats()["queued"] == 1
+        waiter.cancel()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(cancel_a_waiter())
+    assert limiter.stats()["queued"] == 0
+    # the next refill goes to the next caller, not to the one that left
+    with limiter._cond:
+        limiter._requests.level = 1
+    limiter._enqueue(1, "web_research", lambda: granted.append("next"))
+    assert granted == ["first", "next"]
+    # a caller cancelled after its grant returns the request it took
+    with limiter._cond:
+        limiter._requests.level = 1
+    entry = limiter._enqueue(1, "web_research", lambda: granted.append("taken back"))
+    limiter._withdraw(entry)
+    with limiter._cond:
+        assert granted[-1] == "taken back" and limiter._requests.level > 0.9
+
+
+def test_shared_buckets_are_taken_outside_the_queue_lock(tmp_path):
+    limiter = RateLimiter("shared", requests_per_minute=60)
+    shared = rate_limit.SharedBuckets(str(tmp_path / "limits.sqlite"))
+    take = shared.take
+    free = []
+
+    def take_checking_the_lock(*args):
+        other = threading.Thread(target=limiter.stats)
+        other.start()
+        other.join(timeout=1)
+        free.append(not other.is_alive())
+        return take(*args)
+
+    shared.take = take_checking_the_lock
+    limiter.share(shared)
+    granted = []
+    limiter._enqueue(1, "web_research", lambda: granted.append("call"))
+    assert granted == ["call"] and free == [True]
+    assert shared.stats()["shared"]["granted"] == 1
+
+
+def test_a_taken_speculative_search_queues_at_its_branch_priority():
+    limiter = RateLimiter("test")
+    limiter.paused_until = time.monotonic() + 60
+    granted = []
+    promoted = Promotion()
+    token = rate_limit.promotion.set(promoted)
+    try:
+        limiter._enqueue(1, "speculative_search", lambda: granted.append("taken"))
+    finally:
+        rate_limit.promotion.reset(token)
+    limiter._enqueue(1, "speculative_search", lambda: granted.append("speculative"))
+    limiter._enqueue(1, "web_research", lambda: granted.append("branch"))
+    promoted.promote("web_research")
+    with limiter._cond:
+        limiter.paused_until = 0
+        limiter._grant_ready()
+    assert granted == ["taken", "branch", "speculative"]
+
+
+def test_sources_without_a_domain_title_are_not_cited():
+    assert source_label("example.com") == "example"
+    assert source_label("Café prices.local") == "Café prices"
+    assert source_label("no domain") is None and source_label(None) is None
+    chunks = [SimpleNamespace(web=SimpleNamespace(uri="https://a.example/x", title="a.example")),
+              SimpleNamespace(web=SimpleNamespace(uri="https://b.example/y", title=None))]
+    metadata = SimpleNamespace(grounding_chunks=chunks)
+    response = SimpleNamespace(candidates=[SimpleNamespace(grounding_metadata=metadata)])
+    text, sources = _excerpt_sources(
+        response, {"https://a.example/x": "[0-0]", "https://b.example/y": "[0-1]"},
+        [{"url": "https://a.example/x", "text": "Margins held."}, {"url": "https://b.example/y", "text": "Untitled."}],
+    )
+    assert [source["label"] for source in sources] == ["a"] and "Untitled." not in text
+
+
+def test_byte_offsets_map_to_characters_of_multibyte_text():
+    text = "Le café coûte 3 €. Les marges tiennent ✓"
+    starts = {len(text[:i].encode("utf-8")): i for i in range(len(text) + 1)}
+    assert byte_to_char_offsets(text, list(starts)) == starts
+    inside = len("Le caf".encode("utf-8")) + 1
+    past = len(text.encode("utf-8")) + 10
+    # an offset inside a character maps to the character after it, one past the end to the end
+    assert byte_to_char_offsets(text, [inside, past]) == {inside: len("Le café"), past: len(text)}
+
+    sentence = "Les marges tiennent"
+    start = len(text[:text.index(sentence)].encode("utf-8"))
+    support = SimpleNamespace(segment=SimpleNamespace(start_index=start, end_index=start + len(sentence.encode())),
+                              grounding_chunk_indices=[0])
+    metadata = SimpleNamespace(
+        grounding_chunks=[SimpleNamespace(web=SimpleNamespace(uri="https://a.example/x", title="a.example"))],
+        grounding_supports=[support],
+    )
+    response = SimpleNamespace(text=text, candidates=[SimpleNamespace(grounding_metadata=metadata)])
+    [citation] = get_citations(response, {"https://a.example/x": "[0-0]"}, byte_offsets=True)
+    assert text[citation["start_index"]:citation["end_index"]] == sentence
+    [raw] = get_citations(response, {"https://a.example/x": "[0-0]"}, byte_offsets=False)
+    assert (raw["start_index"], raw["end_index"]) == (support.segment.start_index, support.segment.end_index)
+
+
+def test_short_urls_expand_through_aliases_and_custom_urls_and_first_source_wins():
+    prefix = "https://vertexaisearch.cloud.google.com/id/"
+    sources = [
+        {"short_url": f"{prefix}0-0", "value": "https://a.example", "aliases": [f"{prefix}1-3", "ref:a"]},
+        {"short_url": f"{prefix}0-1", "value": "https://b.example"},
+        # the same short url again: the source listed first keeps it
+        {"short_url": f"{prefix}0-0", "value": "https://shadowed.example"},
+        # matched before "ref:a", which it starts with
+        {"short_url": "ref:a-long", "value": "https://c.example"},
+    ]
+    text = (f"A [a]({prefix}1-3), again [a]({prefix}0-0), custom [a](ref:a) "
+            f"and [c](ref:a-long); unknown {prefix}9-9 stays.")
+    expanded, cited = expand_short_urls(text, sources)
+    assert expanded == ("A [a](https://a.example), again [a](https://a.example), custom [a](https://a.example) "
+                        f"and [c](https://c.example); unknown {prefix}9-9 stays.")
+    assert cited == [sources[0], sources[3]]
+
+
+def test_streamed_short_urls_expand_wherever_the_pieces_split():
+    prefix = "https://vertexaisearch.cloud.google.com/id/"
+    sources = [{"short_url": f"{prefix}2-1", "value": "https://a.example"},
+               {"short_url": f"{prefix}2-12", "value": "https://b.example"},
+               {"short_url": "ref:c", "value": "https://c.example"}]
+    text = f"See [a]({prefix}2-1) and [b]({prefix}2-12), then [c](ref:c) and {prefix}2-1"
+    expected = expand_short_urls(text, sources)[0]
+    for first in range(len(text) + 1):
+        for second in (first, min(len(text), first + 7)):
+            expander = ShortUrlExpander(sources)
+            pieces = [text[:first], text[first:second], text[second:]]
+            assert "".join(expander.feed(piece) for piece in pieces) + expander.flush() == expected
+
+    # a complete short url is held back while more digits may still extend it
+    expander = ShortUrlExpander(sources)
+    assert expander.feed(f"[a]({prefix}2-1") == "[a]("
+    assert expander.feed("2) done") == "https://b.example) done"
+    assert expander.feed(f" {prefix}2-1") == " " and expander.flush() == "https://a.example"
@@ -9,6 +9,10 @@ class SearchQueryList(BaseModel):
     rational: str = Field(
         description="A brief explanation of why these queries are relevant to the research topic"
     )
+    confidence: float = Field(
+        default=1.0, ge=0.0, le=1.0,
+        description="How confident you are, from 0 to 1, that these queries cover the research topic"
+    )
 
 
 class Reflection(BaseModel):
@@ -21,5 +25,13 @@ class Reflection(BaseModel):
     follow_up_queries: List[str] = Field(
         description="A list of follow-up queries to address the knowledge gap."
     )
+    confidence: float = Field(
+        default=1.0, ge=0.0, le=1.0,
+        description="How confident you are, from 0 to 1, in this assessment of the summaries."
+    )
 
 
+class FollowUpGuess(BaseModel):
+    follow_up_queries: List[str] = Field(
+        description="The follow-up queries a review of this search result alone would likely ask for."
+    )
@@ -0,0 +1,438 @@
+"""
+Per-node spans of research runs, exported as Chrome trace events, and an
+offline analysis of where a run's time went.
+
+    python tracing.py traces.json
+    python tracing.py traces.json --run <run_id>
+
+With `trace_path` set, every node execution records a span, and so do the
+provider calls, rate-limit waits and local work (citation processing, prompt
+building) inside it. A run is one trace, keyed on its run_id; a web_research
+branch is the child of the generate_query or reflection span that sent it.
+The file opens in chrome://tracing or https://ui.perfetto.dev, one process per
+run and one track per branch.
+"""
+import argparse
+import atexit
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+from configuration import Configuration
+from utils import percentile
+
+# the span that spans started here are children of
+_current = ContextVar("trace_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "category", "span_id", "parent_id", "start", "end", "attributes", "children",
+                 "_ids", "lane", "root")
+
+    def __init__(self, name: str, category: str, span_id: str = "", parent_id: Optional[str] = None, **attributes):
+        self.name = name
+        self.category = category
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start = time.time_ns() // 1000
+        self.end = None
+        self.attributes = attributes
+        # the spans finished inside a node span, emitted with it
+        self.children = []
+        self._ids = itertools.count(1)
+        self.lane = 0
+        # the node span a child span belongs to
+        self.root = None
+
+
+def _node_ids(node: str, state: dict, update) -> tuple:
+    """
+    The (span id, parent span id, track) of a node execution. They follow from
+    the state, so a branch finds the span that sent it, even in another process.
+    """
+    update = update if isinstance(update, dict) else {}
+    if node == "web_research":
+        loop = state.get("loop", 0)
+        sender = "generate_query" if not loop else f"reflection.{loop}"
+        return f"web_research.{loop}.{state.get('id', 0)}", sender, 1 + int(state.get("id", 0))
+    if node == "reflection":
+        return f"reflection.{update.get('research_loop_count', 0)}", "run", 0
+    return node, "run", 0
+
+
+def _trace_pid(trace_id: str) -> int:
+    return zlib.crc32(trace_id.encode("utf-8")) & 0x7FFFFFFF
+
+
+class Tracer:
+    """
+    Buffers finished spans and appends them to `path` as Chrome trace events.
+
+    The file is in the JSON array format, which the viewers accept without its
+    closing bracket, so events are appended in batches as they come and a
+    crash loses at most the unflushed batch. Serializing and writing happen on
+    a background thread, every `flush_interval` seconds or once `flush_every`
+    events are waiting, so a node only pays for building its events. A run is
+    kept with probability `sample_rate`, decided from its run_id, so all its
+    spans go together.
+    """
+
+    def __init__(self, path: str, flush_every: int = 2048, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._buffer = []
+        self._stats = {"spans": 0, "dropped_runs": 0, "flushes": 0}
+        self._writer = None
+
+    def finish_node(self, span: Span, node: str, state: dict, update, sample_rate: float):
+        trace_id = (update.get("run_id") if isinstance(update, dict) else None) or state.get("run_id") or "unknown"
+        if sample_rate < 1 and zlib.crc32(trace_id.encode("utf-8")) / 2 ** 32 >= sample_rate:
+            if node == "check_answer_cache":
+                self._stats["dropped_runs"] += 1
+            return
+        span.span_id, span.parent_id, span.lane = _node_ids(node, state, update)
+        pid = _trace_pid(trace_id)
+        events = []
+        if node == "check_answer_cache":
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"run {trace_id}"}})
+        if span.lane:
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": span.lane,
+                           "args": {"name": f"{node} {span.lane - 1}"}})
+        for item in (span, *span.children):
+            events.append({
+                "name": item.name, "cat": item.category, "ph": "X", "ts": item.start,
+                "dur": item.end - item.start, "pid": pid, "tid": span.lane,
+                "args": {
+                    "trace_id": trace_id,
+                    # children were numbered before the node span knew its id
+                    "span_id": item.span_id.replace("?", span.span_id, 1),
+                    "parent_id": item.parent_id.replace("?", span.span_id, 1) if item.parent_id else None,
+                    **item.attributes,
+                },
+            })
+        with self._lock:
+            self._buffer.extend(events)
+            self._stats["spans"] += 1 + len(span.children)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="trace-writer", daemon=True)
+                self._writer.start()
+            if len(self._buffer) >= self.flush_every:
+                self._wake.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                self._wake.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered events out now."""
+        with self._write_lock:
+            with self._lock:
+                events, self._buffer = self._buffer, []
+            if not events:
+                return
+            # one append per batch, so processes sharing the file do not interleave events
+            data = "".join(json.dumps(event, separators=(",", ":")) + ",\n" for event in events)
+            if not os.path.exists(self.path):
+                _create_with_header(self.path)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+            self._stats["flushes"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "buffered": len(self._buffer)}
+
+
+def _create_with_header(path: str):
+    """
+    Creates the trace file with its opening bracket, unless another process
+    already has. The header is written to a file of our own and linked into
+    place, so no process sees, or appends to, the file before its header.
+    """
+    staging = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(staging, "w", encoding="utf-8") as f:
+        f.write("[\n")
+    try:
+        os.link(staging, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(staging)
+
+
+_tracers = {}
+_tracers_lock = threading.Lock()
+
+
+def get_tracer(path: str) -> Tracer:
+    """Returns the process-wide tracer writing to `path`, flushed at exit."""
+    key = os.path.abspath(path)
+    with _tracers_lock:
+        tracer = _tracers.get(key)
+        if tracer is None:
+            tracer = _tracers[key] = Tracer(path)
+            atexit.register(tracer.flush)
+        return tracer
+
+
+@contextmanager
+def span(name: str, category: str, **attributes):
+    """Records the enclosed block as a child of the current span; does nothing outside a traced node."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    root = parent.root or parent
+    child = Span(name, category, f"?/{next(root._ids)}", parent.span_id or "?", **attributes)
+    child.root = root
+    token = _current.set(child)
+    try:
+        yield child
+    finally:
+        _current.reset(token)
+        child.end = time.time_ns() // 1000
+        root.children.append(child)
+
+
+def record(name: str, category: str, start: float, end: float, **attributes):
+    """Records an already finished block, timed with `time.time()`, as a child of the current span."""
+    parent = _current.get()
+    if parent is None:
+        return
+    root = parent.root or parent
+    child = Span(name, category, f"?/{next(root._ids)}", parent.span_id or "?", **attributes)
+    child.start, child.end = int(start * 1e6), int(end * 1e6)
+    root.children.append(child)
+
+
+def local_span(name: str):
+    """Decorator recording every call of the function as a span of local work."""
+    def decorate(func):
+        @functools.wraps(func)
+        def traced(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(name, "local"):
+                return func(*args, **kwargs)
+        return traced
+    return decorate
+
+
+def _settings(config) -> tuple:
+    configurable = Configuration.from_runnable_config(config)
+    return configurable.trace_path, configurable.trace_sample_rate
+
+
+def traced_node(node: str, func, afunc):
+    """Wraps a node's sync and async functions so that every execution records a span."""
+
+    def run(state, config):
+        path, sample_rate = _settings(config)
+        if not path:
+            return func(state, config)
+        node_span = Span(node, "node")
+        token = _current.set(node_span)
+        update = None
+        try:
+            update = func(state, config)
+            return update
+        except BaseException as exc:
+            node_span.attributes["error"] = type(exc).__name__
+            raise
+        finally:
+            _current.reset(token)
+            node_span.end = time.time_ns() // 1000
+            get_tracer(path).finish_node(node_span, node, state, update, sample_rate)
+
+    async def arun(state, config):
+        path, sample_rate = _settings(config)
+        if not path:
+            return await afunc(state, config)
+        node_span = Span(node, "node")
+        token = _current.set(node_span)
+        update = None
+        try:
+            update = await afunc(state, config)
+            return update
+        except BaseException as exc:
+            node_span.attributes["error"] = type(exc).__name__
+            raise
+        finally:
+            _current.reset(token)
+            node_span.end = time.time_ns() // 1000
+            get_tracer(path).finish_node(node_span, node, state, update, sample_rate)
+
+    return run, arun
+
+
+# ---------------------------------------------------------------------------
+# offline analysis
+
+
+def load_events(path: str) -> List[dict]:
+    """Reads a trace file, with or without its closing bracket."""
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("{"):
+        return json.loads(text)["traceEvents"]
+    text = text.rstrip(",")
+    if not text.endswith("]"):
+        text += "]"
+    return json.loads(text.replace(",\n]", "\n]").replace(",]", "]"))
+
+
+def _union(intervals: list) -> float:
+    total, end = 0, None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+
+def _clip(spans: list, start: int, end: int) -> list:
+    return [(max(s["ts"], start), min(s["ts"] + s["dur"], end)) for s in spans
+            if s["ts"] < end and s["ts"] + s["dur"] > start]
+
+
+def analyze_run(events: List[dict]) -> dict:
+    """
+    Where one run's time went: its critical path, how well each loop's
+    branches overlapped, and the split of the critical path between provider
+    calls, rate-limit waits, local work, the rest of the nodes' own code and
+    the graph runtime between nodes (state merging, checkpoints, scheduling).
+    """
+    nodes = sorted((e for e in events if e.get("cat") == "node"), key=lambda e: e["ts"])
+    children = {}
+    for event in events:
+        if event.get("cat") != "node":
+            node_id = event["args"]["span_id"].split("/", 1)[0]
+            children.setdefault(node_id, []).append(event)
+    started = nodes[0]["ts"]
+    finished = max(node["ts"] + node["dur"] for node in nodes)
+
+    # walk back from the last node to finish: in each superstep the node that
+    # finished last before the next one started is the one everything waited for
+    path, current = [], max(nodes, key=lambda node: node["ts"] + node["dur"])
+    while current is not None:
+        path.append(current)
+        before = [node for node in nodes if node["ts"] + node["dur"] <= current["ts"]]
+        current = max(before, key=lambda node: node["ts"] + node["dur"]) if before else None
+    path.reverse()
+
+    split = {"provider": 0, "queue": 0, "local": 0, "node_other": 0, "runtime": 0}
+    critical_path = []
+    previous_end = started
+    for node in path:
+        end = node["ts"] + node["dur"]
+        spans = children.get(node["args"]["span_id"], [])
+        by_category = {
+            category: _union(_clip([s for s in spans if s["cat"] == category], node["ts"], end))
+            for category in ("provider", "queue", "local")
+        }
+        own = node["dur"] - _union(_clip(spans, node["ts"], end))
+        gap = node["ts"] - previous_end
+        for category, seconds in by_category.items():
+            split[category] += seconds
+        split["node_other"] += own
+        split["runtime"] += gap
+        critical_path.append({"span": node["args"]["span_id"], "wait_s": gap / 1e6, "duration_s": node["dur"] / 1e6})
+        previous_end = end
+
+    loops = {}
+    for node in nodes:
+        if node["name"] == "web_research":
+            loops.setdefault(node["args"]["span_id"].split(".")[1], []).append(node)
+    parallelism = {}
+    for loop, branches in sorted(loops.items(), key=lambda item: int(item[0])):
+        first = min(branch["ts"] for branch in branches)
+        last = max(branch["ts"] + branch["dur"] for branch in branches)
+        durations = [branch["dur"] for branch in branches]
+        parallelism[loop] = {
+            "branches": len(branches),
+            "wall_s": (last - first) / 1e6,
+            # 1.0 when every branch takes as long as the slowest, i.e. nobody waits on a straggler
+            "efficiency": sum(durations) / (len(branches) * (last - first)) if last > first else 1.0,
+            "straggler_ratio": max(durations) / max(percentile(durations, 50), 1),
+        }
+
+    total = finished - started
+    return {
+        "run_id": nodes[0]["args"]["trace_id"],
+        "wall_s": total / 1e6,
+        "critical_path": critical_path,
+        "parallelism": parallelism,
+        "split_s": {category: seconds / 1e6 for category, seconds in split.items()},
+        "split_share": {category: seconds / total if total else 0.0 for category, seconds in split.items()},
+    }
+
+
+def analyze(events: List[dict]) -> List[dict]:
+    """`analyze_run` for every run in the trace."""
+    runs = {}
+    for event in events:
+        if event.get("ph") == "X":
+            runs.setdefault(event["args"]["trace_id"], []).append(event)
+    return [analyze_run(run) for run in runs.values() if any(e["cat"] == "node" for e in run)]
+
+
+def main(args):
+    reports = analyze(load_events(args.trace))
+    if args.run:
+        reports = [report for report in reports if report["run_id"] == args.run]
+    if not reports:
+        print("no runs in the trace")
+        return
+    if len(reports) == 1 or args.run:
+        report = reports[0]
+        print(f"run {report['run_id']}: {report['wall_s'] * 1e3:.1f}ms")
+        print("critical path:")
+        for step in report["critical_path"]:
+            print(f"  {step['span']:<24} waited {step['wait_s'] * 1e3:8.1f}ms  ran {step['duration_s'] * 1e3:8.1f}ms")
+        for loop, stats in report["parallelism"].items():
+            print(f"loop {loop}: {stats['branches']} branches over {stats['wall_s'] * 1e3:.1f}ms, "
+                  f"efficiency {stats['efficiency']:.2f}, straggler x{stats['straggler_ratio']:.2f}")
+        for category, seconds in report["split_s"].items():
+            print(f"  {category:<12} {seconds * 1e3:9.1f}ms {report['split_share'][category]:6.1%}")
+        return
+    walls = [report["wall_s"] for report in reports]
+    print(f"{len(reports)} runs: p50={percentile(walls, 50) * 1e3:.1f}ms p95={percentile(walls, 95) * 1e3:.1f}ms")
+    print("share of the critical path, averaged over runs:")
+    for category in reports[0]["split_share"]:
+        share = sum(report["split_share"][category] for report in reports) / len(reports)
+        print(f"  {category:<12} {share:6.1%}")
+    efficiencies = [stats["efficiency"] for report in reports for stats in report["parallelism"].values()]
+    if efficiencies:
+        print(f"loop parallelism efficiency: p50={percentile(efficiencies, 50):.2f} "
+              f"p5={percentile(efficiencies, 5):.2f}")
+    slowest = {}
+    for report in reports:
+        for step in report["critical_path"]:
+            node = step["span"].split(".")[0]
+            slowest[node] = slowest.get(node, 0.0) + step["duration_s"] + step["wait_s"]
+    print("critical path time by node:")
+    for node, seconds in sorted(slowest.items(), key=lambda item: -item[1]):
+        print(f"  {node:<20} {seconds / len(reports) * 1e3:9.1f}ms per run")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace")
+    parser.add_argument("--run", default="", help="report on one run in detail")
+    main(parser.parse_args())
@@ -1,11 +1,32 @@
+import re
 from datetime import datetime
 from langchain_core.messages import AnyMessage, AIMessage, HumanMessage
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Optional
+
+# short urls built by `resolve_urls` are f"{SHORT_URL_PREFIX}{id}-{idx}"
+SHORT_URL_PREFIX = "https://vertexaisearch.cloud.google.com/id/"
+_SHORT_URL_PATTERN = re.compile(re.escape(SHORT_URL_PREFIX) + r"\d+-\d+")
+# a scheme url at the end of streamed text that may still be missing digits
+_PARTIAL_SHORT_URL_PATTERN = re.compile(re.escape(SHORT_URL_PREFIX) + r"\d*(?:-\d*)?$")
+_MAX_HELD_URL_LENGTH = len(SHORT_URL_PREFIX) + 64
+
+# UTF-8 continuation bytes (0b10xxxxxx) never start a character
+_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
 
 def get_current_date():
     return datetime.now().strftime("%B")
 
 
+def get_date_bucket():
+    """The year and month cached responses are keyed on; the month the prompts give recurs every year."""
+    return datetime.now().strftime("%Y-%m")
+
+
+def normalize_query(query: str) -> str:
+    """Lower-cases a query, drops punctuation and collapses whitespace."""
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+
 def get_research_topic(messages: List[AnyMessage]) -> str:
     """
     Get the research topic from the message
@@ -34,7 +55,7 @@ def resolve_urls(urls_to_resolve: List[Any], id: int) -> Dict[str, str]:
     :return:
     """
 
-    prefix = f"https://vertexaisearch.cloud.google.com/id/"
+    prefix = SHORT_URL_PREFIX
     urls = [site.web.uri for site in urls_to_resolve]
 
     # Create a dictionary that maps each unique URL to its first occurrence index
@@ -46,6 +67,102 @@ def resolve_urls(urls_to_resolve: List[Any], id: int) -> Dict[str, str]:
     return resolved_map
 
 
+class ShortUrlExpander:
+    """
+    Replaces short urls with the urls they stand for, in one scan of the text.
+
+    Short urls follow the `resolve_urls` scheme, so one pattern finds them all;
+    any that do not are matched by an alternation, longest first. Text can be
+    expanded whole with `expand`, or fed piece by piece as it streams in with
+    `feed` and `flush`, in which case a short url split across pieces is held
+    back until it is complete. `cited_sources` lists the unique sources the
+    text cited, in `sources` order.
+    """
+
+    def __init__(self, sources: List[Dict[str, Any]]):
+        self._by_short_url = {}
+        for source in sources:
+            # a source deduplicated by URL answers to the short urls of every branch that found it
+            for short_url in [source.get("short_url"), *source.get("aliases", ())]:
+                if short_url and short_url not in self._by_short_url:
+                    self._by_short_url[short_url] = source
+
+        self._others = sorted(
+            (url for url in self._by_short_url if not _SHORT_URL_PATTERN.fullmatch(url)),
+            key=len, reverse=True,
+        )
+        self._pattern = _SHORT_URL_PATTERN
+        if self._others:
+            self._pattern = re.compile("|".join(
+                [_SHORT_URL_PATTERN.pattern] + [re.escape(url) for url in self._others]
+            ))
+        self._cited = set()
+        self._pending = ""
+
+    def _replace(self, match) -> str:
+        source = self._by_short_url.get(match.group(0))
+        if source is None:
+            return match.group(0)
+        self._cited.add(match.group(0))
+        return source["value"]
+
+    def expand(self, text: str) -> str:
+        if not self._by_short_url:
+            return text
+        return self._pattern.sub(self._replace, text)
+
+    def _hold_from(self, text: str) -> int:
+        # a complete scheme url can still grow more digits, and any tail can be
+        # the start of a url; both are held until the next piece arrives
+        hold = len(text)
+        match = _PARTIAL_SHORT_URL_PATTERN.search(text, max(0, len(text) - _MAX_HELD_URL_LENGTH))
+        if match:
+            hold = match.start()
+        for url in [SHORT_URL_PREFIX] + self._others:
+            for length in range(min(len(url) - 1, len(text)), 0, -1):
+                if text.endswith(url[:length]):
+                    hold = min(hold, len(text) - length)
+                    break
+        return hold
+
+    def feed(self, piece: str) -> str:
+        """Expands the streamed text that can no longer be part of an unfinished url."""
+        text = self._pending + piece
+        hold = self._hold_from(text)
+        self._pending = text[hold:]
+        return self.expand(text[:hold])
+
+    def flush(self) -> str:
+        """Expands whatever is still held back once the stream has ended."""
+        text, self._pending = self._pending, ""
+        return self.expand(text)
+
+    @property
+    def cited_sources(self) -> List[Dict[str, Any]]:
+        cited = {}
+        for url, source in self._by_short_url.items():
+            if url in self._cited:
+                cited.setdefault(id(source), source)
+        return list(cited.values())
+
+
+def expand_short_urls(text: str, sources: List[Dict[str, Any]]):
+    """
+    Replaces every short url in the text with the url it stands for, in one scan.
+
+    Args:
+        text: The answer text citing short urls.
+        sources: Source dictionaries with "short_url" and "value" keys, and
+                 optionally "aliases", as gathered by `web_research`. The first
+                 source per short url wins.
+
+    Returns:
+        The expanded text, and the unique sources it cites in `sources` order.
+    """
+    expander = ShortUrlExpander(sources)
+    return expander.expand(text), expander.cited_sources
+
+
 def insert_citation_markers(text, citations_list):
     """
     Inserts citation markers into a text string based on start and end indices.
@@ -54,38 +171,77 @@ def insert_citation_markers(text, citations_list):
         text (str): The original text string.
         citations_list (list): A list of dictionaries, where each dictionary
                                contains 'start_index', 'end_index', and
-                               'segment_string' (the marker to insert).
+                               'segments' (the links making up the marker).
                                Indices are assumed to be for the original text.
 
     Returns:
         str: The text with citation markers inserted.
     """
-    # Sort citations by end_index in descending order.
-    # If end_index is the same, secondary sort by start_index descending.
-    # This ensures that insertions at the end of the string don't affect
-    # the indices of earlier parts of the string that still need to be processed.
-    sorted_citations = sorted(
-        citations_list, key=lambda c: (c["end_index"], c["start_index"]), reverse=True
+    # Sort citations by end_index, then start_index. Citations sharing both
+    # indices keep their markers in reverse input order, as they did when the
+    # markers were spliced in back to front.
+    order = sorted(
+        range(len(citations_list)),
+        key=lambda i: (citations_list[i]["end_index"], citations_list[i]["start_index"], -i),
     )
 
-    modified_text = text
-    for citation_info in sorted_citations:
-        # These indices refer to positions in the *original* text,
-        # but since we iterate from the end, they remain valid for insertion
-        # relative to the parts of the string already processed.
-        end_idx = citation_info["end_index"]
-        marker_to_insert = ""
-        for segment in citation_info["segments"]:
-            marker_to_insert += f" [{segment['label']}]({segment['short_url']})"
-        # Insert the citation marker at the original end_idx position
-        modified_text = (
-                modified_text[:end_idx] + marker_to_insert + modified_text[end_idx:]
+    # Emit the text once, copying the span up to each end_index and then its marker.
+    pieces = []
+    position = 0
+    text_length = len(text)
+    for i in order:
+        citation_info = citations_list[i]
+        end_idx = min(max(citation_info["end_index"], 0), text_length)
+        if end_idx > position:
+            pieces.append(text[position:end_idx])
+            position = end_idx
+        pieces.extend(
+            f" [{segment['label']}]({segment['short_url']})"
+            for segment in citation_info["segments"]
         )
+    pieces.append(text[position:])
+    return "".join(pieces)
 
-    return modified_text
 
+def byte_to_char_offsets(text: str, byte_offsets) -> Dict[int, int]:
+    """
+    Maps UTF-8 byte offsets into ``text`` to character offsets.
 
-def get_citations(response, resolved_urls_map):
+    Gemini reports grounding segments in bytes, which only matches Python string
+    indices for ASCII text. Every character starts with exactly one
+    non-continuation byte, so the character offset is the number of such bytes
+    before the byte offset; an offset inside a multi-byte character maps to the
+    character after it.
+    """
+    offsets = sorted(set(byte_offsets))
+    if text.isascii():
+        return {offset: offset for offset in offsets}
+
+    encoded = text.encode("utf-8")
+    mapping = {}
+    previous = 0
+    char_position = 0
+    for offset in offsets:
+        end = min(max(offset, 0), len(encoded))
+        if end > previous:
+            char_position += len(encoded[previous:end].translate(None, _CONTINUATION_BYTES))
+            previous = end
+        mapping[offset] = char_position
+    return mapping
+
+
+def source_label(title: Optional[str]) -> Optional[str]:
+    """
+    The label a source is cited under: the part of its title before the first
+    "." (Gemini's chunk titles are domains). None for a missing title or one
+    without a ".", which is not cited.
+    """
+    if not title or "." not in title:
+        return None
+    return title.split(".")[0]
+
+
+def get_citations(response, resolved_urls_map, byte_offsets=True):
     """
     Extracts and formats citation information from a Gemini model's response.
 
@@ -97,8 +253,11 @@ def get_citations(response, resolved_urls_map):
     Args:
         response: The response object from the Gemini model, expected to have
                   a structure including `candidates[0].grounding_metadata`.
-                  It also relies on a `resolved_map` being available in its
-                  scope to map chunk URIs to resolved URLs.
+        resolved_urls_map: Map of chunk URIs to the short urls built by
+                  `resolve_urls`.
+        byte_offsets: Whether the segment indices are UTF-8 byte offsets, as
+                  Gemini reports them. They are converted to character
+                  offsets into `response.text`.
 
     Returns:
         list: A list of dictionaries, where each dictionary represents a citation
@@ -108,10 +267,10 @@ def get_citations(response, resolved_urls_map):
                                      if not specified.
               - "end_index" (int): The character index immediately after the
                                    end of the cited segment (exclusive).
-              - "segments" (list[str]): A list of individual markdown-formatted
-                                        links for each grounding chunk.
-              - "segment_string" (str): A concatenated string of all markdown-
-                                        formatted links for the citation.
+              - "segments" (list[dict]): The label, short url and url of each
+                                         grounding chunk supporting the segment.
+                                         Citations citing the same chunk share
+                                         the same dictionary.
               Returns an empty list if no valid candidates or grounding supports
               are found, or if essential data is missing.
     """
@@ -129,49 +288,53 @@ def get_citations(response, resolved_urls_map):
     ):
         return citations
 
-    for support in candidate.grounding_metadata.grounding_supports:
-        citation = {}
+    # Build the label and url of every chunk once, rather than once per support.
+    # Chunks without a web source or a label get no entry and are skipped.
+    chunk_segments = []
+    for chunk in candidate.grounding_metadata.grounding_chunks or []:
+        web = getattr(chunk, "web", None)
+        label = source_label(getattr(web, "title", None))
+        chunk_segments.append(None if label is None else {
+            "label": label,
+            "short_url": resolved_urls_map.get(web.uri, None),
+            "value": web.uri,
+        })
 
-        # Ensure segment information is present
-        if not hasattr(support, "segment") or support.segment is None:
-            continue  # Skip this support if segment info is missing
+    supports = []
+    for support in candidate.grounding_metadata.grounding_supports or []:
+        # Skip supports without a segment, or without the end_index that bounds it
+        if getattr(support, "segment", None) is None or support.segment.end_index is None:
+            continue
+        supports.append(support)
 
-        start_index = (
-            support.segment.start_index
-            if support.segment.start_index is not None
-            else 0
+    offsets = {}
+    if byte_offsets and supports:
+        offsets = byte_to_char_offsets(
+            response.text or "",
+            [index for support in supports
+             for index in (support.segment.start_index or 0, support.segment.end_index)],
         )
 
-        # Ensure end_index is present to form a valid segment
-        if support.segment.end_index is None:
-            continue  # Skip if end_index is missing, as it's crucial
-
-        # Add 1 to end_index to make it an exclusive end for slicing/range purposes
-        # (assuming the API provides an inclusive end_index)
-        citation["start_index"] = start_index
-        citation["end_index"] = support.segment.end_index
-
-        citation["segments"] = []
-        if (
-                hasattr(support, "grounding_chunk_indices")
-                and support.grounding_chunk_indices
-        ):
-            for ind in support.grounding_chunk_indices:
-                try:
-                    chunk = candidate.grounding_metadata.grounding_chunks[ind]
-                    resolved_url = resolved_urls_map.get(chunk.web.uri, None)
-                    citation["segments"].append(
-                        {
-                            "label": chunk.web.title.split(".")[:-1][0],
-                            "short_url": resolved_url,
-                            "value": chunk.web.uri,
-                        }
-                    )
-                except (IndexError, AttributeError, NameError):
-                    # Handle cases where chunk, web, uri, or resolved_map might be problematic
-                    # For simplicity, we'll just skip adding this particular segment link
-                    # In a production system, you might want to log this.
-                    pass
-        citations.append(citation)
+    chunk_count = len(chunk_segments)
+    for support in supports:
+        start_index = support.segment.start_index or 0
+        end_index = support.segment.end_index
+        segments = []
+        for ind in getattr(support, "grounding_chunk_indices", None) or []:
+            if -chunk_count <= ind < chunk_count and chunk_segments[ind] is not None:
+                segments.append(chunk_segments[ind])
+        citations.append({
+            "start_index": offsets.get(start_index, start_index),
+            "end_index": offsets.get(end_index, end_index),
+            "segments": segments,
+        })
     return citations
 
+
+def percentile(values, pct: float) -> float:
+    """The nearest-rank percentile of `values`, 0 for none."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
@@ -0,0 +1,443 @@
+"""
+Research runs from a durable job queue, by a pool of worker processes.
+
+    python workers.py enqueue jobs.sqlite questions.jsonl --max-attempts 3
+    python workers.py start jobs.sqlite --workers 4 --concurrency 8
+    python workers.py scale jobs.sqlite 8
+    python workers.py status jobs.sqlite --watch 5
+    python workers.py results jobs.sqlite --output answers.jsonl
+
+The queue is a SQLite file; questions are JSON lines as for `batch.py`. `start`
+runs a supervisor keeping the wanted number of worker processes alive, each
+running up to `--concurrency` questions at once through the compiled graph,
+and `scale` changes that number from another shell. A claimed job is hidden
+from other workers for `--visibility-timeout` seconds, extended while its run
+is alive, so the jobs of a worker that dies are claimed again once it lapses
+and resume from their last checkpoint. Failed runs are retried with backoff
+until `--max-attempts`. The workers share their rate limits through the
+queue's file.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+from batch import prune, read_questions, run_question
+from rate_limit import SharedBuckets, backoff
+from utils import percentile
+
+# how often a worker records that it is alive, and how often idle ones look for jobs
+WORKER_HEARTBEAT = 2.0
+POLL_INTERVAL = 0.5
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS jobs ("
+    " seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL UNIQUE, question TEXT NOT NULL,"
+    " configurable TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+    " max_attempts INTEGER NOT NULL, visible_at REAL NOT NULL, worker TEXT, enqueued REAL NOT NULL,"
+    " started REAL, finished REAL, result TEXT, error TEXT)",
+    "CREATE INDEX IF NOT EXISTS jobs_visible ON jobs (status, visible_at)",
+    "CREATE TABLE IF NOT EXISTS workers ("
+    " id TEXT PRIMARY KEY, pid INTEGER NOT NULL, started REAL NOT NULL, heartbeat REAL NOT NULL,"
+    " running INTEGER NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+)
+
+
+class JobQueue:
+    """
+    A queue of research questions and their results in one SQLite file.
+
+    A job is "queued" until a worker claims it, "running" while the worker's
+    claim holds, and then "done" with its result or "failed" with its error.
+    A claim lasts a visibility timeout, which the worker extends while the run
+    is alive; a job whose claim has lapsed is claimed again like a queued one,
+    unless that was its last attempt. Completions and failures only count from
+    the worker holding the claim, so a worker that lost its job to another
+    cannot overwrite the other's result.
+
+    Every change is one short write transaction, in WAL mode, so any number
+    of processes can share the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _write(self, sql: str, args: tuple) -> int:
+        with self._lock:
+            return self._db.execute(sql, args).rowcount
+
+    def enqueue(self, items: Iterable[dict], configurable: Optional[dict] = None, max_attempts: int = 3) -> int:
+        """Adds {"id", "question"} items, skipping ids already in the queue. Returns how many were added."""
+        now = time.time()
+        rows = [
+            (item["id"], item["question"], json.dumps(configurable or {}), max_attempts, now, now)
+            for item in items
+        ]
+        with self._transaction() as db:
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO jobs (id, question, configurable, status, max_attempts, visible_at, enqueued)"
+                " VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                rows,
+            )
+            return db.total_changes - before
+
+    def claim(self, worker: str, visibility_timeout: float) -> Optional[dict]:
+        """
+        Claims the longest-waiting visible job for `visibility_timeout` seconds,
+        or returns None if there is none. Jobs whose claim lapsed on their last
+        attempt are failed first.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', finished = ?, worker = NULL,"
+                " error = 'the worker running its last attempt stopped responding'"
+                " WHERE status = 'running' AND visible_at <= ? AND attempts >= max_attempts",
+                (now, now),
+            )
+            row = db.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, visible_at = ?,"
+                " started = ? WHERE seq = (SELECT seq FROM jobs WHERE status IN ('queued', 'running')"
+                " AND visible_at <= ? ORDER BY visible_at LIMIT 1)"
+                " RETURNING id, question, configurable, attempts, seq",
+                (worker, now + visibility_timeout, now, now),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "question": row[1], "configurable": json.loads(row[2]), "attempts": row[3],
+                "seq": row[4]}
+
+    def extend(self, job_id: str, worker: str, visibility_timeout: float) -> bool:
+        """Extends `worker`'s claim on a job; False if the claim was lost."""
+        return self._write(
+            "UPDATE jobs SET visible_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time() + visibility_timeout, job_id, worker),
+        ) > 0
+
+    def complete(self, job_id: str, worker: str, result: dict) -> bool:
+        """Stores the result of a job `worker` holds; False if the claim was lost."""
+        return self._write(
+            "UPDATE jobs SET status = 'done', finished = ?, result = ?, error = NULL, worker = NULL"
+            " WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time(), json.dumps(result), job_id, worker),
+        ) > 0
+
+    def fail(self, job_id: str, worker: str, error: str, retry_at: float) -> bool:
+        """Queues a failed job again at `retry_at`, or fails it after its last attempt."""
+        return self._write(
+            "UPDATE jobs SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,"
+            " finished = CASE WHEN attempts < max_attempts THEN NULL ELSE ? END,"
+            " visible_at = ?, error = ?, worker = NULL WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time(), retry_at, error, job_id, worker),
+        ) > 0
+
+    def register(self, worker: str, pid: int):
+        now = time.time()
+        self._write("INSERT OR REPLACE INTO workers (id, pid, started, heartbeat) VALUES (?, ?, ?, ?)",
+                    (worker, pid, now, now))
+
+    def beat(self, worker: str, running: int, done: int):
+        self._write("UPDATE workers SET heartbeat = ?, running = ?, done = ? WHERE id = ?",
+                    (time.time(), running, done, worker))
+
+    def unregister(self, worker: str):
+        self._write("DELETE FROM workers WHERE id = ?", (worker,))
+
+    def set_workers(self, count: int):
+        self._write("INSERT OR REPLACE INTO settings (key, value) VALUES ('workers', ?)", (str(count),))
+
+    def wanted_workers(self) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM settings WHERE key = 'workers'").fetchone()
+        return int(row[0]) if row else 0
+
+    def stats(self, window: float = 60.0) -> dict:
+        """Queue depth by status, live workers, and the throughput and latency over the last `window` seconds."""
+        now = time.time()
+        with self._lock:
+            db = self._db
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            ready, oldest = db.execute(
+                "SELECT COUNT(*), MIN(enqueued) FROM jobs WHERE status = 'queued' AND visible_at <= ?", (now,)
+            ).fetchone()
+            latencies = [row[0] for row in db.execute(
+                "SELECT finished - started FROM jobs WHERE status = 'done' AND finished >= ?", (now - window,)
+            )]
+            workers = [pid for pid, in db.execute(
+                "SELECT pid FROM workers WHERE heartbeat >= ? ORDER BY started", (now - 3 * WORKER_HEARTBEAT,)
+            )]
+        return {
+            "queued": ready,
+            # failed attempts waiting out their backoff
+            "retrying": counts.get("queued", 0) - ready,
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "oldest_queued_s": now - oldest if oldest else 0.0,
+            "workers": len(workers),
+            "worker_pids": workers,
+            "wanted_workers": self.wanted_workers(),
+            "throughput_per_min": 60 * len(latencies) / window,
+            "p50_s": percentile(latencies, 50),
+            "p95_s": percentile(latencies, 95),
+        }
+
+    def results(self, include_failed: bool = True) -> Iterator[dict]:
+        """The finished jobs, in the format of `batch.py`'s output lines."""
+        statuses = ("done", "failed") if include_failed else ("done",)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT id, question, status, attempts, result, error FROM jobs"
+                f" WHERE status IN ({', '.join('?' * len(statuses))}) ORDER BY seq",
+                statuses,
+            ).fetchall()
+        for job_id, question, status, attempts, result, error in rows:
+            if status == "done":
+                yield {**json.loads(result), "attempts": attempts}
+            else:
+                yield {"id": job_id, "question": question, "status": "error", "error": error, "attempts": attempts}
+
+    def close(self):
+        self._db.close()
+
+
+async def _serve(queue: JobQueue, worker: str, concurrency: int, visibility_timeout: float, poll: float,
+                 retry_base: float):
+    """Runs up to `concurrency` jobs at once until SIGTERM or SIGINT, then finishes the ones it has."""
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    slots = asyncio.Semaphore(concurrency)
+    counts = {"running": 0, "done": 0}
+    # checkpoint threads are "<queue>/<seq>:<job id>:<digest>": a reclaimed job resumes its own run,
+    # but no other job, even one reusing its id in another queue of the same name, ever does
+    thread_prefix = os.path.splitext(os.path.basename(queue.path))[0]
+
+    async def keep_claim(job: dict):
+        while True:
+            await asyncio.sleep(visibility_timeout / 3)
+            if not await asyncio.to_thread(queue.extend, job["id"], worker, visibility_timeout):
+                return
+
+    async def run(job: dict):
+        counts["running"] += 1
+        keeper = asyncio.create_task(keep_claim(job))
+        try:
+            item = {"id": job["id"], "question": job["question"]}
+            # the first attempt starts over, only a retry of the same job resumes
+            result = await run_question(item, f"{thread_prefix}/{job['seq']}", job["configurable"],
+                                        fresh=job["attempts"] == 1)
+        finally:
+            keeper.cancel()
+            counts["running"] -= 1
+            slots.release()
+        if result["status"] == "ok":
+            if await asyncio.to_thread(queue.complete, job["id"], worker, result):
+                # a worker that lost the claim leaves the checkpoints to the one holding it
+                await prune(item, f"{thread_prefix}/{job['seq']}", job["configurable"])
+            counts["done"] += 1
+        else:
+            retry_at = time.time() + backoff(job["attempts"], retry_base, 300.0)
+            await asyncio.to_thread(queue.fail, job["id"], worker, result["error"], retry_at)
+
+    async def beat():
+        while True:
+            await asyncio.to_thread(queue.beat, worker, counts["running"], counts["done"])
+            await asyncio.sleep(WORKER_HEARTBEAT)
+
+    beating = asyncio.create_task(beat())
+    runs = set()
+    try:
+        while not stopping.is_set():
+            await slots.acquire()
+            job = await asyncio.to_thread(queue.claim, worker, visibility_timeout) if not stopping.is_set() else None
+            if job is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(stopping.wait(), poll)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(run(job))
+            runs.add(task)
+            task.add_done_callback(runs.discard)
+        if runs:
+            await asyncio.wait(runs)
+    finally:
+        beating.cancel()
+
+
+def run_worker(path: str, concurrency: int, visibility_timeout: float, poll: float = POLL_INTERVAL,
+               retry_base: float = 5.0, fake: bool = False, seed: int = 0):
+    """The body of a worker process."""
+    # the workers of a queue share their rate limits through its file, unless told otherwise
+    os.environ.setdefault("RATE_LIMIT_STORE", path)
+    # a reclaimed job resumes from its checkpoints, which the graph does not keep unless asked,
+    # in any worker, so the research texts they refer to are kept on disk beside the queue
+    os.environ.setdefault("CHECKPOINTER", "sqlite")
+    os.environ.setdefault("BLOB_STORE", "disk")
+    os.environ.setdefault("BLOB_STORE_PATH", f"{path}.blobs")
+    if fake:
+        from clients import set_client_registry
+        from fake_providers import FakeClientRegistry, LatencyModel
+
+        set_client_registry(FakeClientRegistry(
+            llm_latency=LatencyModel(median=0.05, seed=seed),
+            search_latency=LatencyModel(median=0.2, seed=seed + 1),
+            seed=seed,
+        ))
+    queue = JobQueue(path)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    queue.register(worker, os.getpid())
+    try:
+        asyncio.run(_serve(queue, worker, concurrency, visibility_timeout, poll, retry_base))
+    finally:
+        queue.unregister(worker)
+        queue.close()
+
+
+def supervise(path: str, workers: Optional[int], concurrency: int, visibility_timeout: float,
+              poll: float = POLL_INTERVAL, fake: bool = False, seed: int = 0, until_empty: bool = False,
+              log=sys.stderr):
+    """
+    Keeps the queue's wanted number of worker processes running, restarting
+    those that die, until SIGINT or SIGTERM (or, with `until_empty`, until no
+    job is left). Workers stopped by a scale-down or a shutdown finish their
+    runs first; a second signal kills them, and their jobs are reclaimed later.
+    """
+    queue = JobQueue(path)
+    if workers is not None:
+        queue.set_workers(workers)
+    context = multiprocessing.get_context("spawn")
+    processes, draining = [], set()
+    signals, finished = [], False
+
+    def on_signal(signum, frame):
+        signals.append(signum)
+
+    previous = {signum: signal.signal(signum, on_signal) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        while True:
+            for process in [process for process in processes if not process.is_alive()]:
+                processes.remove(process)
+                if process.pid not in draining:
+                    print(f"worker {process.pid} exited with {process.exitcode}", file=log)
+                draining.discard(process.pid)
+            if len(signals) > 1:
+                for process in processes:
+                    process.kill()
+            if until_empty and not finished:
+                stats = queue.stats()
+                finished = not (stats["queued"] or stats["retrying"] or stats["running"])
+            stopping = bool(signals) or finished
+            wanted = 0 if stopping else queue.wanted_workers()
+            active = [process for process in processes if process.pid not in draining]
+            for _ in range(wanted - len(active)):
+                process = context.Process(
+                    target=run_worker, args=(path, concurrency, visibility_timeout, poll),
+                    kwargs={"fake": fake, "seed": seed}, daemon=False,
+                )
+                process.start()
+                processes.append(process)
+            for process in active[wanted:]:
+                process.terminate()
+                draining.add(process.pid)
+            if stopping and not processes:
+                return
+            time.sleep(poll)
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        queue.close()
+
+
+def main(args):
+    queue = JobQueue(args.queue)
+    if args.command == "enqueue":
+        configurable = json.loads(args.configurable) if args.configurable else {}
+        added = 0
+        for path in args.files:
+            with open(path) as lines:
+                added += queue.enqueue(read_questions(lines), configurable, args.max_attempts)
+        print(f"enqueued {added} jobs")
+    elif args.command == "scale":
+        queue.set_workers(args.workers)
+        print(f"scaling to {args.workers} workers")
+    elif args.command == "status":
+        shared = SharedBuckets(args.queue)
+        while True:
+            print(json.dumps({**queue.stats(args.window), "rate_limits": shared.stats()}), flush=True)
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    elif args.command == "results":
+        output = open(args.output, "w") if args.output else sys.stdout
+        with output:
+            for result in queue.results(include_failed=not args.done_only):
+                output.write(json.dumps(result) + "\n")
+    else:
+        queue.close()
+        supervise(args.queue, args.workers, args.concurrency, args.visibility_timeout, args.poll,
+                  args.fake, args.seed, args.until_empty)
+        print(json.dumps(JobQueue(args.queue).stats()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    enqueue = commands.add_parser("enqueue", help="add the questions of JSONL files to the queue")
+    enqueue.add_argument("queue")
+    enqueue.add_argument("files", nargs="+")
+    enqueue.add_argument("--max-attempts", type=int, default=3)
+    enqueue.add_argument("--configurable", default="", help="JSON of configurable values for these runs")
+    start = commands.add_parser("start", help="run worker processes until interrupted")
+    start.add_argument("queue")
+    start.add_argument("--workers", type=int, default=None, help="worker processes (default: the last scale)")
+    start.add_argument("--concurrency", type=int, default=4, help="questions in flight per worker")
+    start.add_argument("--visibility-timeout", type=float, default=300.0,
+                       help="seconds a job stays claimed by a worker that stopped responding")
+    start.add_argument("--poll", type=float, default=POLL_INTERVAL, help="seconds between idle queue checks")
+    start.add_argument("--until-empty", action="store_true", help="stop once every job has finished")
+    start.add_argument("--fake", action="store_true", help="run on the offline fake providers")
+    start.add_argument("--seed", type=int, default=0)
+    scale = commands.add_parser("scale", help="change the number of worker processes of a running pool")
+    scale.add_argument("queue")
+    scale.add_argument("workers", type=int)
+    status = commands.add_parser("status", help="print the queue depth, workers and throughput")
+    status.add_argument("queue")
+    status.add_argument("--window", type=float, default=60.0, help="seconds of history for the throughput")
+    status.add_argument("--watch", type=float, default=0.0, help="print every this many seconds")
+    results = commands.add_parser("results", help="write the finished jobs as JSON lines")
+    results.add_argument("queue")
+    results.add_argument("--output", default="", help="file to write (default: stdout)")
+    results.add_argument("--done-only", action="store_true", help="leave out the failed jobs")
+    main(parser.parse_args())